@@ -0,0 +1,77 @@
+"""
+Сравнение записи одного клиента: весь инбаунд (/inbounds/update) против
+поклиентного метода (/inbounds/updateClient) на 1k/10k/50k клиентов.
+
+Меряется размер тела запроса и время его подготовки на стороне бота
+(разбор settings + сериализация). Панель для запуска не нужна:
+
+    python benchmarks/bench_client_api.py
+"""
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from functions import InboundSnapshot, build_inbound_update  # noqa: E402
+
+SIZES = (1_000, 10_000, 50_000)
+ROUNDS = 5
+
+
+def make_inbound(n: int) -> dict:
+    clients = [
+        {
+            "id": str(uuid.uuid4()), "flow": "", "email": f"user_{i}", "subId": uuid.uuid4().hex,
+            "limitIp": 5, "totalGB": 0, "expiryTime": 0, "enable": True, "tgId": str(i), "reset": 0,
+            "fingerprint": "chrome", "publicKey": "k" * 43, "shortId": "1234567890", "spiderX": "/",
+            "ip": f"10.0.0.{i % 253 + 2}",
+        }
+        for i in range(n)
+    ]
+    return {
+        "up": 0, "down": 0, "total": 0, "remark": "bench", "enable": True, "expiryTime": 0,
+        "listen": "", "port": 443, "protocol": "vless",
+        "settings": json.dumps({"clients": clients, "decryption": "none"}),
+        "streamSettings": "{}", "sniffing": "{}",
+    }
+
+
+def best_of(fn) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    print(f"{'clients':>8} | {'full: bytes':>12} {'ms':>8} | {'per-client: bytes':>17} {'ms':>8}")
+    for n in SIZES:
+        inbound = make_inbound(n)
+        email = f"user_{n // 2}"
+
+        def full_write():
+            # Старый путь: разбор settings, правка клиента, сериализация всего инбаунда
+            snapshot = InboundSnapshot(1, inbound)
+            snapshot.update_client(email, {"enable": False})
+            return json.dumps(build_inbound_update(inbound, snapshot.settings))
+
+        snapshot = InboundSnapshot(1, inbound)
+
+        def client_write():
+            # Новый путь: снимок уже в кэше, сериализуется только один клиент
+            client = snapshot.update_client(email, {"enable": False})
+            body = {"id": 1, "settings": json.dumps({"clients": [client]}, separators=(",", ":"))}
+            return json.dumps(body)
+
+        full_ms = best_of(full_write)
+        client_ms = best_of(client_write)
+        print(f"{n:>8} | {len(full_write()):>12} {full_ms:>8.2f} | {len(client_write()):>17} {client_ms:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Гонка за многоразовый промокод: тысячи одновременных активаций одного кода
+через promo.redeem_promo_code (транзакция без обращений к панели). Часть
+запросов — повторы от тех же пользователей, часть пользователей ещё не
+зарегистрирована. Печатаются пропускная способность, задержки p50/p95 и исходы,
+затем проверяются инварианты: активаций ровно max_uses, current_uses совпадает
+с числом записей promocode_uses, повторов нет, счётчики админки сходятся
+(reconcile_counters без расхождений). При нарушении — код выхода 1.
+
+    python benchmarks/bench_promo_activation.py [postgresql://...]
+
+Без аргументов гоняется только SQLite (временный файл). Таблицы в указанной
+базе пересоздаются — не запускайте на рабочей БД.
+"""
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+ACTIVATIONS = 5_000
+MAX_USES = 2_000
+REPEAT_SHARE = 0.1   # доля повторных попыток тех же пользователей
+KNOWN_SHARE = 0.5    # доля пользователей, уже зарегистрированных до акции
+
+
+async def run_backend() -> int:
+    # Движок создаётся при импорте database по DATABASE_URL из окружения
+    sys.path.insert(0, SRC)
+    import database
+    import promo as promo_module
+    from sqlalchemy import func, select
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.drop_all)
+    await database.init_db()
+
+    unique_users = int(ACTIVATIONS * (1 - REPEAT_SHARE))
+    user_ids = [50_000 + i for i in range(unique_users)]
+    async with database.Session() as session:
+        await session.execute(database.insert(database.User), [
+            {"telegram_id": telegram_id, "full_name": f"user {telegram_id}", "subscription_end": datetime.utcnow()}
+            for telegram_id in user_ids[:int(unique_users * KNOWN_SHARE)]
+        ])
+        await session.commit()
+    await database.reconcile_counters()
+    promo = await promo_module.create_promo_code(months=1, max_uses=MAX_USES, code="RUSH")
+
+    attempts = user_ids + random.sample(user_ids, ACTIVATIONS - unique_users)
+    random.shuffle(attempts)
+    latencies = []
+    outcomes = Counter()
+    winners = Counter()
+
+    async def activate(telegram_id: int):
+        started = time.perf_counter()
+        try:
+            redeemed, error = await promo_module.redeem_promo_code(telegram_id, promo.code)
+            outcomes[error or "ok"] += 1
+            if redeemed:
+                winners[telegram_id] += 1
+        except Exception as e:
+            outcomes[f"exception: {type(e).__name__}"] += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(activate(telegram_id) for telegram_id in attempts))
+    elapsed = time.perf_counter() - started
+
+    async with database.Session() as session:
+        current_uses = await session.scalar(select(database.PromoCode.current_uses).filter_by(id=promo.id))
+        uses = await session.scalar(select(func.count(database.PromoCodeUse.id)).filter_by(promocode_id=promo.id))
+    drift = await database.reconcile_counters()
+    await database.close_db()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{ACTIVATIONS} активаций за {elapsed:.2f} с: {ACTIVATIONS / elapsed:.0f}/с, "
+          f"p50 {p50:.1f} ms, p95 {p95:.1f} ms")
+    for outcome, count in outcomes.most_common():
+        print(f"     {count:>6}  {outcome}")
+
+    checks = {
+        f"активаций ровно max_uses ({MAX_USES})": outcomes["ok"] == MAX_USES,
+        "current_uses == записей promocode_uses": current_uses == uses == outcomes["ok"],
+        "никто не активировал дважды": all(count == 1 for count in winners.values()),
+        "счётчики админки сходятся": not drift,
+    }
+    for name, passed in checks.items():
+        print(f"{'✅' if passed else '❌'} {name}")
+    return 0 if all(checks.values()) else 1
+
+
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == "--worker":
+        sys.exit(asyncio.run(run_backend()))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        urls = [f"sqlite:///{os.path.join(tmp, 'bench.db')}"] + sys.argv[1:]
+        for url in urls:
+            print(f"\n{url.split('@')[-1]}")
+            # Отдельный процесс на базу: движок и пул создаются заново
+            env = dict(os.environ, DATABASE_URL=url, BOT_TOKEN=os.getenv("BOT_TOKEN", "0:bench"))
+            failed |= subprocess.run([sys.executable, __file__, "--worker"], env=env).returncode != 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Задержка поиска пользователей в админке (database.search_users) на SQLite:
+временная база со 100 000 пользователей, запросы по Telegram ID, username
+и подстроке имени. Печатаются p50/p95/max для FTS5-индекса и для LIKE без индекса.
+
+    python benchmarks/bench_user_search.py [число_пользователей]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+FIRST_NAMES = ["Иван", "Мария", "Алексей", "Ольга", "Дмитрий", "Anna", "John", "Sergey", "Елена", "Павел"]
+LAST_NAMES = ["Петров", "Смирнова", "Кузнецов", "Попова", "Smith", "Ivanov", "Волков", "Соколова"]
+REPEATS = 200
+
+
+async def main(users: int):
+    tmp = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'search.db')}"
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    sys.path.insert(0, SRC)
+    import database
+
+    await database.init_db()
+    rows = [{
+        "telegram_id": 10_000_000 + i,
+        "full_name": f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)} {i}",
+        "username": f"user{i}_{random.randrange(10 ** 6)}" if i % 3 else None,
+        "subscription_end": datetime.utcnow(),
+    } for i in range(users)]
+    async with database.Session() as session:
+        for i in range(0, users, 10_000):
+            await session.execute(database.insert(database.User), rows[i:i + 10_000])
+        await session.commit()
+
+    queries = {
+        "telegram_id": lambda: str(10_000_000 + random.randrange(users)),
+        "username": lambda: "@" + next(r["username"] for r in random.sample(rows, 10) if r["username"]),
+        "подстрока имени": lambda: random.choice(LAST_NAMES)[1:5],
+        "редкая подстрока": lambda: f"{random.randrange(users)}_",
+    }
+
+    print(f"{users} пользователей")
+    print(f"{'режим':>6} {'запрос':>18} {'p50, ms':>9} {'p95, ms':>9} {'max, ms':>9}")
+    for mode, fts in (("fts5", True), ("like", False)):
+        database.USER_SEARCH_FTS = fts
+        for name, make_query in queries.items():
+            latencies = []
+            for _ in range(REPEATS):
+                query = make_query()
+                started = time.perf_counter()
+                await database.search_users(query)
+                latencies.append((time.perf_counter() - started) * 1000)
+            latencies.sort()
+            print(f"{mode:>6} {name:>18} {latencies[len(latencies) // 2]:>9.2f} "
+                  f"{latencies[int(len(latencies) * 0.95)]:>9.2f} {latencies[-1]:>9.2f}")
+    await database.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))
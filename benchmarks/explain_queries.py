@@ -0,0 +1,121 @@
+"""
+Проверка планов горячих запросов: на свежей SQLite-базе (с миграциями init_db)
+вызывает рабочие хелперы database.py / promo.py, перехватывает выполненные ими
+SQL-операторы и печатает для каждого EXPLAIN QUERY PLAN. Завершается с кодом 1,
+если какой-то оператор читает таблицу полным сканированием вместо индекса.
+
+    python benchmarks/explain_queries.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+# Полный проход ожидаем: COUNT(*) и страница по id с OFFSET читают небольшую таблицу
+# промокодов, которую смотрит только админ
+FULL_SCAN_EXPECTED = {"Статистика промокодов: страница"}
+
+
+def hot_queries(database, promo):
+    now = datetime.utcnow()
+    return {
+        "Happ: пользователь по subscription_token":
+            lambda: database.get_user_by_token("token"),
+        "Панель -> пользователь по client_email":
+            lambda: database.get_user_by_client_email("user_1"),
+        "Планировщик истечения: ближайший срок":
+            lambda: database.get_next_expiry_due(now),
+        "Планировщик истечения: истёкшие профили":
+            lambda: database.get_users_due_for_expiry(now),
+        "Планировщик напоминаний: ближайший срок":
+            lambda: database.get_next_reminder_due(now),
+        "Планировщик напоминаний: пользователи к напоминанию":
+            lambda: database.get_users_due_for_reminder(now, now + timedelta(days=1)),
+        "Активные подписки (счётчики + сегодняшние окончания)":
+            lambda: database.count_active_subscriptions(),
+        "Пользователи без подписки: число":
+            lambda: database.count_users(False),
+        "get_all_users: без подписки":
+            lambda: database.get_all_users(False),
+        "Админка: страница пользователей по сроку":
+            lambda: database.get_users_page(True, "expiry", cursor=(now, 1)),
+        "Админка: страница пользователей по регистрации":
+            lambda: database.get_users_page(None, "registration", descending=True, cursor=(1000,)),
+        "Рассылка: получатели пачкой":
+            lambda: database.iter_user_ids(False).__anext__(),
+        "Статистика промокодов: страница":
+            lambda: promo.get_promocodes_page(),
+        "Статистика промокода: активации":
+            lambda: promo.get_promo_activations(1),
+        "Активация промокода":
+            lambda: promo.redeem_promo_code(1, "EXPLAIN"),
+        "Трафик: свёртка корзин за период":
+            lambda: database.rollup_traffic("raw", "hour", now - timedelta(hours=1), now),
+        "Трафик: последняя корзина уровня":
+            lambda: database.get_last_traffic_bucket("hour"),
+        "Трафик: очистка старых корзин":
+            lambda: database.purge_traffic("raw", now),
+        "Трафик: ряд клиента":
+            lambda: database.get_traffic_series("user_1", "hour", now),
+        "Трафик: топ клиентов":
+            lambda: database.get_top_consumers("hour", now, raw_since=now),
+    }
+
+
+async def main() -> int:
+    tmp = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'plans.db')}"
+    os.environ.setdefault("BOT_TOKEN", "0:explain")
+    sys.path.insert(0, SRC)
+    import database
+    import promo
+    from sqlalchemy import event
+
+    await database.init_db()
+    await promo.create_promo_code(months=1, max_uses=10, code="EXPLAIN")
+    await database.create_user(1, "explain")
+
+    # Операторы, которые хелпер действительно отправил в БД, с их параметрами
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")):
+            captured.append((statement, parameters))
+
+    event.listen(database.engine.sync_engine, "before_cursor_execute", capture)
+    queries = {}
+    for name, call in hot_queries(database, promo).items():
+        captured.clear()
+        database.user_cache.invalidate()
+        try:
+            await call()
+        except StopAsyncIteration:
+            pass
+        queries[name] = list(captured)
+    event.remove(database.engine.sync_engine, "before_cursor_execute", capture)
+
+    failed = 0
+    async with database.engine.connect() as conn:
+        for name, statements in queries.items():
+            plans = []
+            for statement, parameters in statements:
+                rows = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                plans.append([row[-1] for row in rows])
+            steps = [step for plan in plans for step in plan]
+            uses_index = bool(statements) and all(
+                "USING" in step and ("INDEX" in step or "PRIMARY KEY" in step)
+                for step in steps if step.startswith(("SCAN", "SEARCH")) and "CONSTANT ROW" not in step
+            )
+            expected = name in FULL_SCAN_EXPECTED
+            failed += not (uses_index or expected)
+            print(f"{'✅' if uses_index or expected else '❌'} {name}{' (полный проход ожидаем)' if expected and not uses_index else ''}")
+            for step in steps:
+                print(f"     {step}")
+    await database.close_db()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
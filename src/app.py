@@ -1,4 +1,3 @@
-import json
 import asyncio
 import logging
 import warnings
@@ -8,14 +7,18 @@ from config import config
 from aiogram import Bot, Dispatcher
 from aiogram.types import PreCheckoutQuery
 from handlers import setup_handlers
-from datetime import datetime, timedelta
+from datetime import datetime
 from functions import (
-    get_user_stats,
     create_vless_profile,
-    generate_vless_url,
-    disable_client_by_email  # заменили delete на disable
+    get_vless_url,
+    close_xui_api
 )
-from database import Session, User, init_db, get_all_users
+from database import init_db, close_db, get_user_by_token, save_user_profile, sync_admins
+from expiry import expiry_scheduler
+from traffic import get_user_stats, run_traffic_collector, traffic_history
+from broadcast import resume_broadcasts
+from counters import run_counters_reconcile
+from sender import send_scheduler
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -30,34 +33,29 @@ async def happ_subscription_handler(request: web.Request) -> web.Response:
     if not token:
         return web.Response(status=400, text="Missing token")
 
-    with Session() as session:
-        user = session.query(User).filter_by(subscription_token=token).first()
-        if not user:
-            return web.Response(status=404, text="User not found")
+    user = await get_user_by_token(token)
+    if not user:
+        return web.Response(status=404, text="User not found")
 
-        telegram_id = user.telegram_id
-        subscription_end = user.subscription_end
-        vless_profile_data = user.vless_profile_data
+    telegram_id = user.telegram_id
+    subscription_end = user.subscription_end
+    email, client_id = user.client_email, user.client_id
 
     now = datetime.utcnow()
     if not subscription_end or subscription_end <= now:
         return web.Response(status=403, text="Subscription expired")
 
-    if not vless_profile_data:
+    if not email:
         profile_data = await create_vless_profile(telegram_id)
         if not profile_data:
             return web.Response(status=500, text="Failed to create profile")
 
-        with Session() as session:
-            db_user = session.query(User).filter_by(telegram_id=telegram_id).first()
-            if db_user:
-                db_user.vless_profile_data = json.dumps(profile_data)
-                session.commit()
-    else:
-        profile_data = json.loads(vless_profile_data)
+        await save_user_profile(telegram_id, profile_data)
+        expiry_scheduler.rearm()
+        email, client_id = profile_data["email"], profile_data["client_id"]
 
     try:
-        stats = await get_user_stats(profile_data["email"])
+        stats = await get_user_stats(email)
     except Exception:
         stats = {"upload": 0, "download": 0}
 
@@ -66,7 +64,7 @@ async def happ_subscription_handler(request: web.Request) -> web.Response:
     total = 0
     expire_ts = int(subscription_end.timestamp()) if subscription_end else 0
 
-    vless_url = generate_vless_url(profile_data)
+    vless_url = await get_vless_url(client_id, email)
 
     title = getattr(config, "HAPP_PROFILE_TITLE", "VPN")
     support_url = getattr(config, "HAPP_SUPPORT_URL", "")
@@ -106,78 +104,16 @@ async def start_http_server():
     logger.info(f"✅ Happ subscription server started on 0.0.0.0:{config.HAPP_PORT}")
 
 
-async def check_subscriptions(bot: Bot):
-    """Проверка статуса подписок"""
-    while True:
-        try:
-            now = datetime.utcnow()
-            users = await get_all_users()
-
-            for user in users:
-                if not user.subscription_end:
-                    continue
-
-                # Уведомление за 24 часа
-                if user.subscription_end - now < timedelta(days=1) and user.subscription_end >= now and not user.notified:
-                    try:
-                        await bot.send_message(
-                            user.telegram_id,
-                            "⚠️ Ваша подписка истекает через 24 часа! Продлите подписку, чтобы сохранить доступ."
-                        )
-                        with Session() as session:
-                            db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                            if db_user:
-                                db_user.notified = True
-                                session.commit()
-                    except Exception as e:
-                        logger.warning(f"⚠️ Notification error: {e}")
-
-                # Истечение подписки
-                if user.subscription_end and user.subscription_end <= now and user.vless_profile_data:
-                    try:
-                        profile = json.loads(user.vless_profile_data)
-                        success = await disable_client_by_email(profile["email"])
-                        if success:
-                            with Session() as session:
-                                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                                if db_user:
-                                    db_user.is_enabled_in_panel = False
-                                    session.commit()
-                            await bot.send_message(
-                                user.telegram_id,
-                                "❌ Ваша подписка истекла! Доступ к VPN отключён. Продлите подписку, чтобы восстановить доступ."
-                            )
-                        else:
-                            logger.warning(f"⚠️ Failed to disable client {profile['email']} from inbound")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Deletion error: {e}")
-        except Exception as e:
-            logger.warning(f"⚠️ Subscription check error: {e}")
-
-        await asyncio.sleep(3600)
-
-
 async def update_admins_status():
     """Обновляет статус администраторов в базе данных"""
-    with Session() as session:
-        session.query(User).update({User.is_admin: False})
-        for admin_id in config.ADMINS:
-            user = session.query(User).filter_by(telegram_id=admin_id).first()
-            if user:
-                user.is_admin = True
-            else:
-                new_admin = User(
-                    telegram_id=admin_id,
-                    full_name=f"Admin {admin_id}",
-                    is_admin=True
-                )
-                session.add(new_admin)
-        session.commit()
+    await sync_admins(config.ADMINS)
     logger.info("✅ Admin status updated in database")
 
 
 async def main():
     bot = Bot(token=config.BOT_TOKEN)
+    # Все исходящие запросы бота проходят через общий планировщик с приоритетами и лимитами
+    bot.session.middleware(send_scheduler)
     dp = Dispatcher()
 
     try:
@@ -200,10 +136,25 @@ async def main():
         await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
     try:
-        asyncio.create_task(check_subscriptions(bot))
+        asyncio.create_task(expiry_scheduler.run(bot))
     except Exception as e:
         logger.error(f"❌ Subscription check task failed to start: {e}")
 
+    try:
+        asyncio.create_task(run_traffic_collector())
+    except Exception as e:
+        logger.error(f"❌ Traffic collector failed to start: {e}")
+
+    try:
+        asyncio.create_task(run_counters_reconcile())
+    except Exception as e:
+        logger.error(f"❌ Counters reconcile task failed to start: {e}")
+
+    try:
+        await resume_broadcasts(bot)
+    except Exception as e:
+        logger.error(f"❌ Failed to resume broadcasts: {e}")
+
     try:
         asyncio.create_task(start_http_server())
     except Exception as e:
@@ -215,6 +166,14 @@ async def main():
     except Exception as e:
         logger.error(f"❌ Bot start error: {e}")
         return
+    finally:
+        # Незакрытая корзина трафика иначе теряется при каждом перезапуске
+        try:
+            await traffic_history.flush()
+        except Exception as e:
+            logger.error(f"❌ Failed to flush traffic history: {e}")
+        await close_xui_api()
+        await close_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from config import config
+from sender import Priority, set_send_priority
+from datetime import datetime
+from database import (
+    BroadcastJob,
+    count_users,
+    iter_user_ids,
+    create_broadcast_job,
+    get_broadcast_job,
+    get_broadcast_jobs,
+    update_broadcast_job,
+    save_broadcast_progress,
+    get_delivered_ids
+)
+
+logger = logging.getLogger(__name__)
+
+TARGETS = {"active": True, "inactive": False, "all": None}
+
+
+class Broadcast:
+    """
+    Рассылка по заданию из БД: получатели читаются страницами (keyset) после курсора задания,
+    отправка идёт BROADCAST_CONCURRENCY воркерами через общий планировщик с приоритетом BULK.
+    Результаты доставки пишутся в БД пачками, курсор сдвигается после полной обработки страницы,
+    поэтому после рестарта рассылка продолжается с последнего подтверждённого получателя.
+    """
+
+    def __init__(self, bot: Bot, job: BroadcastJob):
+        self.bot = bot
+        self.job_id = job.id
+        self.text = job.text
+        self.with_subscription = TARGETS.get(job.target)
+        self.cursor = job.cursor or 0
+        self.report_chat_id = job.report_chat_id
+        self.progress_message_id = job.progress_message_id
+        self.total = job.total
+        self.sent = job.sent or 0
+        self.failed = job.failed or 0
+        self.done_at_start = self.sent + self.failed
+        self.pending = []      # [(telegram_id, status)], ещё не записанные в БД
+        self.stop_status = None  # paused | cancelled, если рассылку остановили
+        self.started_at = None
+
+    def stop(self, status: str):
+        """Останавливает рассылку: новые получатели не берутся, уже начатые отправки завершаются"""
+        self.stop_status = status
+
+    async def run(self):
+        # Рассылка уступает дорогу ответам пользователям, платежам и уведомлениям
+        set_send_priority(Priority.BULK)
+        self.started_at = time.monotonic()
+        if not self.progress_message_id:
+            message = await self.bot.send_message(
+                self.report_chat_id, f"📨 Рассылка запущена: {self.total} получателей"
+            )
+            self.progress_message_id = message.message_id
+            await update_broadcast_job(self.job_id, progress_message_id=self.progress_message_id)
+
+        queue = asyncio.Queue(maxsize=config.BROADCAST_CONCURRENCY * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(config.BROADCAST_CONCURRENCY)]
+        reporter = asyncio.create_task(self._report_loop())
+        resumed = self.cursor > 0 or self.done_at_start > 0
+        try:
+            async for last_id, telegram_ids in iter_user_ids(
+                    self.with_subscription, config.BROADCAST_PAGE_SIZE, self.cursor):
+                if self.stop_status:
+                    break
+                skip = set()
+                if resumed and telegram_ids:
+                    # Страница, на которой прервались: часть получателей уже обработана
+                    skip = await get_delivered_ids(self.job_id, telegram_ids)
+                    resumed = False
+                for telegram_id in telegram_ids:
+                    if self.stop_status:
+                        break
+                    if telegram_id not in skip:
+                        await queue.put(telegram_id)
+                await queue.join()
+                if self.stop_status:
+                    break
+                # Курсор — последняя прочитанная строка, а не последний получатель:
+                # строки без telegram_id при возобновлении не перечитываются
+                await self._flush(cursor=last_id)
+            # Дожидаемся уже начатых отправок, чтобы их результат попал в БД
+            await queue.join()
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+            await self._flush()
+
+        if self.stop_status:
+            await update_broadcast_job(self.job_id, status=self.stop_status)
+            logger.info(f"ℹ️  Broadcast {self.job_id} {self.stop_status}: {self.sent} sent, {self.failed} failed")
+        else:
+            await update_broadcast_job(self.job_id, status='done', finished_at=datetime.utcnow())
+            logger.info(f"✅ Broadcast {self.job_id} finished: {self.sent} sent, {self.failed} failed of {self.total}")
+        await self._report(final=True)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            telegram_id = await queue.get()
+            try:
+                if self.stop_status:
+                    continue
+                if await self.deliver(telegram_id):
+                    self.sent += 1
+                    self.pending.append((telegram_id, 'sent'))
+                else:
+                    self.failed += 1
+                    self.pending.append((telegram_id, 'failed'))
+                if len(self.pending) >= config.BROADCAST_FLUSH_SIZE:
+                    await self._flush()
+            finally:
+                queue.task_done()
+
+    async def _flush(self, cursor: int = None):
+        """Записывает накопленные результаты одной транзакцией (и курсор, если страница завершена)"""
+        deliveries, self.pending = self.pending, []
+        if not deliveries and cursor is None:
+            return
+        try:
+            await save_broadcast_progress(self.job_id, deliveries, cursor)
+            if cursor is not None:
+                self.cursor = cursor
+        except Exception as e:
+            # Вернём результаты в очередь записи, попробуем при следующем сбросе
+            self.pending = deliveries + self.pending
+            logger.error(f"🛑 Failed to save broadcast {self.job_id} progress: {e}")
+
+    async def deliver(self, telegram_id: int) -> bool:
+        """Отправляет сообщение одному получателю (лимиты и RetryAfter — в планировщике отправки)"""
+        try:
+            await self.bot.send_message(telegram_id, self.text)
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning(f"⚠️ Broadcast to {telegram_id} gave up after flood control: {e}")
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            logger.debug(f"⚙️ Broadcast to {telegram_id} rejected: {e}")
+        except Exception as e:
+            logger.error(f"🛑 Ошибка отправки сообщения {telegram_id}: {e}")
+        return False
+
+    def progress_text(self, final: bool = False) -> str:
+        done = self.sent + self.failed
+        elapsed = max(time.monotonic() - self.started_at, 0.001)
+        speed = (done - self.done_at_start) / elapsed
+        if self.stop_status == 'paused':
+            header = f"⏸ Рассылка #{self.job_id} приостановлена: {done}/{self.total}"
+        elif self.stop_status == 'cancelled':
+            header = f"✖️ Рассылка #{self.job_id} отменена: {done}/{self.total}"
+        elif final:
+            header = f"📨 Результаты рассылки #{self.job_id}:"
+        else:
+            eta = (self.total - done) / speed if speed > 0 else 0
+            header = (f"📨 Рассылка #{self.job_id}: {done}/{self.total} "
+                      f"({speed:.1f} сообщ./с, осталось ~{int(eta)} с)")
+        return (
+            f"{header}\n\n"
+            f"• Успешно: {self.sent}\n"
+            f"• Не удалось: {self.failed}\n"
+            f"• Всего: {self.total}"
+        )
+
+    async def _report(self, final: bool = False):
+        try:
+            await self.bot.edit_message_text(
+                self.progress_text(final),
+                chat_id=self.report_chat_id,
+                message_id=self.progress_message_id
+            )
+        except Exception as e:
+            logger.debug(f"⚙️ Broadcast progress update skipped: {e}")
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(config.BROADCAST_PROGRESS_INTERVAL)
+            await self._report()
+
+
+# Запущенные в этом процессе рассылки по id задания
+active_broadcasts = {}
+
+
+def _launch(bot: Bot, job: BroadcastJob) -> Broadcast:
+    broadcast = Broadcast(bot, job)
+    active_broadcasts[job.id] = broadcast
+    task = asyncio.create_task(broadcast.run())
+
+    def _done(task: asyncio.Task):
+        active_broadcasts.pop(job.id, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"🛑 Broadcast {job.id} crashed: {task.exception()}")
+
+    task.add_done_callback(_done)
+    return broadcast
+
+
+async def start_broadcast(bot: Bot, text: str, target: str, report_chat_id: int) -> Broadcast:
+    """Создаёт задание рассылки и запускает его в фоне"""
+    total = await count_users(TARGETS.get(target))
+    job = await create_broadcast_job(text, target, report_chat_id, total)
+    return _launch(bot, job)
+
+
+async def resume_broadcast(bot: Bot, job_id: int) -> bool:
+    job = await get_broadcast_job(job_id)
+    if not job or job.status not in ('running', 'paused') or job_id in active_broadcasts:
+        return False
+    await update_broadcast_job(job_id, status='running')
+    job.status = 'running'
+    _launch(bot, job)
+    return True
+
+
+async def stop_broadcast(job_id: int, status: str) -> bool:
+    """Ставит рассылку на паузу (status='paused') или отменяет её (status='cancelled')"""
+    broadcast = active_broadcasts.get(job_id)
+    if broadcast:
+        # Итоговый статус запишет сама рассылка, когда остановятся воркеры
+        broadcast.stop(status)
+        return True
+    job = await get_broadcast_job(job_id)
+    if not job or job.status not in ('running', 'paused'):
+        return False
+    if status == 'cancelled' or job.status == 'running':
+        await update_broadcast_job(job_id, status=status)
+    return True
+
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжает рассылки, прерванные остановкой бота"""
+    for job in await get_broadcast_jobs(['running']):
+        logger.info(f"ℹ️  Resuming broadcast {job.id} after restart ({job.sent + job.failed}/{job.total})")
+        _launch(bot, job)
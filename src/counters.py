@@ -0,0 +1,34 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from config import config
+from database import reconcile_counters, get_counters, counter_key
+
+logger = logging.getLogger(__name__)
+
+
+async def get_today_counters() -> dict:
+    """Показатели за сегодня (UTC) для админ-меню: регистрации, оплаты, звёзды, промокоды"""
+    now = datetime.utcnow()
+    names = ("signups", "payments", "stars", "promo_uses")
+    values = await get_counters(*(counter_key(name, now) for name in names))
+    return {name: values[counter_key(name, now)] for name in names}
+
+
+async def run_counters_reconcile():
+    """Ночная сверка счётчиков с данными в COUNTERS_RECONCILE_HOUR (UTC)"""
+    while True:
+        now = datetime.utcnow()
+        next_run = now.replace(hour=config.COUNTERS_RECONCILE_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            drift = await reconcile_counters()
+            if drift:
+                fixed = ", ".join(f"{key}: {old} -> {new}" for key, (old, new) in sorted(drift.items()))
+                logger.warning(f"⚠️ Counters drift fixed: {fixed}")
+            else:
+                logger.info("✅ Counters reconciled, no drift")
+        except Exception as e:
+            logger.error(f"❌ Counters reconcile error: {e}")
@@ -1,8 +1,20 @@
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, func, text, ForeignKey, UniqueConstraint
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from sqlalchemy import event, inspect, bindparam, Column, Integer, BigInteger, String, DateTime, Boolean, func, text, tuple_, table, column, or_, and_, select, insert, update, delete, ForeignKey, UniqueConstraint, Index
+import asyncio
+import functools
+import json
 import logging
+import time
 import uuid
+from config import config
 
 logger = logging.getLogger(__name__)
 
@@ -24,8 +36,8 @@ class PromoCode(Base):
 class PromoCodeUse(Base):
     __tablename__ = 'promocode_uses'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.telegram_id'), nullable=False)  # telegram_id
-    promocode_id = Column(Integer, ForeignKey('promocodes.id'), nullable=False)
+    user_id = Column(BigInteger, ForeignKey('users.telegram_id'), nullable=False, index=True)  # telegram_id
+    promocode_id = Column(Integer, ForeignKey('promocodes.id'), nullable=False, index=True)
     used_at = Column(DateTime, default=datetime.utcnow)
 
     # Уникальность: один пользователь не может использовать один промокод дважды
@@ -34,20 +46,39 @@ class PromoCodeUse(Base):
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True)
+    telegram_id = Column(BigInteger, unique=True)  # BIGINT: ID Telegram выходят за 32 бита
     full_name = Column(String)
     username = Column(String)
     registration_date = Column(DateTime, default=datetime.utcnow)
-    subscription_end = Column(DateTime)
+    subscription_end = Column(DateTime, index=True)  # выборки по сроку: статистика, списки, планировщик
     vless_profile_id = Column(String)
-    vless_profile_data = Column(String)
+    vless_profile_data = Column(String)  # полный ответ создания профиля (JSON), для чтения — колонки ниже
+    client_email = Column(String, index=True)   # email клиента в панели
+    client_id = Column(String, index=True)      # UUID клиента в панели
+    client_sub_id = Column(String, index=True)  # subId клиента в панели
     is_admin = Column(Boolean, default=False)
     notified = Column(Boolean, default=False)
-    subscription_token = Column(String, unique=True)
+    subscription_token = Column(String, unique=True, index=True)  # поиск при каждом запросе Happ
     happ_install_code = Column(String, nullable=True)  # код от Happ
     device_limit = Column(Integer, default=1)  # лимит устройств (можно брать из тарифа)
     is_enabled_in_panel = Column(Boolean, default=True)
 
+class SchemaMigration(Base):
+    """Применённые миграции схемы"""
+    __tablename__ = 'schema_migrations'
+    version = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+class StatCounter(Base):
+    """
+    Счётчики для админ-экранов, обновляемые в тех же транзакциях, что и данные:
+    users_total, signups:<день>, expires:<день> (подписки, истекающие в этот день),
+    payments:<день>, stars:<день>, promo_uses, promo_uses:<день>. Дни — UTC, YYYY-MM-DD.
+    """
+    __tablename__ = 'stat_counters'
+    key = Column(String, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
 class StaticProfile(Base):
     __tablename__ = 'static_profiles'
     id = Column(Integer, primary_key=True)
@@ -55,28 +86,545 @@ class StaticProfile(Base):
     vless_url = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-engine = create_engine('sqlite:///users.db', echo=False)
-Session = sessionmaker(bind=engine)
+class TrafficSample(Base):
+    """Трафик клиента за интервал: raw — корзины по TRAFFIC_BUCKET_SECONDS, hour/day — агрегаты"""
+    __tablename__ = 'traffic_samples'
+    id = Column(Integer, primary_key=True)
+    email = Column(String, nullable=False)
+    granularity = Column(String, nullable=False)   # raw | hour | day
+    bucket_start = Column(DateTime, nullable=False)
+    upload = Column(BigInteger, default=0)
+    download = Column(BigInteger, default=0)
+
+    # Индекс по клиенту: выборка ряда одного клиента идёт по префиксу (email, granularity).
+    # Индекс по времени: свёртка, очистка и топ клиентов выбирают корзины уровня за период
+    __table_args__ = (
+        UniqueConstraint('email', 'granularity', 'bucket_start', name='_traffic_bucket_uc'),
+        Index('ix_traffic_granularity_bucket', 'granularity', 'bucket_start'),
+    )
+
+class BroadcastJob(Base):
+    """Рассылка: текст, аудитория и курсор по users.id, до которого все получатели обработаны"""
+    __tablename__ = 'broadcast_jobs'
+    id = Column(Integer, primary_key=True)
+    text = Column(String, nullable=False)
+    target = Column(String, nullable=False)           # active | inactive | all
+    status = Column(String, default='running')        # running | paused | cancelled | done
+    cursor = Column(Integer, default=0)               # последний users.id, страница до которого подтверждена
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    report_chat_id = Column(BigInteger)
+    progress_message_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class BroadcastDelivery(Base):
+    """Результат доставки рассылки одному получателю"""
+    __tablename__ = 'broadcast_deliveries'
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id'), nullable=False)
+    telegram_id = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False)           # sent | failed
+
+    __table_args__ = (UniqueConstraint('job_id', 'telegram_id', name='_broadcast_delivery_uc'),)
+
+def database_url(url: str) -> str:
+    """Подставляет асинхронный драйвер, если в URL указан синхронный (sqlite:// или postgresql://)"""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith(("postgresql:", "postgres:")):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+def create_engine_from_url(url: str):
+    url = database_url(url)
+    if not url.startswith("postgresql"):
+        return create_async_engine(url, echo=False)
+    # PostgreSQL: пул соединений, проверка соединения перед выдачей и таймаут на каждый запрос
+    return create_async_engine(
+        url,
+        echo=False,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        connect_args={
+            "server_settings": {"statement_timeout": str(config.DB_STATEMENT_TIMEOUT)},
+            "command_timeout": config.DB_STATEMENT_TIMEOUT / 1000 + 5,
+        },
+    )
+
+# Асинхронный движок: запросы не блокируют event loop бота и HTTP-сервера
+engine = create_engine_from_url(config.DATABASE_URL)
+# expire_on_commit=False: объекты, возвращённые хелперами, читаются и после закрытия сессии
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+SQLITE_TUNED = engine.dialect.name == "sqlite" and config.SQLITE_TUNING
+
+if SQLITE_TUNED:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        """Профиль SQLite для одного сервера: WAL, ослабленный fsync, mmap и большой кэш страниц"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT}")
+        cursor.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+
+# Выставлен внутри задачи писателя: вложенные записи выполняются сразу, без очереди
+_in_writer = ContextVar("in_db_writer", default=False)
+
+
+class DatabaseWriter:
+    """
+    Единственный писатель SQLite: все записи выполняются по очереди в одной задаче,
+    поэтому писатели не конкурируют за блокировку БД, а читатели (в режиме WAL)
+    никогда не получают "database is locked". Для PostgreSQL очередь не используется.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.queue = None
+        self._task = None
+        self._loop = None
+        self.writes = 0
+        self.errors = 0
+        self.waits = deque(maxlen=1000)      # время в очереди, сек
+        self.latencies = deque(maxlen=1000)  # время в очереди + выполнение, сек
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self.queue = asyncio.Queue()
+            self._loop = loop
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, func, *args, **kwargs):
+        if not self.enabled or _in_writer.get():
+            return await func(*args, **kwargs)
+        self._ensure_task()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((func, args, kwargs, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        _in_writer.set(True)
+        while True:
+            func, args, kwargs, future, enqueued = await self.queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                started = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    self.errors += 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+                finished = time.perf_counter()
+                self.writes += 1
+                self.waits.append(started - enqueued)
+                self.latencies.append(finished - enqueued)
+            finally:
+                self.queue.task_done()
+
+    async def close(self):
+        """Дожидается выполнения поставленных записей и останавливает задачу писателя"""
+        if self._task and not self._task.done():
+            await self.queue.join()
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "writes": self.writes,
+            "errors": self.errors,
+            "avg_wait_ms": sum(self.waits) / len(self.waits) * 1000 if self.waits else 0.0,
+            "avg_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0,
+        }
+
+
+db_writer = DatabaseWriter(enabled=SQLITE_TUNED and config.SQLITE_SINGLE_WRITER)
 
-async def init_db():
-    Base.metadata.create_all(engine)
 
-    # Добавляем недостающие колонки в существующую БД (если нужно)
-    try:
-        with engine.connect() as conn:
-            conn.execute(text("ALTER TABLE users ADD COLUMN subscription_token VARCHAR"))
-    except Exception:
-        # Колонка уже существует или БД ещё не создана полностью
-        pass
+def writes(func):
+    """Помечает хелпер как запись: в режиме SQLite он выполняется через db_writer"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await db_writer.submit(func, *args, **kwargs)
+    return wrapper
+
+
+class UserCache:
+    """
+    Кэш чтения пользователей: LRU на size записей с TTL, ключи telegram_id и subscription_token.
+    Хранит значения колонок, а не ORM-объекты: каждый get отдаёт новый отсоединённый User,
+    поэтому изменения одного обработчика не видны другим до записи в БД.
+    Все хелперы записи пользователей вызывают invalidate после коммита. Чтение, начатое
+    до инвалидации, не кладёт в кэш устаревшую строку (проверка по generation).
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # telegram_id -> (значения колонок, time.monotonic() истечения)
+        self.tokens = {}              # subscription_token -> telegram_id
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, telegram_id):
+        entry = self.entries.get(telegram_id)
+        if entry is None:
+            return None
+        values, expires = entry
+        if expires < time.monotonic():
+            self._drop(telegram_id)
+            return None
+        self.entries.move_to_end(telegram_id)
+        user = User()
+        for key, value in values.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return user
+
+    def get(self, telegram_id: int):
+        user = self._lookup(telegram_id)
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    def get_by_token(self, token: str):
+        return self.get(self.tokens.get(token))
+
+    def put(self, user, generation: int):
+        """Кладёт строку, прочитанную при данном generation, если с тех пор не было записей"""
+        if not self.size or user is None or generation != self.generation:
+            return
+        self._drop(user.telegram_id)
+        values = {column.key: getattr(user, column.key) for column in User.__mapper__.column_attrs}
+        self.entries[user.telegram_id] = (values, time.monotonic() + self.ttl)
+        if user.subscription_token:
+            self.tokens[user.subscription_token] = user.telegram_id
+        while len(self.entries) > self.size:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, telegram_id):
+        entry = self.entries.pop(telegram_id, None)
+        if entry is not None:
+            self.tokens.pop(entry[0]["subscription_token"], None)
+
+    def invalidate(self, *telegram_ids):
+        """Сбрасывает записи указанных пользователей, без аргументов — весь кэш"""
+        self.generation += 1
+        if not telegram_ids:
+            self.entries.clear()
+            self.tokens.clear()
+        for telegram_id in telegram_ids:
+            self._drop(telegram_id)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+user_cache = UserCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+
+async def _has_column(conn, table: str, column: str) -> bool:
+    columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns(table))
+    return any(c["name"] == column for c in columns)
+
+async def _create_indexes(conn, *tables):
+    """
+    Создаёт объявленные в моделях индексы, которых ещё нет в БД.
+    Индексы по колонкам, которые добавит более поздняя миграция, пропускаются —
+    их создаст та миграция.
+    """
+    for model_table in tables:
+        columns = {c["name"] for c in await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns(model_table.name))}
+        for index in model_table.indexes:
+            if all(index_column.name in columns for index_column in index.columns):
+                await conn.run_sync(lambda sync_conn: index.create(sync_conn, checkfirst=True))
+
+async def _migrate_subscription_token(conn):
+    if not await _has_column(conn, "users", "subscription_token"):
+        await conn.execute(text("ALTER TABLE users ADD COLUMN subscription_token VARCHAR"))
+
+async def _migrate_lookup_indexes(conn):
+    await _create_indexes(conn, User.__table__, PromoCodeUse.__table__)
+
+async def _migrate_traffic_index(conn):
+    await _create_indexes(conn, TrafficSample.__table__)
+
+async def _migrate_profile_columns(conn):
+    for column_name in ("client_email", "client_id", "client_sub_id"):
+        if not await _has_column(conn, "users", column_name):
+            await conn.execute(text(f"ALTER TABLE users ADD COLUMN {column_name} VARCHAR"))
+    await _create_indexes(conn, User.__table__)
+
+async def _backfill_profile_columns(conn, batch_size: int = 500):
+    """Заполняет колонки профиля из JSON vless_profile_data пачками, коммитя каждую пачку"""
+    last_id = 0
+    filled = 0
+    while True:
+        rows = (await conn.execute(
+            select(User.id, User.vless_profile_data).where(
+                User.id > last_id,
+                User.vless_profile_data.isnot(None),
+                User.client_email.is_(None)
+            ).order_by(User.id).limit(batch_size)
+        )).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        values = []
+        for row in rows:
+            try:
+                profile = json.loads(row.vless_profile_data)
+            except (TypeError, ValueError):
+                continue
+            if isinstance(profile, dict) and profile.get("email"):
+                values.append({"row_id": row.id, **profile_columns(profile)})
+        if values:
+            await conn.execute(
+                update(User.__table__).where(User.__table__.c.id == bindparam("row_id")).values(
+                    client_email=bindparam("client_email"),
+                    client_id=bindparam("client_id"),
+                    client_sub_id=bindparam("client_sub_id"),
+                ),
+                values
+            )
+            filled += len(values)
+        # Пачка фиксируется сразу, чтобы не держать блокировку записи на всё время переноса
+        await conn.commit()
+    if filled:
+        logger.info(f"ℹ️  Profile columns backfilled for {filled} users")
+
+async def _migrate_user_search(conn):
+    """
+    Индекс поиска пользователей по подстроке full_name/username.
+    SQLite: FTS5-таблица с триграммным токенизатором поверх users, синхронизируемая триггерами
+    (любой UPDATE имени — в том числе из /start — сразу попадает в индекс).
+    PostgreSQL: GIN-индексы pg_trgm для ILIKE, если расширение доступно.
+    """
+    if conn.dialect.name == "sqlite":
+        try:
+            await conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+                "full_name, username, content='users', content_rowid='id', tokenize='trigram')"
+            ))
+        except Exception as e:
+            # SQLite старше 3.34 без триграмм: поиск будет работать через LIKE
+            logger.warning(f"⚠️ User search index is not available: {e}")
+            return
+        for statement in (
+            "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN "
+            "INSERT INTO users_fts(rowid, full_name, username) VALUES (new.id, new.full_name, new.username); END",
+            "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN "
+            "INSERT INTO users_fts(users_fts, rowid, full_name, username) "
+            "VALUES ('delete', old.id, old.full_name, old.username); END",
+            "CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF full_name, username ON users BEGIN "
+            "INSERT INTO users_fts(users_fts, rowid, full_name, username) "
+            "VALUES ('delete', old.id, old.full_name, old.username); "
+            "INSERT INTO users_fts(rowid, full_name, username) VALUES (new.id, new.full_name, new.username); END",
+            "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+        ):
+            await conn.execute(text(statement))
+    elif conn.dialect.name == "postgresql":
+        try:
+            async with conn.begin_nested():
+                await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                for column_name in ("full_name", "username"):
+                    await conn.execute(text(
+                        f"CREATE INDEX IF NOT EXISTS ix_users_{column_name}_trgm ON users USING gin ({column_name} gin_trgm_ops)"
+                    ))
+        except Exception as e:
+            logger.warning(f"⚠️ pg_trgm is not available, user search will scan the table: {e}")
+
+async def _rebuild_counters(conn) -> dict:
+    """
+    Пересчитывает счётчики из users и promocode_uses и возвращает расхождения {ключ: (было, стало)}.
+    Оплаты (payments, stars) хранятся только в счётчиках и не пересчитываются.
+    """
+    fresh = Counter({"users_total": await conn.scalar(select(func.count(User.id)))})
+    for name, column_, model in (
+        ("signups", User.registration_date, User),
+        ("expires", User.subscription_end, User),
+        ("promo_uses", PromoCodeUse.used_at, PromoCodeUse),
+    ):
+        day = func.date(column_)
+        rows = await conn.execute(select(day, func.count(model.id)).filter(column_.isnot(None)).group_by(day))
+        for value_day, count in rows:
+            fresh[f"{name}:{value_day}"] = count
+    fresh["promo_uses"] = await conn.scalar(select(func.count(PromoCodeUse.id)))
+
+    rebuilt = ("users_total", "promo_uses", "signups:", "expires:", "promo_uses:")
+    current = {
+        row.key: row.value for row in await conn.execute(select(StatCounter.key, StatCounter.value))
+        if row.key.startswith(rebuilt)
+    }
+    drift = {
+        key: (current.get(key, 0), fresh.get(key, 0))
+        for key in current.keys() | fresh.keys()
+        if current.get(key, 0) != fresh.get(key, 0)
+    }
+    if drift:
+        await conn.execute(delete(StatCounter).where(StatCounter.key.in_(list(drift))))
+        rows = [{"key": key, "value": new} for key, (_, new) in drift.items() if new]
+        if rows:
+            await conn.execute(insert(StatCounter), rows)
+    return drift
+
+# Миграции существующих БД: create_all создаёт только новые таблицы, поэтому новые колонки
+# и индексы старых таблиц добавляются здесь. Каждая миграция идемпотентна и выполняется один раз.
+MIGRATIONS = [
+    ("0001_users_subscription_token", _migrate_subscription_token),
+    ("0002_lookup_indexes", _migrate_lookup_indexes),
+    ("0003_profile_columns", _migrate_profile_columns),
+    ("0004_backfill_profile_columns", _backfill_profile_columns),
+    ("0005_user_search", _migrate_user_search),
+    ("0006_stat_counters", _rebuild_counters),
+    ("0007_traffic_bucket_index", _migrate_traffic_index),
+]
+
+async def run_migrations():
+    async with engine.connect() as conn:
+        applied = set(await conn.scalars(select(SchemaMigration.version)))
+    for version, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            # Своя транзакция на миграцию: в PostgreSQL ошибка обрывает всю транзакцию.
+            # Долгие миграции могут коммитить промежуточные пачки сами
+            async with engine.connect() as conn:
+                await migrate(conn)
+                await conn.execute(insert(SchemaMigration).values(version=version, applied_at=datetime.utcnow()))
+                await conn.commit()
+            logger.info(f"✅ Migration applied: {version}")
+        except Exception as e:
+            # Следующие миграции могут зависеть от этой — останавливаемся
+            logger.error(f"❌ Migration {version} failed: {e}")
+            return
+
+async def init_db():
+    global USER_SEARCH_FTS
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await run_migrations()
+    async with engine.connect() as conn:
+        USER_SEARCH_FTS = await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table("users_fts"))
 
     logger.info("✅ Database tables created")
 
+async def close_db():
+    """Закрывает соединения пула (иначе рабочие потоки aiosqlite не дают процессу завершиться)"""
+    await db_writer.close()
+    await engine.dispose()
+
+def counter_key(name: str, day: datetime = None) -> str:
+    return f"{name}:{day.strftime('%Y-%m-%d')}" if day else name
+
+def expiry_move(old_end: datetime, new_end: datetime) -> Counter:
+    """Изменение счётчиков expires:<день> при переносе окончания подписки"""
+    deltas = Counter()
+    if old_end:
+        deltas[counter_key("expires", old_end)] -= 1
+    if new_end:
+        deltas[counter_key("expires", new_end)] += 1
+    return deltas
+
+def signup_deltas(subscription_end: datetime = None) -> Counter:
+    deltas = Counter({"users_total": 1, counter_key("signups", datetime.utcnow()): 1})
+    deltas.update(expiry_move(None, subscription_end))
+    return deltas
+
+def upsert_insert(model):
+    """INSERT с поддержкой ON CONFLICT для диалекта текущей базы"""
+    return (postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert)(model)
+
+async def bump_counters(session, deltas: dict):
+    """Прибавляет deltas к счётчикам в транзакции session (UPSERT, без чтения)"""
+    # Ключи по порядку: параллельные транзакции блокируют строки в одной очерёдности (без дедлоков)
+    rows = [{"key": key, "value": value} for key, value in sorted(deltas.items()) if value]
+    if not rows:
+        return
+    statement = upsert_insert(StatCounter).values(rows)
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[StatCounter.key],
+        set_={"value": StatCounter.value + statement.excluded.value}
+    ))
+
+@writes
+async def reconcile_counters() -> dict:
+    """Сверяет счётчики с данными (ночная задача); возвращает исправленные расхождения"""
+    async with engine.begin() as conn:
+        return await _rebuild_counters(conn)
+
+async def get_counters(*keys) -> dict:
+    async with Session() as session:
+        rows = await session.execute(select(StatCounter.key, StatCounter.value).filter(StatCounter.key.in_(keys)))
+        values = {row.key: row.value for row in rows}
+    return {key: values.get(key, 0) for key in keys}
+
+async def count_active_subscriptions() -> int:
+    """
+    Активные подписки: сумма expires:<день> после сегодняшнего дня (не больше строки на день)
+    плюс сегодняшние ещё не истёкшие — короткий диапазон индекса subscription_end
+    """
+    now = datetime.utcnow()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    async with Session() as session:
+        later = await session.scalar(select(func.coalesce(func.sum(StatCounter.value), 0)).filter(
+            # Префикс через LIKE: верхняя граница строкой зависела бы от правил сортировки БД
+            StatCounter.key.like("expires:%"),
+            StatCounter.key >= counter_key("expires", tomorrow)
+        ))
+        today = await session.scalar(select(func.count(User.id)).filter(
+            User.subscription_end > now, User.subscription_end < tomorrow
+        ))
+    return int(later) + today
+
 async def get_user(telegram_id: int):
-    with Session() as session:
-        return session.query(User).filter_by(telegram_id=telegram_id).first()
+    user = user_cache.get(telegram_id)
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    async with Session() as session:
+        user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
+    user_cache.put(user, generation)
+    return user
 
+async def get_user_by_token(token: str):
+    user = user_cache.get_by_token(token)
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    async with Session() as session:
+        user = await session.scalar(select(User).filter_by(subscription_token=token))
+    user_cache.put(user, generation)
+    return user
+
+@writes
 async def create_user(telegram_id: int, full_name: str, username: str = None, is_admin: bool = False):
-    with Session() as session:
+    async with Session() as session:
         user = User(
             telegram_id=telegram_id,
             full_name=full_name,
@@ -86,27 +634,136 @@ async def create_user(telegram_id: int, full_name: str, username: str = None, is
             subscription_token=str(uuid.uuid4())
         )
         session.add(user)
-        session.commit()
+        await bump_counters(session, signup_deltas(user.subscription_end))
+        await session.commit()
+        user_cache.invalidate(telegram_id)
         logger.info(f"✅ New user created: {telegram_id}")
         return user
 
+def profile_columns(profile_data: dict) -> dict:
+    """Значения колонок профиля из ответа создания профиля"""
+    return {
+        "client_email": profile_data.get("email"),
+        "client_id": profile_data.get("client_id"),
+        "client_sub_id": profile_data.get("subId") or None,
+    }
+
+@writes
+async def save_user_profile(telegram_id: int, profile_data: dict, **fields) -> bool:
+    """Сохраняет созданный профиль: JSON целиком и колонки email/client_id/subId"""
+    return await update_user(
+        telegram_id,
+        vless_profile_data=json.dumps(profile_data),
+        **profile_columns(profile_data),
+        **fields
+    )
+
+def assign_profile(user: User, profile_data: dict):
+    """Записывает созданный профиль в поля объекта user; сохранит их flush_user"""
+    user.vless_profile_data = json.dumps(profile_data)
+    for key, value in profile_columns(profile_data).items():
+        setattr(user, key, value)
+
+@writes
+async def flush_user(user: User) -> bool:
+    """
+    Записывает изменённые на объекте user поля одним UPDATE и снимает с них отметку
+    изменения. Объект может быть отсоединён от сессии (как всё, что возвращает get_user).
+    """
+    state = inspect(user)
+    fields = {attr.key: attr.value for attr in state.attrs if attr.history.added}
+    if not fields:
+        return False
+    await update_user(user.telegram_id, **fields)
+    for key, value in fields.items():
+        set_committed_value(user, key, value)
+    return True
+
+async def get_user_by_client_email(email: str):
+    async with Session() as session:
+        return await session.scalar(select(User).filter_by(client_email=email))
+
+@writes
+async def update_user(telegram_id: int, **fields) -> bool:
+    """Обновляет поля пользователя одним UPDATE; False, если пользователя нет"""
+    async with Session() as session:
+        result = await session.execute(
+            update(User).where(User.telegram_id == telegram_id).values(**fields)
+        )
+        await session.commit()
+        user_cache.invalidate(telegram_id)
+        return result.rowcount > 0
+
+@writes
+async def shift_subscription(telegram_id: int, delta: timedelta):
+    """
+    Сдвигает окончание подписки на delta. Добавление считается от текущего окончания
+    (или от сейчас, если подписка истекла), уменьшение не опускает окончание раньше текущего момента.
+    Возвращает обновлённого пользователя или None.
+    """
+    async with Session() as session:
+        user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
+        if not user:
+            return None
+        now = datetime.utcnow()
+        old_end = user.subscription_end
+        if delta >= timedelta(0):
+            if user.subscription_end and user.subscription_end > now:
+                user.subscription_end += delta
+            else:
+                user.subscription_end = now + delta
+        else:
+            new_end = user.subscription_end + delta if user.subscription_end else now
+            user.subscription_end = max(new_end, now)
+        await bump_counters(session, expiry_move(old_end, user.subscription_end))
+        await session.commit()
+        user_cache.invalidate(telegram_id)
+        return user
+
+@writes
+async def sync_admins(admin_ids: list):
+    """Проставляет is_admin по списку из конфига, создавая недостающих администраторов"""
+    async with Session() as session:
+        await session.execute(update(User).values(is_admin=False))
+        for admin_id in admin_ids:
+            user = await session.scalar(select(User).filter_by(telegram_id=admin_id))
+            if user:
+                user.is_admin = True
+            else:
+                session.add(User(
+                    telegram_id=admin_id,
+                    full_name=f"Admin {admin_id}",
+                    is_admin=True
+                ))
+                await bump_counters(session, signup_deltas())
+        await session.commit()
+        user_cache.invalidate()
+
+@writes
 async def delete_user_profile(telegram_id: int):
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    async with Session() as session:
+        user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
         if user:
             user.vless_profile_data = None
+            user.client_email = user.client_id = user.client_sub_id = None
             user.notified = False
-            session.commit()
+            await session.commit()
+            user_cache.invalidate(telegram_id)
             logger.info(f"✅ User profile deleted: {telegram_id}")
 
-async def update_subscription(telegram_id: int, months: int):
-    """Обновляет подписку с учетом текущего состояния"""
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+@writes
+async def update_subscription(telegram_id: int, months: int, stars: int = None):
+    """
+    Обновляет подписку с учетом текущего состояния.
+    stars — сумма оплаты: платёж учитывается в счётчиках той же транзакцией
+    """
+    async with Session() as session:
+        user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
         if user:
             now = datetime.utcnow()
+            old_end = user.subscription_end
             # Если подписка активна, добавляем к текущей дате окончания
-            if user.subscription_end > now:
+            if user.subscription_end and user.subscription_end > now:
                 user.subscription_end += timedelta(days=months * 30)
             else:
                 # Если подписка истекла, начинаем с текущей даты
@@ -114,36 +771,360 @@ async def update_subscription(telegram_id: int, months: int):
             
             # Сбрасываем флаг уведомления
             user.notified = False
-            session.commit()
+            deltas = expiry_move(old_end, user.subscription_end)
+            if stars is not None:
+                deltas[counter_key("payments", now)] += 1
+                deltas[counter_key("stars", now)] += stars
+            await bump_counters(session, deltas)
+            await session.commit()
+            user_cache.invalidate(telegram_id)
             logger.info(f"✅ Subscription updated for {telegram_id}: +{months} months")
             return True
         return False
 
+def _subscription_filter(query, with_subscription: bool = None):
+    if with_subscription is not None:
+        if with_subscription:
+            query = query.filter(User.subscription_end > datetime.utcnow())
+        else:
+            query = query.filter(User.subscription_end <= datetime.utcnow())
+    return query
+
 async def get_all_users(with_subscription: bool = None):
-    with Session() as session:
-        query = session.query(User)
-        if with_subscription is not None:
-            if with_subscription:
-                query = query.filter(User.subscription_end > datetime.utcnow())
-            else:
-                query = query.filter(User.subscription_end <= datetime.utcnow())
-        return query.all()
+    async with Session() as session:
+        return (await session.scalars(_subscription_filter(select(User), with_subscription))).all()
+
+async def count_users(with_subscription: bool = None) -> int:
+    """Число пользователей по счётчикам (без подсчёта строк users)"""
+    if with_subscription is None:
+        return (await get_counters("users_total"))["users_total"]
+    active = await count_active_subscriptions()
+    if with_subscription:
+        return active
+    return (await get_counters("users_total"))["users_total"] - active - await _count_undated_users()
 
+async def _count_undated_users() -> int:
+    """
+    Пользователи без даты окончания (например, админы): по предикату _subscription_filter
+    они не попадают ни в активные, ни в список без подписки
+    """
+    async with Session() as session:
+        return await session.scalar(select(func.count(User.id)).filter(User.subscription_end.is_(None)))
+
+# Порядки списка пользователей для админки: колонки keyset-ключа (последняя — уникальная)
+USER_ORDERS = {
+    "expiry": (User.subscription_end, User.id),
+    "registration": (User.id,),  # id растёт в порядке регистрации
+}
+
+async def get_users_page(with_subscription: bool = None, order: str = "expiry", descending: bool = False,
+                         cursor: tuple = None, backward: bool = False, page_size: int = 20):
+    """
+    Страница списка пользователей с keyset-пагинацией: строки после (или, при backward,
+    перед) ключа cursor в порядке order. Выбираются только колонки для вывода в списке.
+    Возвращает (строки, есть ли ещё строки в направлении чтения).
+    """
+    columns = USER_ORDERS[order]
+    key = tuple_(*columns) if len(columns) > 1 else columns[0]
+    ascending = descending == backward
+    query = _subscription_filter(select(
+        User.id, User.telegram_id, User.full_name, User.username,
+        User.subscription_end, User.registration_date
+    ), with_subscription)
+    if cursor:
+        bound = tuple_(*cursor) if len(columns) > 1 else cursor[0]
+        query = query.filter(key > bound if ascending else key < bound)
+    query = query.order_by(*(c.asc() if ascending else c.desc() for c in columns)).limit(page_size + 1)
+    async with Session() as session:
+        rows = (await session.execute(query)).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+# Есть ли FTS5-индекс поиска (выставляется в init_db после миграций)
+USER_SEARCH_FTS = False
+users_fts = table("users_fts", column("rowid"))
+
+async def search_users(query: str, limit: int = 10):
+    """
+    Поиск пользователей для админки: точное совпадение Telegram ID либо подстрока
+    имени или username (не короче 3 символов). Возвращает строки с колонками для списка.
+    """
+    query = query.strip().lstrip("@")
+    columns = (User.id, User.telegram_id, User.full_name, User.username, User.subscription_end)
+    async with Session() as session:
+        if query.isdigit():
+            rows = (await session.execute(select(*columns).filter(User.telegram_id == int(query)))).all()
+            if rows:
+                return rows
+        if len(query) < 3:
+            return []
+        if USER_SEARCH_FTS:
+            # Вся строка — одна фраза: триграммы ищут её как подстроку в любой из колонок.
+            # Новые пользователи первыми: FTS5 отдаёт совпадения в порядке rowid без сортировки
+            # (ранжирование bm25 пришлось бы считать для всех совпадений частой подстроки)
+            phrase = '"' + query.replace('"', '""') + '"'
+            statement = select(*columns).join(users_fts, users_fts.c.rowid == User.id).where(
+                text("users_fts MATCH :phrase").bindparams(phrase=phrase)
+            ).order_by(users_fts.c.rowid.desc())
+        else:
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            statement = select(*columns).filter(or_(
+                User.full_name.ilike(pattern, escape="\\"),
+                User.username.ilike(pattern, escape="\\")
+            )).order_by(User.id.desc())
+        return (await session.execute(statement.limit(limit))).all()
+
+async def iter_user_ids(with_subscription: bool = None, page_size: int = 500, after_id: int = 0):
+    """
+    Отдаёт страницы получателей по id (keyset), не загружая всю таблицу:
+    (id последней прочитанной строки, [telegram_id]). Список может быть пустым,
+    если на странице нет пользователей с telegram_id, — курсор всё равно сдвигается
+    """
+    last_id = after_id
+    while True:
+        async with Session() as session:
+            rows = (await session.execute(_subscription_filter(
+                select(User.id, User.telegram_id).filter(User.id > last_id),
+                with_subscription
+            ).order_by(User.id).limit(page_size))).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield last_id, [row.telegram_id for row in rows if row.telegram_id]
+
+@writes
+async def create_broadcast_job(text: str, target: str, report_chat_id: int, total: int) -> BroadcastJob:
+    async with Session() as session:
+        job = BroadcastJob(text=text, target=target, report_chat_id=report_chat_id, total=total)
+        session.add(job)
+        await session.commit()
+        await session.refresh(job)
+        return job
+
+async def get_broadcast_job(job_id: int):
+    async with Session() as session:
+        return await session.get(BroadcastJob, job_id)
+
+async def get_broadcast_jobs(statuses) -> list:
+    async with Session() as session:
+        return (await session.scalars(select(BroadcastJob).filter(
+            BroadcastJob.status.in_(statuses)
+        ).order_by(BroadcastJob.id))).all()
+
+@writes
+async def update_broadcast_job(job_id: int, **fields):
+    async with Session() as session:
+        await session.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(**fields))
+        await session.commit()
+
+@writes
+async def save_broadcast_progress(job_id: int, deliveries: list, cursor: int = None):
+    """
+    Сохраняет пачку результатов [(telegram_id, status)] одной транзакцией
+    и, если передан cursor, сдвигает курсор задания
+    """
+    async with Session() as session:
+        if deliveries:
+            await session.execute(insert(BroadcastDelivery), [
+                {"job_id": job_id, "telegram_id": telegram_id, "status": status}
+                for telegram_id, status in deliveries
+            ])
+        sent = sum(1 for _, status in deliveries if status == 'sent')
+        fields = {
+            BroadcastJob.sent: BroadcastJob.sent + sent,
+            BroadcastJob.failed: BroadcastJob.failed + len(deliveries) - sent,
+        }
+        if cursor is not None:
+            fields[BroadcastJob.cursor] = cursor
+        await session.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(fields))
+        await session.commit()
+
+async def get_delivered_ids(job_id: int, telegram_ids: list) -> set:
+    """Получатели из списка, которым рассылка уже отправлялась (для продолжения после рестарта)"""
+    if not telegram_ids:
+        return set()
+    async with Session() as session:
+        rows = await session.scalars(select(BroadcastDelivery.telegram_id).filter(
+            BroadcastDelivery.job_id == job_id,
+            BroadcastDelivery.telegram_id.in_(telegram_ids)
+        ))
+        return set(rows)
+
+@writes
 async def create_static_profile(name: str, vless_url: str):
-    with Session() as session:
+    async with Session() as session:
         profile = StaticProfile(name=name, vless_url=vless_url)
         session.add(profile)
-        session.commit()
+        await session.commit()
         logger.info(f"✅ Static profile created: {name}")
         return profile
 
 async def get_static_profiles():
-    with Session() as session:
-        return session.query(StaticProfile).all()
+    async with Session() as session:
+        return (await session.scalars(select(StaticProfile))).all()
+
+async def get_static_profile(profile_id: int):
+    async with Session() as session:
+        return await session.get(StaticProfile, profile_id)
+
+@writes
+async def delete_static_profile(profile_id: int):
+    async with Session() as session:
+        await session.execute(delete(StaticProfile).where(StaticProfile.id == profile_id))
+        await session.commit()
 
 async def get_user_stats():
-    with Session() as session:
-        total = session.query(func.count(User.id)).scalar()
-        with_sub = session.query(func.count(User.id)).filter(User.subscription_end > datetime.utcnow()).scalar()
-        without_sub = total - with_sub
-        return total, with_sub, without_sub
\ No newline at end of file
+    total = (await get_counters("users_total"))["users_total"]
+    with_sub = await count_active_subscriptions()
+    # Как count_users(False): без пользователей без даты окончания, чтобы меню совпадало со списком
+    without_sub = total - with_sub - await _count_undated_users()
+    return total, with_sub, without_sub
+
+@writes
+async def add_traffic_samples(granularity: str, bucket_start: datetime, deltas: dict, chunk_size: int = 1000):
+    """
+    Записывает корзину трафика: deltas — email -> (upload, download).
+    Если корзина уже есть (сброс при остановке и снова после перезапуска), приросты суммируются.
+    Строки пишутся пачками по chunk_size, чтобы не упираться в лимит параметров запроса
+    """
+    if not deltas:
+        return
+    rows = [
+        {"email": email, "granularity": granularity, "bucket_start": bucket_start, "upload": up, "download": down}
+        for email, (up, down) in deltas.items()
+    ]
+    async with Session() as session:
+        for i in range(0, len(rows), chunk_size):
+            statement = upsert_insert(TrafficSample).values(rows[i:i + chunk_size])
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[TrafficSample.email, TrafficSample.granularity, TrafficSample.bucket_start],
+                set_={
+                    "upload": TrafficSample.upload + statement.excluded.upload,
+                    "download": TrafficSample.download + statement.excluded.download,
+                }
+            ))
+        await session.commit()
+
+@writes
+async def rollup_traffic(source: str, target: str, start: datetime, end: datetime) -> int:
+    """Сворачивает корзины source за [start, end) в одну корзину target по каждому клиенту"""
+    async with Session() as session:
+        rows = (await session.execute(select(
+            TrafficSample.email,
+            func.sum(TrafficSample.upload),
+            func.sum(TrafficSample.download)
+        ).filter(
+            TrafficSample.granularity == source,
+            TrafficSample.bucket_start >= start,
+            TrafficSample.bucket_start < end
+        ).group_by(TrafficSample.email))).all()
+        if rows:
+            await session.execute(insert(TrafficSample), [
+                {"email": email, "granularity": target, "bucket_start": start,
+                 "upload": int(up or 0), "download": int(down or 0)}
+                for email, up, down in rows
+            ])
+            await session.commit()
+        return len(rows)
+
+async def get_last_traffic_bucket(granularity: str):
+    async with Session() as session:
+        return await session.scalar(select(func.max(TrafficSample.bucket_start)).filter(
+            TrafficSample.granularity == granularity
+        ))
+
+@writes
+async def purge_traffic(granularity: str, before: datetime) -> int:
+    """Удаляет корзины старше срока хранения"""
+    async with Session() as session:
+        result = await session.execute(delete(TrafficSample).where(
+            TrafficSample.granularity == granularity,
+            TrafficSample.bucket_start < before
+        ))
+        await session.commit()
+        return result.rowcount
+
+async def get_traffic_series(email: str, granularity: str, since: datetime):
+    """Ряд трафика клиента: [(bucket_start, upload, download)] по возрастанию времени"""
+    async with Session() as session:
+        return (await session.execute(select(
+            TrafficSample.bucket_start, TrafficSample.upload, TrafficSample.download
+        ).filter(
+            TrafficSample.email == email,
+            TrafficSample.granularity == granularity,
+            TrafficSample.bucket_start >= since
+        ).order_by(TrafficSample.bucket_start))).all()
+
+async def get_top_consumers(granularity: str, since: datetime, limit: int = 10, raw_since: datetime = None):
+    """Клиенты с наибольшим трафиком: [(email, upload, download)]
+
+    raw_since — добавить к агрегатам ещё не свёрнутые raw-корзины начиная с этого момента
+    """
+    async with Session() as session:
+        total = func.sum(TrafficSample.upload + TrafficSample.download)
+        condition = and_(TrafficSample.granularity == granularity, TrafficSample.bucket_start >= since)
+        if raw_since is not None:
+            condition = or_(condition, and_(
+                TrafficSample.granularity == "raw", TrafficSample.bucket_start >= raw_since
+            ))
+        return (await session.execute(select(
+            TrafficSample.email,
+            func.sum(TrafficSample.upload),
+            func.sum(TrafficSample.download)
+        ).filter(condition).group_by(TrafficSample.email).order_by(total.desc()).limit(limit))).all()
+
+async def get_next_reminder_due(after: datetime):
+    """Ближайший subscription_end после after у пользователей, которым ещё не отправлено напоминание"""
+    async with Session() as session:
+        return await session.scalar(select(func.min(User.subscription_end)).filter(
+            User.notified.isnot(True),
+            User.subscription_end > after
+        ))
+
+async def get_next_expiry_due(after: datetime):
+    """Ближайший subscription_end после after у пользователей с включённым в панели профилем"""
+    async with Session() as session:
+        return await session.scalar(select(func.min(User.subscription_end)).filter(
+            User.client_email.isnot(None),
+            User.is_enabled_in_panel.isnot(False),
+            User.subscription_end > after
+        ))
+
+async def get_users_due_for_reminder(now: datetime, until: datetime):
+    """Пользователи, у которых подписка кончается в [now, until) и напоминания ещё не было"""
+    async with Session() as session:
+        return (await session.scalars(select(User).filter(
+            User.notified.isnot(True),
+            User.subscription_end >= now,
+            User.subscription_end < until
+        ))).all()
+
+async def get_users_due_for_expiry(now: datetime):
+    """Пользователи с истёкшей подпиской, чей профиль ещё включён в панели"""
+    async with Session() as session:
+        return (await session.scalars(select(User).filter(
+            User.client_email.isnot(None),
+            User.is_enabled_in_panel.isnot(False),
+            User.subscription_end <= now
+        ))).all()
+
+@writes
+async def mark_user_notified(telegram_id: int):
+    await update_user(telegram_id, notified=True)
+
+@writes
+async def set_users_panel_enabled(telegram_ids: list, enabled: bool, chunk_size: int = 500):
+    """Массово проставляет is_enabled_in_panel одним UPDATE на каждые chunk_size пользователей"""
+    async with Session() as session:
+        for i in range(0, len(telegram_ids), chunk_size):
+            await session.execute(
+                update(User).where(
+                    User.telegram_id.in_(telegram_ids[i:i + chunk_size])
+                ).values(is_enabled_in_panel=enabled),
+                execution_options={"synchronize_session": False}
+            )
+        await session.commit()
+        user_cache.invalidate(*telegram_ids)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from aiogram import Bot
+from config import config
+from functions import disable_clients_by_email
+from database import (
+    get_next_reminder_due, get_next_expiry_due,
+    get_users_due_for_reminder, get_users_due_for_expiry,
+    mark_user_notified, set_users_panel_enabled
+)
+from sender import Priority, set_send_priority
+
+logger = logging.getLogger(__name__)
+
+REMINDER_BEFORE = timedelta(days=1)
+
+
+class ExpiryScheduler:
+    """
+    Планировщик уведомлений и отключения подписок.
+    Спит до ближайшего срока (напоминание за сутки или окончание подписки),
+    который берётся индексированным запросом по subscription_end.
+    rearm() будит его после любого изменения сроков, чтобы пересчитать ближайший срок.
+    """
+
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+
+    def rearm(self):
+        """Сообщает планировщику, что сроки подписок изменились"""
+        self._wakeup.set()
+
+    async def next_deadline(self, now: datetime) -> datetime:
+        deadlines = [now + timedelta(seconds=config.EXPIRY_MAX_SLEEP)]
+        reminder_end = await get_next_reminder_due(now + REMINDER_BEFORE)
+        if reminder_end:
+            deadlines.append(reminder_end - REMINDER_BEFORE)
+        expiry_end = await get_next_expiry_due(now)
+        if expiry_end:
+            deadlines.append(expiry_end)
+        return min(deadlines)
+
+    async def run(self, bot: Bot):
+        # Напоминания и уведомления об истечении уступают ответам пользователям и платежам
+        set_send_priority(Priority.NOTIFICATION)
+        while True:
+            self._wakeup.clear()
+            try:
+                now = datetime.utcnow()
+                await self.process_due(bot, now)
+                # Срок считается от того же now, чтобы не пропустить подписки, истёкшие во время обработки
+                delay = (await self.next_deadline(now) - datetime.utcnow()).total_seconds()
+            except Exception as e:
+                logger.warning(f"⚠️ Subscription check error: {e}")
+                delay = config.EXPIRY_MAX_SLEEP
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_due(self, bot: Bot, now: datetime):
+        # Уведомление за 24 часа
+        for user in await get_users_due_for_reminder(now, now + REMINDER_BEFORE):
+            try:
+                await bot.send_message(
+                    user.telegram_id,
+                    "⚠️ Ваша подписка истекает через 24 часа! Продлите подписку, чтобы сохранить доступ."
+                )
+                await mark_user_notified(user.telegram_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Notification error: {e}")
+
+        # Истечение подписки: все истёкшие отключаются одной записью инбаунда
+        results = await self.expire_users(await get_users_due_for_expiry(now))
+        for telegram_id, success in results.items():
+            if not success:
+                continue
+            try:
+                await bot.send_message(
+                    telegram_id,
+                    "❌ Ваша подписка истекла! Доступ к VPN отключён. Продлите подписку, чтобы восстановить доступ."
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Notification error: {e}")
+
+    async def expire_users(self, users: list) -> dict:
+        """
+        Отключает клиентов пользователей в панели пакетом и одним UPDATE помечает их в БД.
+        Возвращает {telegram_id: успех}.
+        """
+        emails = {user.telegram_id: user.client_email for user in users if user.client_email}
+        if not emails:
+            return {}
+
+        disabled = await disable_clients_by_email(list(emails.values()))
+        results = {telegram_id: disabled.get(email, False) for telegram_id, email in emails.items()}
+        for telegram_id, success in results.items():
+            if not success:
+                logger.warning(f"⚠️ Failed to disable client {emails[telegram_id]} from inbound")
+
+        done = [telegram_id for telegram_id, success in results.items() if success]
+        if done:
+            await set_users_panel_enabled(done, False)
+            logger.info(f"✅ Disabled {len(done)} expired subscription(s)")
+        return results
+
+
+expiry_scheduler = ExpiryScheduler()
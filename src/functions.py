@@ -1,4 +1,8 @@
 import aiohttp
+import asyncio
+import copy
+import hashlib
+import time
 import uuid
 import subprocess
 from datetime import datetime, timedelta
@@ -11,11 +15,275 @@ import secrets
 
 logger = logging.getLogger(__name__)
 
+def inbound_fingerprint(inbound: dict) -> str:
+    """Дешёвый отпечаток списка клиентов: хэш строки settings без разбора JSON"""
+    raw = inbound.get("settings") or ""
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+
+def build_inbound_update(inbound: dict, settings: dict) -> dict:
+    """Формирует тело запроса /inbounds/update из данных инбаунда и новых settings"""
+    return {
+        "up": inbound["up"],
+        "down": inbound["down"],
+        "total": inbound["total"],
+        "remark": inbound["remark"],
+        "enable": inbound["enable"],
+        "expiryTime": inbound["expiryTime"],
+        "listen": inbound["listen"],
+        "port": inbound["port"],
+        "protocol": inbound["protocol"],
+        "settings": json.dumps(settings, separators=(",", ":"), ensure_ascii=False),
+        "streamSettings": inbound["streamSettings"],
+        "sniffing": inbound["sniffing"],
+    }
+
+
+class InboundSnapshot:
+    """
+    Снимок инбаунда из панели с уже разобранными settings и списком клиентов.
+    Держит индексы email -> позиция в списке, tgId -> email и subId -> email,
+    чтобы поиск клиента не требовал прохода по всему списку.
+    changes — журнал изменённых клиентов [(op, client)], op: add/update/delete.
+    Пакет записи меняет не кэшированный снимок, а его копию (fork): читатели кэша
+    не видят клиентов, которых ещё нет в панели.
+    """
+
+    def __init__(self, inbound_id: int, inbound: dict, settings: dict = None, version: int = 1,
+                 index: "InboundSnapshot" = None):
+        self.inbound_id = inbound_id
+        self.inbound = inbound
+        self.settings = settings if settings is not None else json.loads(inbound.get("settings") or "{}")
+        self.clients = self.settings.setdefault("clients", [])
+        self.fingerprint = inbound_fingerprint(inbound)
+        self.version = version
+        self.fetched_at = time.monotonic()
+        self.changes = []
+        self.parent = None  # снимок из кэша, от которого сделана копия (fork)
+        if index is not None and index.clients is self.clients:
+            # Список клиентов тот же (запись из кэша) — индексы уже актуальны
+            self.by_email = index.by_email
+            self.email_by_tg = index.email_by_tg
+            self.email_by_sub = index.email_by_sub
+        else:
+            self._build_index()
+
+    def fork(self) -> "InboundSnapshot":
+        """
+        Копия для изменений пакета: свой список клиентов и индексы, словари клиентов
+        общие — update_client заменяет словарь изменённого клиента копией
+        """
+        forked = copy.copy(self)
+        forked.settings = {**self.settings, "clients": list(self.clients)}
+        forked.clients = forked.settings["clients"]
+        forked.by_email = dict(self.by_email)
+        forked.email_by_tg = dict(self.email_by_tg)
+        forked.email_by_sub = dict(self.email_by_sub)
+        forked.changes = []
+        forked.parent = self
+        return forked
+
+    def sync_settings(self):
+        """Пересобирает строку settings и отпечаток из текущего списка клиентов (после записи в панель)"""
+        self.inbound = {**self.inbound, "settings": json.dumps(self.settings, separators=(",", ":"), ensure_ascii=False)}
+        self.fingerprint = inbound_fingerprint(self.inbound)
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.fetched_at < config.XUI_INBOUND_CACHE_TTL
+
+    def _build_index(self):
+        self.by_email = {}
+        self.email_by_tg = {}
+        self.email_by_sub = {}
+        for pos, client in enumerate(self.clients):
+            email = client.get("email")
+            if email is not None and email not in self.by_email:
+                self.by_email[email] = pos
+                self._index_keys(client)
+
+    def _index_keys(self, client: dict):
+        email = client.get("email")
+        if client.get("tgId"):
+            self.email_by_tg[str(client["tgId"])] = email
+        if client.get("subId"):
+            self.email_by_sub[client["subId"]] = email
+
+    def _unindex_keys(self, client: dict):
+        email = client.get("email")
+        tg_id = str(client.get("tgId") or "")
+        if tg_id and self.email_by_tg.get(tg_id) == email:
+            del self.email_by_tg[tg_id]
+        sub_id = client.get("subId")
+        if sub_id and self.email_by_sub.get(sub_id) == email:
+            del self.email_by_sub[sub_id]
+
+    def find_client(self, email: str):
+        """Клиент по email или None"""
+        pos = self.by_email.get(email)
+        return self.clients[pos] if pos is not None else None
+
+    def find_client_by_tg_id(self, telegram_id) -> dict:
+        email = self.email_by_tg.get(str(telegram_id))
+        return self.find_client(email) if email else None
+
+    def find_client_by_sub_id(self, sub_id: str) -> dict:
+        email = self.email_by_sub.get(sub_id)
+        return self.find_client(email) if email else None
+
+    def add_client(self, client: dict):
+        self.clients.append(client)
+        email = client.get("email")
+        if email not in self.by_email:
+            self.by_email[email] = len(self.clients) - 1
+            self._index_keys(client)
+        self.changes.append(("add", client))
+
+    def update_client(self, email: str, changes: dict):
+        """Применяет изменения к клиенту, поддерживая индексы. Возвращает клиента или None"""
+        pos = self.by_email.get(email)
+        if pos is None:
+            return None
+        self._unindex_keys(self.clients[pos])
+        # Новый словарь, а не правка на месте: исходный может принадлежать снимку в кэше
+        client = self.clients[pos] = {**self.clients[pos], **changes}
+        self._index_keys(client)
+        self.changes.append(("update", client))
+        return client
+
+    def remove_client(self, email: str):
+        """Удаляет клиента; позиции сдвигаются только у клиентов после удалённого"""
+        pos = self.by_email.pop(email, None)
+        if pos is None:
+            return None
+        client = self.clients.pop(pos)
+        self._unindex_keys(client)
+        for i in range(pos, len(self.clients)):
+            other = self.clients[i].get("email")
+            if self.by_email.get(other) == i + 1:
+                self.by_email[other] = i
+        self.changes.append(("delete", client))
+        return client
+
+
+class InboundWriteBatcher:
+    """
+    Собирает изменения клиентов одного инбаунда за короткое окно (XUI_BATCH_WINDOW)
+    или до XUI_BATCH_MAX_SIZE штук и применяет их одной записью /inbounds/update.
+    Каждый вызывающий получает свой результат через future.
+    """
+
+    def __init__(self, api: "XUIAPI", inbound_id: int):
+        self.api = api
+        self.inbound_id = inbound_id
+        self._pending = []  # [(mutation, failed, future)]
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, mutation, failed=False):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((mutation, failed, future))
+        if len(self._pending) >= config.XUI_BATCH_MAX_SIZE:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(config.XUI_BATCH_WINDOW, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._apply(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Немедленно записывает накопленные изменения и ждёт завершения записей"""
+        self._start_flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _apply(self, batch: list):
+        async with self.api.inbound_lock(self.inbound_id):
+            results = [failed for _, failed, _ in batch]
+            try:
+                for attempt in range(config.XUI_WRITE_RETRIES + 1):
+                    cached = await self.api.get_inbound_snapshot(self.inbound_id)
+                    if not cached:
+                        logger.error(f"🛑 Inbound {self.inbound_id} not found")
+                        break
+
+                    # Изменения — в копию; в кэш она попадёт только после успешной записи
+                    snapshot, results, changes = self._apply_mutations(cached, batch)
+                    if not any(changes):
+                        break
+
+                    logger.info(f"ℹ️  Writing {len(batch)} client change(s) to inbound {self.inbound_id}")
+                    saved = await self.api.write_client_changes(snapshot, changes)
+                    if saved is not None:
+                        results = [
+                            result if ok else failed
+                            for result, ok, (_, failed, _) in zip(results, saved, batch)
+                        ]
+                        break
+
+                    # Инбаунд изменили в обход бота: изменения применяются заново к свежему снимку
+                    logger.warning(f"⚠️ Inbound {self.inbound_id} changed concurrently, retrying ({attempt + 1})")
+                else:
+                    logger.error(f"🛑 Inbound {self.inbound_id} write gave up after {config.XUI_WRITE_RETRIES} conflicts")
+                    results = [failed for _, failed, _ in batch]
+            except Exception as e:
+                self.api.invalidate_inbound(self.inbound_id)
+                logger.exception(f"🛑 Inbound batch write error: {e}")
+                results = [failed for _, failed, _ in batch]
+
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    @staticmethod
+    def _apply_mutations(cached: "InboundSnapshot", batch: list):
+        """
+        Применяет изменения пакета к копии снимка; возвращает копию, результаты и журналы
+        изменений по вызывающим. Если изменение упало на середине, копия могла остаться
+        частично изменённой — она собирается заново без этого изменения.
+        """
+        broken = set()
+        while True:
+            snapshot = cached.fork()
+            results = [failed for _, failed, _ in batch]
+            changes = [[] for _ in batch]
+            for i, (mutation, failed, _) in enumerate(batch):
+                if i in broken:
+                    continue
+                snapshot.changes = []
+                try:
+                    result = mutation(snapshot)
+                except Exception as e:
+                    logger.exception(f"🛑 Client mutation error: {e}")
+                    broken.add(i)
+                    break
+                if result:
+                    results[i] = result
+                    changes[i] = snapshot.changes
+            else:
+                snapshot.changes = []
+                return snapshot, results, changes
+
+
 class XUIAPI:
     def __init__(self):
         self.session = None
         self.cookie_jar = aiohttp.CookieJar(unsafe=True)  # Разрешаем небезопасные куки
         self.auth_cookies = None
+        self.logged_in_at = None  # time.monotonic() последнего успешного логина
+        self._login_lock = asyncio.Lock()
+        self._inbounds = {}  # inbound_id -> InboundSnapshot
+        self._batchers = {}  # inbound_id -> InboundWriteBatcher
+        self._inbound_locks = {}  # inbound_id -> asyncio.Lock
+        self.client_api_supported = None  # есть ли в панели addClient/updateClient/delClient
+        self.client_api_checked_at = None  # time.monotonic() решения об отсутствии этих методов
         # Формируем базовый URL с учётом базового пути
         self.base_url = config.XUI_API_URL.rstrip('/')
         self.api_prefix = "/panel/api"
@@ -34,17 +302,44 @@ class XUIAPI:
         """Генерирует уникальный ID для ссылки подписки клиента"""
         return str(uuid.uuid4()).replace('-', '')[:16]
 
-    async def login(self):
-        """Аутентификация в 3x-UI API"""
-        try:
-            # Создаем новую сессию с общей куки-банкой
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию с пулом соединений, создавая её при необходимости"""
+        if self.session is None or self.session.closed:
             self.session = aiohttp.ClientSession(
                 cookie_jar=self.cookie_jar,
                 trust_env=True,  # Доверять переменным окружения для прокси
-                connector=aiohttp.TCPConnector(ssl=False)
-            )   # <-- добавить
-                
-            
+                connector=aiohttp.TCPConnector(
+                    ssl=False,
+                    limit=config.XUI_POOL_SIZE,
+                    keepalive_timeout=60
+                ),
+                timeout=aiohttp.ClientTimeout(total=config.XUI_TIMEOUT)
+            )
+        return self.session
+
+    def is_authenticated(self) -> bool:
+        """Проверяет, что куки авторизации есть и ещё не истекли"""
+        if self.logged_in_at is None:
+            return False
+        return time.monotonic() - self.logged_in_at < config.XUI_SESSION_TTL
+
+    async def login(self, force: bool = False):
+        """Аутентификация в 3x-UI API (повторно используется, пока куки не истекли)"""
+        if not force and self.is_authenticated():
+            return True
+
+        async with self._login_lock:
+            # Пока ждали блокировку, логин мог выполнить другой запрос
+            if not force and self.is_authenticated():
+                return True
+            return await self._do_login()
+
+    async def _do_login(self):
+        try:
+            session = self._ensure_session()
+            self.logged_in_at = None
+            self.cookie_jar.clear()
+
             auth_data = {
                 "username": config.XUI_USERNAME,
                 "password": config.XUI_PASSWORD
@@ -54,7 +349,7 @@ class XUIAPI:
             
             logger.info(f"ℹ️  Trying login to {login_url} with user: {config.XUI_USERNAME}")
             
-            async with self.session.post(login_url, data=auth_data) as resp:
+            async with session.post(login_url, data=auth_data) as resp:
                 if resp.status != 200:
                     logger.error(f"🛑 Login failed with status: {resp.status}")
                     return False
@@ -66,6 +361,7 @@ class XUIAPI:
                         logger.info("✅ Login successful")
                         # Сохраняем куки для последующих запросов
                         self.auth_cookies = self.cookie_jar
+                        self.logged_in_at = time.monotonic()
                         logger.debug(f"⚙️ Auth cookies: {self.auth_cookies}")
                         return True
                     else:
@@ -78,6 +374,7 @@ class XUIAPI:
                         logger.warning("⚠️ Login successful (text response)")
                         # Сохраняем куки для последующих запросов
                         self.auth_cookies = self.cookie_jar
+                        self.logged_in_at = time.monotonic()
                         logger.debug(f"⚙️ Auth cookies: {self.auth_cookies}")
                         return True
                     logger.error(f"🛑 Login failed. Response text: {text[:100]}...")
@@ -86,39 +383,97 @@ class XUIAPI:
             logger.exception(f"🛑 Login error: {e}")
             return False
 
-    async def get_inbound(self, inbound_id: int):
-        """Получение данных инбаунда"""
-        try:
-            url = f"{self.base_url}{self.api_prefix}/inbounds/get/{inbound_id}"
-            
-            logger.info(f"ℹ️  Getting inbound data from: {url}")
-            logger.debug(f"⚙️ Using cookies: {self.cookie_jar}")
-            
-            async with self.session.get(url) as resp:
-                logger.debug(f"⚙️ Response status: {resp.status}")
-                logger.debug(f"⚙️ Response cookies: {resp.cookies}")
-                
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.error(f"🛑 Get inbound failed: status={resp.status}, response={text}...")
-                    return None
-                
+    async def request(self, method: str, path: str, **kwargs):
+        """
+        Выполняет запрос к API панели через общую сессию.
+        При 401/403 или редиректе на страницу логина один раз перелогинивается и повторяет запрос.
+        Возвращает (status, payload), где payload — dict для JSON-ответа или текст.
+        При ошибке авторизации/сети возвращает (None, None).
+        """
+        url = f"{self.base_url}{self.api_prefix}{path}"
+        for attempt in range(2):
+            if not await self.login():
+                return None, None
+            seen_login = self.logged_in_at
+            session = self._ensure_session()
+            async with session.request(method, url, allow_redirects=False, **kwargs) as resp:
+                if resp.status in (301, 302, 303, 307, 308, 401, 403):
+                    logger.warning(f"⚠️ Panel session rejected ({resp.status}), re-login")
+                    # Сбрасываем логин, только если его не обновил параллельный запрос
+                    if self.logged_in_at == seen_login:
+                        self.logged_in_at = None
+                    continue
                 try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        logger.debug(f'⚙️ Data: {str(data)}')
-                        return data.get("obj")
-                    else:
-                        logger.error(f"🛑 Get inbound failed: {data.get('msg')}")
-                        return None
-                except:
-                    text = await resp.text()
-                    logger.error(f"🛑 Get inbound response error: {text[:100]}...")
-                    return None
+                    payload = await resp.json(content_type=None)
+                except Exception:
+                    payload = await resp.text()
+                return resp.status, payload
+        return None, None
+
+    async def _fetch_inbound(self, inbound_id: int):
+        """Загружает инбаунд из панели (без кэша)"""
+        try:
+            logger.info(f"ℹ️  Getting inbound data for: {inbound_id}")
+            status, data = await self.request("GET", f"/inbounds/get/{inbound_id}")
+            logger.debug(f"⚙️ Response status: {status}")
+
+            if status != 200:
+                logger.error(f"🛑 Get inbound failed: status={status}, response={str(data)[:100]}...")
+                return None
+
+            if isinstance(data, dict):
+                if data.get("success"):
+                    return data.get("obj")
+                logger.error(f"🛑 Get inbound failed: {data.get('msg')}")
+                return None
+            logger.error(f"🛑 Get inbound response error: {str(data)[:100]}...")
+            return None
         except Exception as e:
             logger.exception(f"🛑 Get inbound error: {e}")
             return None
 
+    async def get_inbound_snapshot(self, inbound_id: int, force: bool = False):
+        """
+        Возвращает кэшированный снимок инбаунда (InboundSnapshot).
+        Панель запрашивается, только если снимок старше XUI_INBOUND_CACHE_TTL или force=True.
+        Если отпечаток settings не изменился, повторный разбор JSON не выполняется.
+        """
+        cached = self._inbounds.get(inbound_id)
+        if cached and not force and cached.is_fresh():
+            return cached
+
+        inbound = await self._fetch_inbound(inbound_id)
+        if not inbound:
+            return None
+
+        if cached and cached.fingerprint == inbound_fingerprint(inbound):
+            # Клиенты не менялись — обновляем только счётчики и время
+            cached.inbound = inbound
+            cached.fetched_at = time.monotonic()
+            return cached
+
+        version = cached.version + 1 if cached else 1
+        if cached:
+            logger.info(f"ℹ️  Inbound {inbound_id} changed on panel side (v{version})")
+        snapshot = InboundSnapshot(inbound_id, inbound, version=version)
+        self._inbounds[inbound_id] = snapshot
+        return snapshot
+
+    async def get_inbound(self, inbound_id: int, force: bool = False):
+        """Получение данных инбаунда (из кэша, если он свежий)"""
+        snapshot = await self.get_inbound_snapshot(inbound_id, force=force)
+        return snapshot.inbound if snapshot else None
+
+    def cached_inbound_snapshot(self, inbound_id: int):
+        """Последний снимок инбаунда из кэша без обращения к панели (может быть устаревшим)"""
+        return self._inbounds.get(inbound_id)
+
+    def invalidate_inbound(self, inbound_id: int = None):
+        """Сбрасывает кэш инбаунда (или всех инбаундов)"""
+        if inbound_id is None:
+            self._inbounds.clear()
+        else:
+            self._inbounds.pop(inbound_id, None)
 
     async def get_inbound_settings(inbound_id: int = None):
         """
@@ -127,7 +482,7 @@ class XUIAPI:
         """
         if inbound_id is None:
             inbound_id = config.INBOUND_ID
-        api = XUIAPI()
+        api = get_xui_api()
         try:
             inbound = await api.get_inbound(inbound_id)
             if not inbound:
@@ -148,8 +503,6 @@ class XUIAPI:
         except Exception as e:
             logger.exception(f"Error getting inbound settings: {e}")
             return None
-        finally:
-            await api.close()
 
     def generate_vless_url(client_id: str, email: str, host: str, port: int, 
                                     public_key: str, sni: str, short_id: str, fingerprint: str, spider_x: str) -> str:
@@ -163,603 +516,463 @@ class XUIAPI:
             f"#{email}"
         )
 
-    async def update_inbound(self, inbound_id: int, data: dict):
-        """Обновление инбаунда"""
+    async def update_inbound(self, inbound_id: int, data: dict, snapshot: "InboundSnapshot" = None):
+        """
+        Обновление инбаунда.
+        После успешной записи в кэш кладётся snapshot (с уже разобранными settings, из которых
+        собраны data), при ошибке или без snapshot кэш сбрасывается.
+        """
         try:
-            url = f"{self.base_url}{self.api_prefix}/inbounds/update/{inbound_id}"
-            
-            logger.info(f"ℹ️  Updating inbound at: {url}")
-            
-            async with self.session.post(url, json=data) as resp:
-                if resp.status != 200:
-                    logger.error(f"🛑 Update inbound failed with status: {resp.status}")
-                    return False
-                
-                try:
-                    response = await resp.json()
-                    return response.get("success", False)
-                except:
-                    text = await resp.text()
-                    return "success" in text.lower()
+            logger.info(f"ℹ️  Updating inbound: {inbound_id}")
+            status, response = await self.request("POST", f"/inbounds/update/{inbound_id}", json=data)
+            if status != 200:
+                logger.error(f"🛑 Update inbound failed with status: {status}")
+                success = False
+            elif isinstance(response, dict):
+                success = response.get("success", False)
+            else:
+                success = "success" in str(response).lower()
         except Exception as e:
             logger.exception(f"🛑 Update inbound error: {e}")
+            success = False
+
+        if success and snapshot is not None:
+            snapshot.inbound = {**snapshot.inbound, **data}
+            snapshot.fingerprint = inbound_fingerprint(snapshot.inbound)
+            self.commit_snapshot(snapshot)
+        else:
+            self.invalidate_inbound(inbound_id)
+        return success
+
+    def commit_snapshot(self, snapshot: "InboundSnapshot"):
+        """
+        Кладёт в кэш копию снимка с записанными в панель изменениями. Если кэш за время
+        записи заменили (перечитали панель), копия могла устареть — кэш сбрасывается
+        """
+        inbound_id = snapshot.inbound_id
+        parent = snapshot.parent
+        if parent is not None and self._inbounds.get(inbound_id) is not parent:
+            self.invalidate_inbound(inbound_id)
+            return
+        snapshot.parent = None
+        snapshot.version = (parent.version if parent else snapshot.version) + 1
+        self._inbounds[inbound_id] = snapshot
+
+    def inbound_lock(self, inbound_id: int) -> asyncio.Lock:
+        """Блокировка чтения-изменения-записи одного инбаунда внутри процесса"""
+        lock = self._inbound_locks.get(inbound_id)
+        if lock is None:
+            lock = self._inbound_locks[inbound_id] = asyncio.Lock()
+        return lock
+
+    async def save_inbound(self, snapshot: "InboundSnapshot"):
+        """
+        Записывает изменённые settings снимка в панель целиком.
+        Перед записью перечитывает инбаунд: если список клиентов в панели изменился
+        с момента снятия снимка, кэш заменяется свежими данными и возвращается None
+        (вызывающий должен заново применить свои изменения). Иначе — True/False.
+        """
+        inbound_id = snapshot.inbound_id
+        current = await self._fetch_inbound(inbound_id)
+        if not current:
+            self.invalidate_inbound(inbound_id)
             return False
 
-    async def create_vless_profile(self, telegram_id: int, subscription_days: int = 0, client_ip: str = None):
-        """Создание нового клиента для пользователя (expiryTime всегда 0)"""
-        if not await self.login():
-            logger.error("🛑 Login failed before creating profile")
+        if inbound_fingerprint(current) != snapshot.fingerprint:
+            self._inbounds[inbound_id] = InboundSnapshot(inbound_id, current, version=snapshot.version + 1)
             return None
 
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error(f"🛑 Inbound {config.INBOUND_ID} not found")
-            return None
+        # Счётчики трафика и прочие поля берём свежие, чтобы не затереть их старыми
+        data = build_inbound_update(current, snapshot.settings)
+        return await self.update_inbound(inbound_id, data, snapshot=snapshot)
 
+    async def _send_client_change(self, inbound_id: int, op: str, client: dict):
+        """
+        Отправляет изменение одного клиента через addClient/updateClient/delClient.
+        Возвращает True/False, или None, если панель не поддерживает эти методы.
+        """
+        if op == "delete":
+            path = f"/inbounds/{inbound_id}/delClient/{client['id']}"
+            kwargs = {}
+        else:
+            path = "/inbounds/addClient" if op == "add" else f"/inbounds/updateClient/{client['id']}"
+            kwargs = {"json": {
+                "id": inbound_id,
+                "settings": json.dumps({"clients": [client]}, separators=(",", ":"), ensure_ascii=False)
+            }}
         try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-
-            client_id = str(uuid.uuid4())
-            email = f"user_{telegram_id}"
-
-            # Генерация IP, если не передан
-            if client_ip is None:
-                last_octet = (telegram_id % 253) + 2
-                client_ip = f"10.0.0.{last_octet}"
-            sub_id = secrets.token_hex(16)  # 32 символа hex
-            new_client = {
-                "id": client_id,
-                "flow": "",
-                "email": email,
-                "subId": sub_id,
-                "limitIp": 5,
-                "totalGB": 0,
-                "expiryTime": 0,
-                "enable": True,
-                "tgId": f"{telegram_id}",
-                "subId": "",
-                "reset": 0,
-                "fingerprint": config.REALITY_FINGERPRINT,
-                "publicKey": config.REALITY_PUBLIC_KEY,
-                "shortId": config.REALITY_SHORT_ID,
-                "spiderX": config.REALITY_SPIDER_X,
-                "ip": client_ip  # обязательно для 3X-UI
-            }
+            status, response = await self.request("POST", path, **kwargs)
+            if status in (404, 405):
+                # Новые панели отвечают 404 и на запросы с истёкшей сессией — перелогиниваемся и пробуем ещё раз
+                logger.warning(f"⚠️ Client {op} returned {status}, re-login and retry")
+                await self.login(force=True)
+                status, response = await self.request("POST", path, **kwargs)
+        except Exception as e:
+            logger.exception(f"🛑 Client {op} error: {e}")
+            return False
+        if status in (404, 405):
+            return None
+        if status != 200:
+            logger.error(f"🛑 Client {op} failed with status: {status}")
+            return False
+        if isinstance(response, dict):
+            if not response.get("success", False):
+                logger.error(f"🛑 Client {op} failed: {response.get('msg')}")
+                return False
+            return True
+        return "success" in str(response).lower()
 
-            clients.append(new_client)
-            settings["clients"] = clients
+    def client_api_usable(self) -> bool:
+        """Пробовать ли поклиентные методы: отказ от них пересматривается через XUI_CLIENT_API_RECHECK"""
+        if self.client_api_supported is not False:
+            return True
+        if time.monotonic() - self.client_api_checked_at >= config.XUI_CLIENT_API_RECHECK:
+            self.client_api_supported = None
+            return True
+        return False
 
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
+    async def _write_per_client(self, snapshot: "InboundSnapshot", changes: list):
+        """
+        Отправляет изменения пакета поклиентно; возвращает успех для каждого вызывающего.
+        None — панель не знает этих методов: решается только по первому изменению пакета,
+        пока в панель ничего не отправлено, чтобы пакет можно было целиком записать
+        через инбаунд. Отказ на середине пакета считается ошибкой записи этого изменения.
+        """
+        results = []
+        sent_any = False
+        for caller_changes in changes:
+            ok = True
+            for op, client in caller_changes:
+                sent = await self._send_client_change(snapshot.inbound_id, op, client)
+                if sent is None:
+                    if not sent_any:
+                        logger.warning("⚠️ Panel has no per-client API, falling back to full inbound updates")
+                        self.client_api_supported = False
+                        self.client_api_checked_at = time.monotonic()
+                        return None
+                    logger.error(f"🛑 Client {op} rejected by panel mid-batch")
+                    sent = False
+                sent_any = True
+                ok = ok and sent
+            results.append(ok)
+
+        self.client_api_supported = True
+        if not all(results):
+            # Часть изменений не дошла до панели — снимок больше не совпадает с ней
+            self.invalidate_inbound(snapshot.inbound_id)
+        else:
+            # Копия совпадает с панелью: settings и отпечаток — по новому списку клиентов
+            snapshot.sync_settings()
+            self.commit_snapshot(snapshot)
+        return results
+
+    async def write_client_changes(self, snapshot: "InboundSnapshot", changes: list) -> list:
+        """
+        Записывает изменения клиентов, уже применённые к снимку.
+        changes — списки [(op, client)] для каждого вызывающего; возвращает успех для каждого.
+        Небольшие пакеты уходят поклиентно, большие (и старые панели без этих методов) —
+        одной записью всего инбаунда. None — конфликт с изменениями в панели (см. save_inbound).
+        """
+        total = sum(len(c) for c in changes)
+        if self.client_api_usable() and total <= config.XUI_CLIENT_API_MAX_BATCH:
+            results = await self._write_per_client(snapshot, changes)
+            if results is not None:
+                return results
+
+        # Снимок уже содержит все изменения; в панель поклиентно не ушло ни одно из них
+        saved = await self.save_inbound(snapshot)
+        if saved is None:
+            return None
+        return [saved] * len(changes)
+
+    async def mutate_inbound(self, mutation, failed=False, inbound_id: int = None):
+        """
+        Ставит изменение клиентов в очередь пакетной записи инбаунда.
+        mutation(snapshot) меняет снимок и возвращает результат для вызывающего
+        (пустой результат — изменений нет). Возвращает результат после записи или failed.
+        """
+        if inbound_id is None:
+            inbound_id = config.INBOUND_ID
+        batcher = self._batchers.get(inbound_id)
+        if batcher is None:
+            batcher = self._batchers[inbound_id] = InboundWriteBatcher(self, inbound_id)
+        return await batcher.submit(mutation, failed)
+
+    async def create_vless_profile(self, telegram_id: int, subscription_days: int = 0, client_ip: str = None):
+        """Создание нового клиента для пользователя (expiryTime всегда 0)"""
+        client_id = str(uuid.uuid4())
+        email = f"user_{telegram_id}"
+
+        # Генерация IP, если не передан
+        if client_ip is None:
+            last_octet = (telegram_id % 253) + 2
+            client_ip = f"10.0.0.{last_octet}"
+        sub_id = secrets.token_hex(16)  # 32 символа hex
+        new_client = {
+            "id": client_id,
+            "flow": "",
+            "email": email,
+            "subId": sub_id,
+            "limitIp": 5,
+            "totalGB": 0,
+            "expiryTime": 0,
+            "enable": True,
+            "tgId": f"{telegram_id}",
+            "subId": "",
+            "reset": 0,
+            "fingerprint": config.REALITY_FINGERPRINT,
+            "publicKey": config.REALITY_PUBLIC_KEY,
+            "shortId": config.REALITY_SHORT_ID,
+            "spiderX": config.REALITY_SPIDER_X,
+            "ip": client_ip  # обязательно для 3X-UI
+        }
+
+        def add(snapshot):
+            # Дубликат email панель отклонит вместе со всем пакетом
+            if snapshot.find_client(email) is not None:
+                logger.error(f"🛑 Create profile error: client {email} already exists")
+                return None
+            snapshot.add_client(new_client)
+            inbound = snapshot.inbound
+            return {
+                "client_id": client_id,
+                "email": email,
                 "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
+                "security": "reality",
+                "remark": inbound["remark"],
+                "sni": config.REALITY_SNI,
+                "pbk": config.REALITY_PUBLIC_KEY,
+                "fp": config.REALITY_FINGERPRINT,
+                "sid": config.REALITY_SHORT_ID,
+                "spx": config.REALITY_SPIDER_X,
+                "subId": sub_id,
+                "client_ip": client_ip
             }
 
-            if await self.update_inbound(config.INBOUND_ID, update_data):
-                return {
-                    "client_id": client_id,
-                    "email": email,
-                    "port": inbound["port"],
-                    "security": "reality",
-                    "remark": inbound["remark"],
-                    "sni": config.REALITY_SNI,
-                    "pbk": config.REALITY_PUBLIC_KEY,
-                    "fp": config.REALITY_FINGERPRINT,
-                    "sid": config.REALITY_SHORT_ID,
-                    "spx": config.REALITY_SPIDER_X,
-                    "subId": sub_id,
-                    "client_ip": client_ip
-                }
-            return None
-        except Exception as e:
-            logger.exception(f"🛑 Create profile error: {e}")
-            return None
+        return await self.mutate_inbound(add, failed=None)
 
     async def create_static_client(self, profile_name: str):
         """Создание статического клиента"""
-        if not await self.login():
-            logger.error("🛑 Login failed before creating static client")
-            return None
+        client_id = str(uuid.uuid4())
         
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error(f"🛑 Inbound {config.INBOUND_ID} not found")
-            return None
-        
-        try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            client_id = str(uuid.uuid4())
-            
-            # Обновленные настройки для Reality
-            new_client = {
-                "id": client_id,
-                "flow": "",
+        # Обновленные настройки для Reality
+        new_client = {
+            "id": client_id,
+            "flow": "",
+            "email": profile_name,
+            "limitIp": 0,
+            "totalGB": 0,
+            "expiryTime": 0,
+            "enable": True,
+            "tgId": "",
+            "subId": "",
+            "reset": 0,
+            # Добавляем настройки для Reality
+            "fingerprint": config.REALITY_FINGERPRINT,
+            "publicKey": config.REALITY_PUBLIC_KEY,
+            "shortId": config.REALITY_SHORT_ID,
+            "spiderX": config.REALITY_SPIDER_X
+        }
+
+        def add(snapshot):
+            if snapshot.find_client(profile_name) is not None:
+                logger.error(f"🛑 Create static client error: client {profile_name} already exists")
+                return None
+            snapshot.add_client(new_client)
+            inbound = snapshot.inbound
+            return {
+                "client_id": client_id,
                 "email": profile_name,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": 0,
-                "enable": True,
-                "tgId": "",
-                "subId": "",
-                "reset": 0,
-                # Добавляем настройки для Reality
-                "fingerprint": config.REALITY_FINGERPRINT,
-                "publicKey": config.REALITY_PUBLIC_KEY,
-                "shortId": config.REALITY_SHORT_ID,
-                "spiderX": config.REALITY_SPIDER_X
-            }
-            
-            clients.append(new_client)
-            settings["clients"] = clients
-            
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
                 "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-                # "allocate": inbound["allocate"]
+                # Указываем тип безопасности как reality
+                "security": "reality",
+                "remark": inbound["remark"],
+                # Добавляем необходимые параметры для Reality
+                "sni": config.REALITY_SNI,
+                "pbk": config.REALITY_PUBLIC_KEY,
+                "fp": config.REALITY_FINGERPRINT,
+                "sid": config.REALITY_SHORT_ID,
+                "spx": config.REALITY_SPIDER_X
             }
-            
-            if await self.update_inbound(config.INBOUND_ID, update_data):
-                return {
-                    "client_id": client_id,
-                    "email": profile_name,
-                    "port": inbound["port"],
-                    # Указываем тип безопасности как reality
-                    "security": "reality",
-                    "remark": inbound["remark"],
-                    # Добавляем необходимые параметры для Reality
-                    "sni": config.REALITY_SNI,
-                    "pbk": config.REALITY_PUBLIC_KEY,
-                    "fp": config.REALITY_FINGERPRINT,
-                    "sid": config.REALITY_SHORT_ID,
-                    "spx": config.REALITY_SPIDER_X
-                }
-            return None
-        except Exception as e:
-            logger.exception(f"🛑 Create static client error: {e}")
-            return None
+
+        return await self.mutate_inbound(add, failed=None)
 
     async def delete_client(self, email: str):
         """Удаление клиента по email"""
-        if not await self.login():
-            return False
-        
-        try:
-            # Получаем данные инбаунда
-            inbound = await self.get_inbound(config.INBOUND_ID)
-            if not inbound:
-                return False
-            
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            # Фильтруем клиентов
-            new_clients = [c for c in clients if c["email"] != email]
-            
-            # Если не было изменений
-            if len(new_clients) == len(clients):
-                return False
-            
-            settings["clients"] = new_clients
-            
-            # Формируем данные для обновления
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"]
-            }
-            
-            return await self.update_inbound(config.INBOUND_ID, update_data)
-        except Exception as e:
-            logger.exception(f"🛑 Delete client error: {e}")
-            return False
+        # Если клиента нет, изменений не будет
+        return await self.mutate_inbound(lambda snapshot: snapshot.remove_client(email) is not None)
     
     async def get_user_stats(self, email: str):
         """Получение статистики и subId по email (с проверкой в settings)"""
-        if not await self.login():
-            return {"upload": 0, "download": 0, "subId": None}
         try:
-            url = f"{self.base_url}{self.api_prefix}/inbounds/getClientTraffics/{email}"
-            async with self.session.get(url) as resp:
-                if resp.status != 200:
-                    return {"upload": 0, "download": 0, "subId": None}
-                data = await resp.json()
-                if data.get("success"):
-                    client_data = data.get("obj")
-                    if isinstance(client_data, dict):
-                        sub_id = client_data.get("subId")
-                        # Если subId нет в статистике, пытаемся получить из настроек инбаунда
-                        if not sub_id:
-                            inbound = await self.get_inbound(config.INBOUND_ID)
-                            if inbound:
-                                settings = json.loads(inbound["settings"])
-                                for cl in settings.get("clients", []):
-                                    if cl.get("email") == email:
-                                        sub_id = cl.get("subId", "")
-                                        break
-                        return {
-                            "upload": client_data.get("up", 0),
-                            "download": client_data.get("down", 0),
-                            "subId": sub_id
-                        }
+            status, data = await self.request("GET", f"/inbounds/getClientTraffics/{email}")
+            if status != 200 or not isinstance(data, dict):
+                return {"upload": 0, "download": 0, "subId": None}
+            if data.get("success"):
+                client_data = data.get("obj")
+                if isinstance(client_data, dict):
+                    sub_id = client_data.get("subId")
+                    # Если subId нет в статистике, берём его из кэшированных настроек инбаунда
+                    if not sub_id:
+                        snapshot = await self.get_inbound_snapshot(config.INBOUND_ID)
+                        client = snapshot.find_client(email) if snapshot else None
+                        if client:
+                            sub_id = client.get("subId", "")
+                    return {
+                        "upload": client_data.get("up", 0),
+                        "download": client_data.get("down", 0),
+                        "subId": sub_id
+                    }
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
         return {"upload": 0, "download": 0, "subId": None}
     
+    async def find_client_by_sub_id(self, sub_id: str):
+        """Находит клиента панели по subId (токену подписки) через индекс снимка"""
+        snapshot = await self.get_inbound_snapshot(config.INBOUND_ID)
+        return snapshot.find_client_by_sub_id(sub_id) if snapshot else None
+
     async def get_global_stats(self, inbound_id: int):
         """Получение статистики инбаунда"""
-        if not await self.login():
-            logger.error("🛑 Login failed before getting stats")
-            return {"upload": 0, "download": 0}
-        
         try:
-            url = f"{self.base_url}{self.api_prefix}/inbounds/get/{inbound_id}"
-            
-            async with self.session.get(url) as resp:
-                if resp.status != 200:
-                    return {"upload": 0, "download": 0}
-                
-                try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        client_data = data.get("obj")
-                        if isinstance(client_data, dict):
-                            return {
-                                "upload": client_data.get("up", 0),
-                                "download": client_data.get("down", 0)
-                            }
-                except:
-                    return {"upload": 0, "download": 0}
+            inbound = await self.get_inbound(inbound_id)
+            if isinstance(inbound, dict):
+                return {
+                    "upload": inbound.get("up", 0),
+                    "download": inbound.get("down", 0)
+                }
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
         return {"upload": 0, "download": 0}
 
     async def get_online_users(self):
         """Получение количества онлайн пользователей"""
-        if not await self.login():
-            logger.error("🛑 Login failed before getting online users")
-            return 0
-        
         try:
-            url = f"{self.base_url}{self.api_prefix}/inbounds/onlines"
-            
-            async with self.session.post(url) as resp:
-                if resp.status != 200:
-                    return 0
-                
-                try:
-                    data = await resp.json()
-                    logger.debug(data)
-                    online = 0
-                    if data.get("success"):
-                        users = data.get("obj")
-                        if isinstance(users, list):
-                            for user in users:
-                                if str(user).startswith("user_"):
-                                    online += 1
-                        return online
-                except:
-                    return 0
+            status, data = await self.request("POST", "/inbounds/onlines")
+            if status != 200 or not isinstance(data, dict):
+                return 0
+            logger.debug(data)
+            online = 0
+            if data.get("success"):
+                users = data.get("obj")
+                if isinstance(users, list):
+                    for user in users:
+                        if str(user).startswith("user_"):
+                            online += 1
+            return online
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
             return 0
 
-    async def update_client_expiry(self, email: str, expiry_timestamp_ms: int) -> bool:
-        if not await self.login():
-            logger.error("🛑 update_client_expiry: login failed")
-            return False
-
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error("🛑 update_client_expiry: inbound not found")
-            return False
-
-        try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-
-            updated = False
-            for client in clients:
-                if client.get("email") == email:
-                    client["enable"] = True   # включаем клиента
-                    client["flow"] = client.get("flow", "")
-                    logger.info(f"📧 update_client_expiry: {email}")
-                    updated = True
-                    break
-
-            if not updated:
-                logger.warning(f"⚠️ update_client_expiry: client {email} not found")
+    async def _update_client(self, email: str, changes: dict, action: str) -> bool:
+        """Меняет поля клиента с данным email через пакетную запись инбаунда"""
+        def update(snapshot):
+            client = snapshot.update_client(email, changes)
+            if client is None:
+                logger.warning(f"⚠️ {action}: client {email} not found")
                 return False
+            # Меняем flow для принудительного обновления UI
+            client["flow"] = client.get("flow", "")
+            logger.info(f"📧 {action}: {email}")
+            return True
 
-            settings["clients"] = clients
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-            }
+        return await self.mutate_inbound(update)
 
-            return await self.update_inbound(config.INBOUND_ID, update_data)
-        except Exception as e:
-            logger.exception(f"🛑 update_client_expiry error: {e}")
-            return False
+    async def update_client_expiry(self, email: str, expiry_timestamp_ms: int) -> bool:
+        # expiryTime у клиентов всегда 0, срок контролирует бот — клиент просто включается
+        return await self._update_client(email, {"enable": True}, "update_client_expiry")
 
     async def update_client_subid(self, email: str, new_subid: str) -> bool:
         """Обновляет subId у клиента в inbound"""
-        if not await self.login():
-            return False
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            return False
-        try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            updated = False
-            for client in clients:
-                if client.get("email") == email:
-                    client["subId"] = new_subid
-                    updated = True
-                    break
-            if not updated:
-                return False
-            settings["clients"] = clients
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-            }
-            return await self.update_inbound(config.INBOUND_ID, update_data)
-        except Exception as e:
-            logger.exception(f"🛑 update_client_subid error: {e}")
-            return False
+        return await self._update_client(email, {"subId": new_subid}, "update_client_subid")
 
     async def disable_client_by_email(self, email: str) -> bool:
         """
         Отключает клиента по email (enable = false), не удаляя его.
         Возвращает True при успехе, False при ошибке.
         """
-        if not await self.login():
-            logger.error("🛑 disable_client_by_email: login failed")
-            return False
-
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error("🛑 disable_client_by_email: inbound not found")
-            return False
-
-        try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-
-            updated = False
-            for client in clients:
-                if client.get("email") == email:
-                    client["enable"] = False
-                    # Меняем flow для принудительного обновления UI
-                    client["flow"] = client.get("flow", "")
-                    logger.info(f"📧 disable_client_by_email: {email} disabled")
-                    updated = True
-                    break
-
-            if not updated:
-                logger.warning(f"⚠️ disable_client_by_email: client {email} not found")
-                return False
-
-            settings["clients"] = clients
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-            }
-
-            return await self.update_inbound(config.INBOUND_ID, update_data)
-        except Exception as e:
-            logger.exception(f"🛑 disable_client_by_email error: {e}")
-            return False
+        return await self._update_client(email, {"enable": False}, "disable_client_by_email")
 
     async def enable_client(self, email: str) -> bool:
         """Включает клиента по email (enable = true)"""
-        if not await self.login():
-            logger.error("🛑 enable_client: login failed")
-            return False
-
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error("🛑 enable_client: inbound not found")
-            return False
+        return await self._update_client(email, {"enable": True}, "enable_client")
 
-        try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-
-            updated = False
-            for client in clients:
-                if client.get("email") == email:
-                    client["enable"] = True
+    async def set_clients_enabled(self, emails: list, enabled: bool) -> dict:
+        """
+        Включает/отключает сразу несколько клиентов одним изменением инбаунда.
+        Возвращает {email: успех} для каждого переданного email.
+        """
+        def update(snapshot):
+            found = {}
+            for email in emails:
+                client = snapshot.update_client(email, {"enable": enabled})
+                found[email] = client is not None
+                if client is None:
+                    logger.warning(f"⚠️ set_clients_enabled: client {email} not found")
+                else:
                     client["flow"] = client.get("flow", "")
-                    logger.info(f"📧 enable_client: {email} enabled")
-                    updated = True
-                    break
-
-            if not updated:
-                logger.warning(f"⚠️ enable_client: client {email} not found")
-                return False
-
-            settings["clients"] = clients
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-            }
+            return found if any(found.values()) else None
 
-            return await self.update_inbound(config.INBOUND_ID, update_data)
-        except Exception as e:
-            logger.exception(f"🛑 enable_client error: {e}")
-            return False
+        result = await self.mutate_inbound(update, failed=None)
+        if result is None:
+            return {email: False for email in emails}
+        logger.info(f"📧 set_clients_enabled({enabled}): {sum(result.values())}/{len(emails)} clients")
+        return result
 
     async def close(self):
-        """Закрывает сессию aiohttp"""
+        """Дописывает отложенные изменения и закрывает сессию aiohttp"""
+        for batcher in list(self._batchers.values()):
+            await batcher.flush()
         if self.session:
             await self.session.close()
+        self.session = None
+        self.logged_in_at = None
 
-async def update_client_subid(self, email: str, new_subid: str) -> bool:
-    """Обновляет subId у клиента в inbound"""
-    if not await self.login():
-        return False
-    inbound = await self.get_inbound(config.INBOUND_ID)
-    if not inbound:
-        return False
-    try:
-        settings = json.loads(inbound["settings"])
-        clients = settings.get("clients", [])
-        updated = False
-        for client in clients:
-            if client.get("email") == email:
-                client["subId"] = new_subid
-                updated = True
-                break
-        if not updated:
-            return False
-        settings["clients"] = clients
-        update_data = {
-            "up": inbound["up"],
-            "down": inbound["down"],
-            "total": inbound["total"],
-            "remark": inbound["remark"],
-            "enable": inbound["enable"],
-            "expiryTime": inbound["expiryTime"],
-            "listen": inbound["listen"],
-            "port": inbound["port"],
-            "protocol": inbound["protocol"],
-            "settings": json.dumps(settings, indent=2),
-            "streamSettings": inbound["streamSettings"],
-            "sniffing": inbound["sniffing"],
-        }
-        return await self.update_inbound(config.INBOUND_ID, update_data)
-    except Exception as e:
-        logger.exception(f"🛑 update_client_subid error: {e}")
-        return False
+
+_xui_api = None
+
+
+def get_xui_api() -> XUIAPI:
+    """Возвращает общий для процесса клиент панели (одна сессия и пул соединений)"""
+    global _xui_api
+    if _xui_api is None:
+        _xui_api = XUIAPI()
+    return _xui_api
+
+
+async def close_xui_api():
+    """Закрывает общий клиент панели при остановке бота"""
+    global _xui_api
+    if _xui_api is not None:
+        await _xui_api.close()
+        _xui_api = None
 
 async def create_vless_profile(telegram_id: int, subscription_days: int = 0):
-    api = XUIAPI()
-    try:
-        return await api.create_vless_profile(telegram_id, subscription_days)
-    finally:
-        await api.close()
+    return await get_xui_api().create_vless_profile(telegram_id, subscription_days)
 
 async def create_static_client(profile_name: str):
-    api = XUIAPI()
-    try:
-        return await api.create_static_client(profile_name)
-    finally:
-        await api.close()
+    return await get_xui_api().create_static_client(profile_name)
 
 async def delete_client_by_email(email: str):
-    api = XUIAPI()
-    try:
-        return await api.delete_client(email)
-    finally:
-        await api.close()
+    return await get_xui_api().delete_client(email)
 
 async def disable_client_by_email(email: str):
-    api = XUIAPI()
-    try:
-        return await api.disable_client_by_email(email)
-    finally:
-        await api.close()
+    return await get_xui_api().disable_client_by_email(email)
+
+async def disable_clients_by_email(emails: list) -> dict:
+    return await get_xui_api().set_clients_enabled(emails, False)
 
 async def get_global_stats():
-    api = XUIAPI()
-    try:
-        return await api.get_global_stats(config.INBOUND_ID)
-    finally:
-        await api.close()
+    return await get_xui_api().get_global_stats(config.INBOUND_ID)
 
 async def enable_client_by_email(email: str) -> bool:
-    api = XUIAPI()
-    try:
-        return await api.enable_client(email)
-    finally:
-        await api.close()
+    return await get_xui_api().enable_client(email)
 
 async def get_online_users():
-    api = XUIAPI()
-    try:
-        return await api.get_online_users()
-    finally:
-        await api.close()
+    return await get_xui_api().get_online_users()
 
 async def get_user_stats(email: str):
-    api = XUIAPI()
-    try:
-        return await api.get_user_stats(email)
-    finally:
-        await api.close()
+    return await get_xui_api().get_user_stats(email)
 
 def generate_vless_url1(profile_data: dict) -> str:
     remark = profile_data.get('remark', '')
@@ -793,6 +1006,21 @@ def generate_vless_url(profile_data: dict) -> str:
         f"#{fragment}"
     )
 
+async def get_vless_url(client_id: str, email: str) -> str:
+    """
+    VLESS-ссылка по колонкам профиля пользователя: порт и remark берутся
+    из кэшированного снимка инбаунда (при недоступной панели — из последнего снимка)
+    """
+    api = get_xui_api()
+    snapshot = await api.get_inbound_snapshot(config.INBOUND_ID) or api.cached_inbound_snapshot(config.INBOUND_ID)
+    inbound = snapshot.inbound if snapshot else {}
+    return generate_vless_url({
+        "client_id": client_id,
+        "email": email,
+        "port": inbound.get("port", 443),
+        "remark": inbound.get("remark", ""),
+    })
+
 async def apply_tc_limit(ip: str):
     """Применяет ограничение скорости для IP через tc (30 Мбит/с)"""
     try:
@@ -14,15 +14,17 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardMarkup, InlineKeyboardButton
 from config import config
 from database import (
-    StaticProfile, get_user, create_user, update_subscription,
-    get_all_users, create_static_profile, get_static_profiles,
-    User, Session, get_user_stats as db_user_stats
+    get_user, create_user, update_user, update_subscription, shift_subscription,
+    get_users_page, count_users, search_users, create_static_profile, get_static_profiles,
+    get_static_profile, delete_static_profile,
+    get_user_stats as db_user_stats, get_broadcast_jobs, db_writer,
+    get_user_by_client_email, assign_profile, flush_user, user_cache, User
 )
 from functions import (
     create_vless_profile,
     delete_client_by_email,
     generate_vless_url,
-    get_user_stats,
+    get_vless_url,
     create_static_client,
     get_global_stats,
     get_online_users,
@@ -31,12 +33,19 @@ from functions import (
     apply_tc_limit,
     remove_tc_limit,
     safe_json_loads,
-    XUIAPI
+    get_xui_api
 )
+from traffic import get_user_stats, get_daily_usage, get_top_traffic, traffic_store
+from expiry import expiry_scheduler
+from counters import get_today_counters
+from middlewares import user_context, is_admin_id
+from sender import Priority, send_priority, send_scheduler
+from broadcast import start_broadcast, resume_broadcast, stop_broadcast, active_broadcasts
 from promo import (
     create_promo_code,
     activate_promo_code,
-    get_all_promocodes_with_stats,
+    get_promocodes_page,
+    get_promo_activations,
     get_promo_by_code,
     list_promocodes
 )
@@ -65,10 +74,29 @@ class AdminStates(StatesGroup):
     ADD_TIME_AMOUNT = State()
     REMOVE_TIME_AMOUNT = State()
     SEND_MESSAGE_TARGET = State()
+    SEARCH_USER = State()
 
 class PromoStates(StatesGroup):
     waiting_for_code = State()
 
+def format_bytes(size: int) -> str:
+    """Человекочитаемый размер: 12.34 MB / 1.23 GB"""
+    mb = size / 1024 / 1024
+    if mb < 1024:
+        return f"{mb:.2f} MB"
+    return f"{mb / 1024:.2f} GB"
+
+
+def usage_chart(usage: list, width: int = 12) -> str:
+    """Текстовый график трафика по дням: [(date, bytes)] -> строки с полосами"""
+    peak = max((value for _, value in usage), default=0)
+    lines = []
+    for day, value in usage:
+        bar = "▇" * round(width * value / peak) if peak else ""
+        lines.append(f"{day.strftime('%d.%m')} {bar or '▁'} {format_bytes(value)}")
+    return "\n".join(lines)
+
+
 def split_text(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     """Разбивает текст на части указанной максимальной длины"""
     if len(text) <= max_length:
@@ -88,9 +116,13 @@ def split_text(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     return parts
 
 
-async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
-    """Функция для отображения меню (может как редактировать существующее сообщение, так и отправлять новое)"""
-    user = await get_user(chat_id)
+async def show_menu(bot: Bot, chat_id: int, message_id: int = None, user: User = None):
+    """
+    Функция для отображения меню (может как редактировать существующее сообщение, так и отправлять новое).
+    Обработчики передают пользователя из контекста апдейта, иначе он загружается по chat_id
+    """
+    if user is None:
+        user = await get_user(chat_id)
     if not user:
         return
 
@@ -115,7 +147,7 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
     builder.button(text="ℹ️ Помощь", callback_data="help")
     builder.button(text="🎫 Активировать промокод", callback_data="activate_promo")
 
-    if user.is_admin:
+    if is_admin_id(user.telegram_id):
         builder.button(text="⚠️ Админ. меню", callback_data="admin_menu")
 
     builder.adjust(2, 2, 1, 1, 1)
@@ -140,7 +172,7 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
 
 
 @router.message(Command("start"))
-async def start_cmd(message: Message, bot: Bot):
+async def start_cmd(message: Message, bot: Bot, user: User = None):
     logger.info(f"ℹ️  Start command from {message.from_user.id}")
 
     # Разбираем реферальный параметр, если он есть (/start ref_12345)
@@ -152,23 +184,19 @@ async def start_cmd(message: Message, bot: Bot):
         except ValueError:
             referrer_id = None
 
-    user = await get_user(message.from_user.id)
-
-    # Обновляем данные пользователя если они изменились
-    update_data = {}
+    # Обновляем данные пользователя если они изменились (запишет middleware после обработки)
     is_new_user = False
     if user:
         if user.full_name != message.from_user.full_name:
-            update_data["full_name"] = message.from_user.full_name
+            user.full_name = message.from_user.full_name
         if user.username != message.from_user.username:
-            update_data["username"] = message.from_user.username
+            user.username = message.from_user.username
     else:
-        is_admin = message.from_user.id in config.ADMINS
         user = await create_user(
             telegram_id=message.from_user.id,
             full_name=message.from_user.full_name,
             username=message.from_user.username,
-            is_admin=is_admin
+            is_admin=is_admin_id(message.from_user.id)
         )
         is_new_user = True
         await message.answer(
@@ -193,33 +221,29 @@ async def start_cmd(message: Message, bot: Bot):
                     parse_mode="Markdown"
                 )
                 try:
-                    await bot.send_message(
-                        referrer_id,
-                        f"🎉 По вашей реферальной ссылке зарегистрировался новый пользователь "
-                        f"`{user.full_name}` (`{user.telegram_id}`).\n"
-                        f"Вам начислен **1 {suffix}** VPN.",
-                        parse_mode="Markdown"
-                    )
+                    with send_priority(Priority.NOTIFICATION):
+                        await bot.send_message(
+                            referrer_id,
+                            f"🎉 По вашей реферальной ссылке зарегистрировался новый пользователь "
+                            f"`{user.full_name}` (`{user.telegram_id}`).\n"
+                            f"Вам начислен **1 {suffix}** VPN.",
+                            parse_mode="Markdown"
+                        )
                 except Exception as e:
                     logger.error(
                         f"🛑 Failed to notify referrer {referrer_id}: {e}")
 
-    # Обновляем данные если есть изменения
-    if update_data:
-        with Session() as session:
-            db_user = session.query(User).get(user.id)
-            for key, value in update_data.items():
-                setattr(db_user, key, value)
-            session.commit()
-            logger.info(f"🔄 Updated user data: {message.from_user.id}")
+        # Новый пробный период (и реферальные бонусы) сдвигают ближайшие сроки
+        expiry_scheduler.rearm()
+        # Реферальный бонус изменил подписку в БД — меню покажет свежие данные
+        user = None
 
-    await show_menu(bot, message.from_user.id)
+    await show_menu(bot, message.from_user.id, user=user)
 
 
 @router.message(Command("ref"))
-async def referral_cmd(message: Message, bot: Bot):
+async def referral_cmd(message: Message, bot: Bot, user: User = None):
     """Отправляет пользователю его реферальную ссылку"""
-    user = await get_user(message.from_user.id)
     if not user:
         # Если пользователя нет в БД, проводим через стандартный /start
         await start_cmd(message, bot)
@@ -237,42 +261,49 @@ async def referral_cmd(message: Message, bot: Bot):
     await message.answer(text, parse_mode="Markdown")
 
 @router.callback_query(F.data == "admin_promo_stats")
-async def admin_promo_stats_list(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    if not user or not user.is_admin:
+@router.callback_query(F.data.startswith("promo_stats_page_"))
+async def admin_promo_stats_list(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
         await callback.answer("⛔ Доступ запрещён")
         return
 
     await callback.answer()
-    promos = await get_all_promocodes_with_stats()
-    if not promos:
+    page = int(callback.data.rsplit("_", 1)[1]) if callback.data.startswith("promo_stats_page_") else 0
+    page_size = config.ADMIN_PROMOS_PAGE_SIZE
+    promos, total = await get_promocodes_page(page, page_size)
+    if not total:
         text = "📭 Промокоды ещё не созданы."
         builder = InlineKeyboardBuilder()
         builder.button(text="⬅️ Назад", callback_data="admin_menu")
         await callback.message.edit_text(text, reply_markup=builder.as_markup())
         return
 
-    # Формируем сообщение со списком промокодов
-    text = "**📊 Статистика промокодов:**\n\n"
+    pages = -(-total // page_size)
+    # Формируем сообщение со списком промокодов текущей страницы
+    text = f"**📊 Статистика промокодов:** {total}\nСтраница {min(page + 1, pages)} из {pages}\n\n"
     builder = InlineKeyboardBuilder()
-    for item in promos:
-        promo = item["promo"]
-        uses_count = len(item["uses"])
+    for promo, uses_count in promos:
         status = "✅ Активен" if promo.is_active else "❌ Неактивен"
         # Краткая строка
         text += f"• `{promo.code}` — {uses_count}/{promo.max_uses}, {status}\n"
         # Добавляем кнопку для детального просмотра этого промокода
-        builder.button(text=f"🔍 {promo.code}", callback_data=f"promo_detail_{promo.id}")
-    builder.button(text="⬅️ Назад", callback_data="admin_menu")
-    builder.adjust(1)  # по одной кнопке в ряд
+        builder.row(InlineKeyboardButton(text=f"🔍 {promo.code}", callback_data=f"promo_detail_{promo.id}_0"))
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"promo_stats_page_{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"promo_stats_page_{page + 1}"))
+    if nav:
+        builder.row(*nav)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_menu"))
 
     await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="Markdown")
 
 @router.callback_query(F.data == "ref_program")
-async def referral_program_callback(callback: CallbackQuery, bot: Bot):
+async def referral_program_callback(callback: CallbackQuery, bot: Bot, user: User = None):
     """Кнопка реферальной программы в меню"""
     await callback.answer()
-    user = await get_user(callback.from_user.id)
     if not user:
         # Если пользователя нет в БД, проводим через стандартный /start
         fake_message = Message(
@@ -297,21 +328,20 @@ async def referral_program_callback(callback: CallbackQuery, bot: Bot):
     await callback.message.answer(text, parse_mode="Markdown")
 
 @router.callback_query(F.data.startswith("promo_detail_"))
-async def admin_promo_detail(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    if not user or not user.is_admin:
+async def admin_promo_detail(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
         await callback.answer("⛔ Доступ запрещён")
         return
 
-    promo_id = int(callback.data.split("_")[2])
-    promos = await get_all_promocodes_with_stats()
-    promo_item = next((p for p in promos if p["promo"].id == promo_id), None)
-    if not promo_item:
+    parts = callback.data.split("_")
+    promo_id = int(parts[2])
+    page = int(parts[3]) if len(parts) > 3 else 0
+    page_size = config.ADMIN_PROMO_USES_PAGE_SIZE
+    promo, uses, total_uses = await get_promo_activations(promo_id, page, page_size)
+    if not promo:
         await callback.answer("❌ Промокод не найден")
         return
-
-    promo = promo_item["promo"]
-    uses = promo_item["uses"]
+    await callback.answer()
 
     status = "✅ Активен" if promo.is_active else "❌ Неактивен"
     expires = promo.expires_at.strftime("%d.%m.%Y") if promo.expires_at else "никогда"
@@ -325,7 +355,7 @@ async def admin_promo_detail(callback: CallbackQuery):
         f"• Статус: {status}\n"
         f"• Создан: {promo.created_at.strftime('%d.%m.%Y %H:%M')}\n"
         f"• Истекает: {expires}\n\n"
-        f"<b>👤 Активации:</b>"
+        f"<b>👤 Активации:</b> {total_uses}"
     )
 
     if uses:
@@ -341,36 +371,31 @@ async def admin_promo_detail(callback: CallbackQuery):
         text += "\n• Пока не активирован"
 
     builder = InlineKeyboardBuilder()
-    builder.button(text="⬅️ Назад к списку", callback_data="admin_promo_stats")
-    builder.button(text="⬅️ В админ-меню", callback_data="admin_menu")
-    builder.adjust(1)
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"promo_detail_{promo.id}_{page - 1}"))
+    if (page + 1) * page_size < total_uses:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"promo_detail_{promo.id}_{page + 1}"))
+    if nav:
+        builder.row(*nav)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="admin_promo_stats"))
+    builder.row(InlineKeyboardButton(text="⬅️ В админ-меню", callback_data="admin_menu"))
 
     await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
 
 @router.message(Command("menu"))
-async def menu_cmd(message: Message, bot: Bot):
-    user = await get_user(message.from_user.id)
+async def menu_cmd(message: Message, bot: Bot, user: User = None):
     if not user:
         await start_cmd(message, bot)
         return
 
-    # Проверяем изменения данных
-    update_data = {}
+    # Проверяем изменения данных (запишет middleware после обработки)
     if user.full_name != message.from_user.full_name:
-        update_data["full_name"] = message.from_user.full_name
+        user.full_name = message.from_user.full_name
     if user.username != message.from_user.username:
-        update_data["username"] = message.from_user.username
+        user.username = message.from_user.username
 
-    # Обновляем данные если есть изменения
-    if update_data:
-        with Session() as session:
-            db_user = session.query(User).get(user.id)
-            for key, value in update_data.items():
-                setattr(db_user, key, value)
-            session.commit()
-            logger.info(f"🔄 Updated user data in menu: {message.from_user.id}")
-
-    await show_menu(bot, message.from_user.id)
+    await show_menu(bot, message.from_user.id, user=user)
 
 @router.callback_query(F.data == "activate_promo")
 async def activate_promo_start(callback: CallbackQuery, state: FSMContext):
@@ -509,55 +534,57 @@ async def process_pre_checkout_query(
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 @router.message(Command("fix_subids"))
-async def fix_subids(message: Message):
-    user = await get_user(message.from_user.id)
-    if not user or not user.is_admin:
+async def fix_subids(message: Message, is_admin: bool):
+    if not is_admin:
         await message.answer("⛔ Доступ запрещён")
         return
 
     await message.answer("🔄 Получаю список клиентов из панели...")
     
-    async with XUIAPI() as api:
-        inbound = await api.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            await message.answer("❌ Не удалось получить данные inbound")
-            return
-        
-        settings = json.loads(inbound["settings"])
-        clients = settings.get("clients", [])
-        
-        updated = 0
-        for client in clients:
-            email = client.get("email")
-            sub_id = client.get("subId", "")
-            if not sub_id and email:
-                # Генерируем новый subId
-                new_subid = secrets.token_hex(16)
-                # Обновляем в панели
-                if await api.update_client_subid(email, new_subid):
-                    updated += 1
-                    # Если пользователь есть в БД, обновляем и там
-                    with Session() as session:
-                        db_user = session.query(User).filter_by(telegram_id=email.split('_')[-1] if email.startswith('user_') else None).first()
-                        # Или поиск по другим полям — упрощённо
-                        if db_user:
-                            db_user.subscription_token = new_subid
-                            if db_user.vless_profile_data:
-                                profile = json.loads(db_user.vless_profile_data)
-                                profile["subId"] = new_subid
-                                db_user.vless_profile_data = json.dumps(profile)
-                            session.commit()
-                    await message.answer(f"✅ Обновлён {email} -> {new_subid[:8]}...")
-                else:
-                    await message.answer(f"❌ Ошибка обновления {email}")
-        
-        await message.answer(f"✅ Готово! Обновлено {updated} клиентов.")
+    api = get_xui_api()
+    snapshot = await api.get_inbound_snapshot(config.INBOUND_ID)
+    if not snapshot:
+        await message.answer("❌ Не удалось получить данные inbound")
+        return
+
+    # Копия списка: update_client_subid меняет клиентов снимка по ходу цикла
+    clients = list(snapshot.clients)
+    
+    updated = 0
+    for client in clients:
+        email = client.get("email")
+        sub_id = client.get("subId", "")
+        if not sub_id and email:
+            # Генерируем новый subId
+            new_subid = secrets.token_hex(16)
+            # Обновляем в панели
+            if await api.update_client_subid(email, new_subid):
+                updated += 1
+                # Если пользователь есть в БД, обновляем и там (поиск по индексу client_email)
+                db_user = await get_user_by_client_email(email)
+                if db_user:
+                    fields = {"subscription_token": new_subid, "client_sub_id": new_subid}
+                    if db_user.vless_profile_data:
+                        profile = json.loads(db_user.vless_profile_data)
+                        profile["subId"] = new_subid
+                        fields["vless_profile_data"] = json.dumps(profile)
+                    await update_user(db_user.telegram_id, **fields)
+                await message.answer(f"✅ Обновлён {email} -> {new_subid[:8]}...")
+            else:
+                await message.answer(f"❌ Ошибка обновления {email}")
+    
+    await message.answer(f"✅ Готово! Обновлено {updated} клиентов.")
 
 @router.message(F.successful_payment)
-async def process_successful_payment(message: Message, bot: Bot):
+async def process_successful_payment(message: Message, bot: Bot, user: User = None):
+    # Подтверждение оплаты и уведомления админов идут вперёд уведомлений и рассылок
+    with send_priority(Priority.TRANSACTIONAL):
+        await handle_successful_payment(message, bot, user)
+
+
+async def handle_successful_payment(message: Message, bot: Bot, user: User = None):
     try:
         payload = message.successful_payment.invoice_payload
-        user = await get_user(message.from_user.id)
         if not user:
             await message.answer("❌ Ошибка: пользователь не найден")
             return
@@ -568,64 +595,53 @@ async def process_successful_payment(message: Message, bot: Bot):
         if payload.startswith("stars_"):
             months = int(payload.split("_")[1])
             stars_price = config.calculate_stars_price(months)
-            success = await update_subscription(message.from_user.id, months)
+            # В счётчики идёт фактически оплаченная сумма
+            success = await update_subscription(
+                message.from_user.id, months, stars=message.successful_payment.total_amount
+            )
             suffix = "месяц" if months == 1 else "месяца" if months in (2, 3, 4) else "месяцев"
 
             if success:
-                profile_data = None
+                email, client_id, sub_id = user.client_email, user.client_id, user.client_sub_id
                 # Создаём профиль, если его нет
-                if not user.vless_profile_data:
+                if not email:
                     days = months * 30
                     profile_data = await create_vless_profile(user.telegram_id, subscription_days=days)
                     if profile_data:
-                        with Session() as session:
-                            db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                            if db_user:
-                                db_user.vless_profile_data = json.dumps(profile_data)
-                                # Сохраняем subId как subscription_token
-                                db_user.subscription_token = profile_data.get("subId")
-                                session.commit()
-                        # Применяем ограничение скорости по IP
+                        # Сохраняем subId как subscription_token
+                        assign_profile(user, profile_data)
+                        user.subscription_token = profile_data.get("subId")
+                        email, client_id, sub_id = profile_data["email"], profile_data["client_id"], profile_data.get("subId")
+                        # Применяем ограничение скорости по IP (IP хранится в данных профиля)
                         client_ip = profile_data.get("client_ip")
                         if client_ip:
-                            with Session() as session:
-                                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                                if db_user and not db_user.client_ip:
-                                    db_user.client_ip = client_ip
-                                    session.commit()
                             await apply_tc_limit(client_ip)
-                else:
-                    profile_data = safe_json_loads(user.vless_profile_data)
 
                 # Включаем клиента, если он был отключён
-                if profile_data and profile_data.get("email"):
-                    email = profile_data["email"]
-                    updated_user = await get_user(message.from_user.id)
-                    if updated_user and not updated_user.is_enabled_in_panel:
-                        enable_success = await enable_client_by_email(email)
-                        if enable_success:
-                            with Session() as session:
-                                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                                if db_user:
-                                    db_user.is_enabled_in_panel = True
-                                    session.commit()
-                            logger.info(f"✅ Client {email} re-enabled after payment")
-                        else:
-                            logger.warning(f"⚠️ Failed to enable client {email} after payment")
+                if email and not user.is_enabled_in_panel:
+                    enable_success = await enable_client_by_email(email)
+                    if enable_success:
+                        user.is_enabled_in_panel = True
+                        logger.info(f"✅ Client {email} re-enabled after payment")
+                    else:
+                        logger.warning(f"⚠️ Failed to enable client {email} after payment")
+
+                # Профиль и флаг панели — одним UPDATE, до перепланирования проверки сроков
+                await flush_user(user)
+                expiry_scheduler.rearm()
 
                 # Формируем ссылку на подписку (если есть subId)
                 vless_url = None
                 subscription_link = None
-                if profile_data:
-                    sub_id = profile_data.get("subId")
-                    # Если subId нет в profile_data, но есть в БД как subscription_token
+                if email:
+                    # Если subId нет у профиля, но есть в БД как subscription_token
                     if not sub_id and user.subscription_token:
                         sub_id = user.subscription_token
                     if sub_id:
                         subscription_link = f"https://panel.marlin.fit:2096/u7dGkL9pQw2rXyZ/{sub_id}"
                     else:
                         # Если subId нет, генерируем статичную VLESS-ссылку
-                        vless_url = generate_vless_url(profile_data)
+                        vless_url = await get_vless_url(client_id, email)
 
                 # Текст ответа
                 answer_text = (
@@ -671,20 +687,22 @@ async def process_successful_payment(message: Message, bot: Bot):
         await message.answer("❌ Ошибка при обработке платежа")
 
 @router.callback_query(F.data == "admin_menu")
-async def admin_menu(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    if not user or not user.is_admin:
+async def admin_menu(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
         await callback.answer("🛑 Доступ запрещен!")
         return
 
     total, with_sub, without_sub = await db_user_stats()
+    today = await get_today_counters()
     online_count = await get_online_users()
 
     text = (
         "**Административное меню**\n\n"
         f"**Всего пользователей**: `{total}`\n"
         f"**С подпиской/Без подписки**: `{with_sub}`/`{without_sub}`\n"
-        f"**Онлайн**: `{online_count}` | **Офлайн**: `{with_sub - online_count}`")
+        f"**Онлайн**: `{online_count}` | **Офлайн**: `{with_sub - online_count}`\n"
+        f"**Сегодня**: регистраций `{today['signups']}`, оплат `{today['payments']}` "
+        f"на `{today['stars']}`⭐, промокодов `{today['promo_uses']}`")
 
     builder = InlineKeyboardBuilder()
     builder.button(text="+ время", callback_data="admin_add_time")
@@ -699,7 +717,9 @@ async def admin_menu(callback: CallbackQuery):
     builder.button(text="⬅️ Назад", callback_data="back_to_menu")
     builder.button(text="🎫 Создать промокод", callback_data="admin_create_promo")
     builder.button(text="📊 Статистика промокодов", callback_data="admin_promo_stats")
-    builder.adjust(2, 1, 1, 1, 1, 1, 1)
+    builder.button(text="🔥 Топ по трафику", callback_data="admin_top_traffic")
+    builder.button(text="🔎 Поиск пользователя", callback_data="admin_search")
+    builder.adjust(2, 1, 1, 1, 1, 1, 1, 1, 1)
 
     await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='Markdown')
 
@@ -743,36 +763,18 @@ async def admin_add_time_amount(message: Message, state: FSMContext):
             minutes * 60
         )
 
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if user:
-                now = datetime.utcnow()
-                if user.subscription_end and user.subscription_end > now:
-                    user.subscription_end += timedelta(seconds=total_seconds)
-                else:
-                    user.subscription_end = now + \
-                        timedelta(seconds=total_seconds)
-                session.commit()
-                # Получаем email пользователя из его профиля
-                if user and user.vless_profile_data:
-                    profile = json.loads(user.vless_profile_data)
-                    email = profile.get("email")
-                    if email and user.subscription_end:
-                        api_updater = XUIAPI()
-                        with Session() as session:
-                                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                                if db_user and db_user.is_enabled_in_panel == False:
-                                    db_user.is_enabled_in_panel = True
-                                    session.commit()
-                            
-                        try:
-                            if await api_updater.login():
-                                await api_updater.enable_client(email)
-                        finally:
-                            await api_updater.close()
-                await message.answer(f"✅ Добавлено время пользователю {user_id}")
-            else:
-                await message.answer("❌ Пользователь не найден")
+        user = await shift_subscription(user_id, timedelta(seconds=total_seconds))
+        if user:
+            # Email клиента в панели
+            email = user.client_email
+            if email and user.subscription_end:
+                if user.is_enabled_in_panel == False:
+                    await update_user(user.telegram_id, is_enabled_in_panel=True)
+                await enable_client_by_email(email)
+            expiry_scheduler.rearm()
+            await message.answer(f"✅ Добавлено время пользователю {user_id}")
+        else:
+            await message.answer("❌ Пользователь не найден")
     except Exception as e:
         await message.answer(f"Ошибка: {str(e)}")
     finally:
@@ -816,33 +818,16 @@ async def admin_remove_time_amount(message: Message, state: FSMContext):
             minutes * 60
         )
 
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if user:
-                now = datetime.utcnow()
-                if user.subscription_end:
-                    new_end = user.subscription_end - \
-                        timedelta(seconds=total_seconds)
-                    if new_end < now:
-                        new_end = now
-                else:
-                    new_end = now
-                user.subscription_end = new_end
-                session.commit()
-                if user and user.vless_profile_data:
-                    profile = json.loads(user.vless_profile_data)
-                    email = profile.get("email")
-                    if email and user.subscription_end:
-                        expiry_ms = int(user.subscription_end.timestamp() * 1000)
-                        api_updater = XUIAPI()
-                        try:
-                            if await api_updater.login():
-                                await api_updater.update_client_expiry(email, expiry_ms)
-                        finally:
-                            await api_updater.close()
-                await message.answer(f"✅ Удалено время у пользователя {user_id}")
-            else:
-                await message.answer("❌ Пользователь не найден")
+        user = await shift_subscription(user_id, -timedelta(seconds=total_seconds))
+        if user:
+            email = user.client_email
+            if email and user.subscription_end:
+                expiry_ms = int(user.subscription_end.timestamp() * 1000)
+                await get_xui_api().update_client_expiry(email, expiry_ms)
+            expiry_scheduler.rearm()
+            await message.answer(f"✅ Удалено время у пользователя {user_id}")
+        else:
+            await message.answer("❌ Пользователь не найден")
     except Exception as e:
         await message.answer(f"Ошибка: {str(e)}")
     finally:
@@ -874,55 +859,219 @@ async def admin_user_list(callback: CallbackQuery):
     await callback.message.edit_text("**Выберите фильтр**", reply_markup=builder.as_markup(), parse_mode='Markdown')
 
 
-@router.callback_query(F.data == "user_list_active")
-async def handle_user_list_active(callback: CallbackQuery):
-    users = await get_all_users(with_subscription=True)
+# Список пользователей листается страницами: ul:<фильтр>:<порядок>:<страница>:<n|p>:<ключ>,
+# где ключ — последняя (n) или первая (p) строка текущей страницы
+USER_LIST_FILTERS = {"a": True, "i": False}
+USER_LIST_ORDERS = {"e": "expiry", "r": "registration"}
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_user_cursor(row, order: str) -> str:
+    if order == "expiry":
+        return f"{(row.subscription_end - EPOCH) // timedelta(microseconds=1)}.{row.id}"
+    return str(row.id)
+
+
+def decode_user_cursor(value: str, order: str):
+    if not value:
+        return None
+    if order == "expiry":
+        micros, user_id = value.split(".")
+        return EPOCH + timedelta(microseconds=int(micros)), int(user_id)
+    return (int(value),)
+
+
+async def show_user_list(callback: CallbackQuery, filter_code: str, order_code: str,
+                         page: int = 1, direction: str = "n", cursor: str = ""):
+    with_subscription = USER_LIST_FILTERS[filter_code]
+    order = USER_LIST_ORDERS[order_code]
+    # Активные — ближайшие к окончанию первыми, без подписки — недавно истёкшие первыми,
+    # по регистрации — новые первыми
+    descending = order == "registration" or not with_subscription
+    rows, has_more = await get_users_page(
+        with_subscription, order, descending,
+        cursor=decode_user_cursor(cursor, order),
+        backward=direction == "p",
+        page_size=config.ADMIN_USERS_PAGE_SIZE
+    )
+    total = await count_users(with_subscription)
+    pages = max(1, -(-total // config.ADMIN_USERS_PAGE_SIZE))
+
+    title = "с активной подпиской" if with_subscription else "без подписки"
+    text = f"👤 <b>Пользователи {title}:</b> {total}\nСтраница {min(page, pages)} из {pages}\n\n"
+    if not rows:
+        text += "Нет пользователей"
+    for row in rows:
+        username = f"@{row.username}" if row.username else "none"
+        text += f"• {html.escape(row.full_name or '')} ({username} | <code>{row.telegram_id}</code>)"
+        if with_subscription:
+            text += f" - до <code>{row.subscription_end.strftime('%d.%m.%Y %H:%M')}</code>"
+        if order == "registration" and row.registration_date:
+            text += f", рег. {row.registration_date.strftime('%d.%m.%Y')}"
+        text += "\n"
+
+    builder = InlineKeyboardBuilder()
+    nav = []
+    if rows and page > 1:
+        prev_cursor = encode_user_cursor(rows[0], order)
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=f"ul:{filter_code}:{order_code}:{page - 1}:p:{prev_cursor}"))
+    if rows and (has_more or direction == "p"):
+        next_cursor = encode_user_cursor(rows[-1], order)
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=f"ul:{filter_code}:{order_code}:{page + 1}:n:{next_cursor}"))
+    if nav:
+        builder.row(*nav)
+    builder.row(
+        InlineKeyboardButton(
+            text=("✅ " if order_code == "e" else "") + "По сроку",
+            callback_data=f"ul:{filter_code}:e:1:n:"),
+        InlineKeyboardButton(
+            text=("✅ " if order_code == "r" else "") + "По регистрации",
+            callback_data=f"ul:{filter_code}:r:1:n:")
+    )
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_user_list"))
+    await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
+
+
+@router.callback_query(F.data.in_({"user_list_active", "user_list_inactive"}))
+async def handle_user_list(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
+        await callback.answer("⛔ Доступ запрещён")
+        return
     await callback.answer()
-    if not users:
-        await callback.answer("Нет пользователей с активной подпиской")
+    await show_user_list(callback, "a" if callback.data == "user_list_active" else "i", "e")
+
+
+@router.callback_query(F.data.startswith("ul:"))
+async def handle_user_list_page(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
+        await callback.answer("⛔ Доступ запрещён")
         return
+    await callback.answer()
+    _, filter_code, order_code, page, direction, cursor = callback.data.split(":", 5)
+    await show_user_list(callback, filter_code, order_code, int(page), direction, cursor)
 
-    text = "👤 <b>Пользователи с активной подпиской:</b>\n\n"
-    for user in users:
-        expire_date = user.subscription_end.strftime("%d.%m.%Y %H:%M")
-        username = f"@{user.username}" if user.username else "none"
-        user_line = f"• {user.full_name} ({username} | <code>{user.telegram_id}</code>) - до <code>{expire_date}</code>\n"
 
-        # Если текст становится слишком длинным, отправляем текущую часть и
-        # начинаем новую
-        if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Пользователи с активной подпиской (продолжение):</b>\n\n"
+# Поиск пользователя: по Telegram ID, @username или части имени
+@router.callback_query(F.data == "admin_search")
+async def admin_search_start(callback: CallbackQuery, state: FSMContext, is_admin: bool):
+    if not is_admin:
+        await callback.answer("⛔ Доступ запрещён")
+        return
+    await callback.answer()
+    await callback.message.answer("🔎 Введите Telegram ID, @username или часть имени (от 3 символов):")
+    await state.set_state(AdminStates.SEARCH_USER)
 
-        text += user_line
 
-    # Отправляем оставшуюся часть текста
-    await callback.message.answer(text, parse_mode="HTML")
+@router.message(AdminStates.SEARCH_USER)
+async def admin_search_query(message: Message, state: FSMContext):
+    await state.clear()
+    await send_search_results(message, message.text or "")
 
 
-@router.callback_query(F.data == "user_list_inactive")
-async def handle_user_list_inactive(callback: CallbackQuery):
-    await callback.answer()
-    users = await get_all_users(with_subscription=False)
+@router.message(Command("find"))
+async def find_user_cmd(message: Message, is_admin: bool):
+    """Поиск пользователя. Формат: /find <ID, @username или часть имени>"""
+    if not is_admin:
+        await message.answer("⛔ Доступ запрещён")
+        return
+    args = message.text.split(maxsplit=1)
+    if len(args) != 2:
+        await message.answer("Использование: /find <ID, @username или часть имени>")
+        return
+    await send_search_results(message, args[1])
+
+
+async def send_search_results(message: Message, query: str):
+    users = await search_users(query)
     if not users:
-        await callback.answer("Нет пользователей без подписки")
+        await message.answer("❌ Никого не найдено")
+        return
+    if len(users) == 1:
+        await send_user_card(message, users[0].telegram_id)
         return
 
-    text = "👤 <b>Пользователи без подписки:</b>\n\n"
-    for user in users:
-        username = f"@{user.username}" if user.username else "none"
-        user_line = f"• {user.full_name} ({username} | <code>{user.telegram_id}</code>)\n"
+    builder = InlineKeyboardBuilder()
+    for row in users:
+        username = f" @{row.username}" if row.username else ""
+        builder.button(text=f"{row.full_name or row.telegram_id}{username}", callback_data=f"ucard_{row.telegram_id}")
+    builder.adjust(1)
+    await message.answer(f"🔎 Найдено: {len(users)}", reply_markup=builder.as_markup())
 
-        # Если текст становится слишком длинным, отправляем текущую часть и
-        # начинаем новую
-        if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Пользователи без подписки (продолжение):</b>\n\n"
 
-        text += user_line
+async def user_card(telegram_id: int):
+    """Текст и кнопки карточки пользователя: данные из кэша пользователей и локальной статистики трафика"""
+    user = await get_user(telegram_id)
+    if not user:
+        return None, None
+
+    now = datetime.utcnow()
+    if user.subscription_end and user.subscription_end > now:
+        subscription = f"до <code>{user.subscription_end.strftime('%d.%m.%Y %H:%M')}</code>"
+    else:
+        subscription = "истекла"
+    username = f"@{user.username}" if user.username else "none"
+    registered = user.registration_date.strftime('%d.%m.%Y') if user.registration_date else "—"
+    text = (
+        f"👤 <b>{html.escape(user.full_name or '')}</b> ({username})\n"
+        f"• ID: <code>{user.telegram_id}</code>\n"
+        f"• Регистрация: {registered}\n"
+        f"• Подписка: {subscription}\n"
+    )
+    if user.client_email:
+        panel = "включён" if user.is_enabled_in_panel is not False else "отключён"
+        text += f"• Профиль: <code>{html.escape(user.client_email)}</code>, в панели {panel}\n"
+        traffic = traffic_store.get(user.client_email)
+        if traffic:
+            text += f"• Трафик: 🔼 {format_bytes(traffic[0])} | 🔽 {format_bytes(traffic[1])}\n"
+        usage = await get_daily_usage(user.client_email, days=7)
+        if any(value for _, value in usage):
+            text += f"\n<b>За 7 дней:</b>\n<pre>{usage_chart(usage)}</pre>"
+    else:
+        text += "• Профиль: не создан\n"
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="+ время", callback_data=f"ucard_add_{telegram_id}")
+    builder.button(text="- время", callback_data=f"ucard_remove_{telegram_id}")
+    builder.button(text="⬅️ В админ-меню", callback_data="admin_menu")
+    builder.adjust(2, 1)
+    return text, builder.as_markup()
+
+
+async def send_user_card(message: Message, telegram_id: int):
+    text, markup = await user_card(telegram_id)
+    if text is None:
+        await message.answer("❌ Пользователь не найден")
+        return
+    await message.answer(text, reply_markup=markup, parse_mode="HTML")
+
+
+@router.callback_query(F.data.regexp(r"^ucard_\d+$"))
+async def admin_user_card(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
+        await callback.answer("⛔ Доступ запрещён")
+        return
+    text, markup = await user_card(int(callback.data.split("_")[1]))
+    if text is None:
+        await callback.answer("❌ Пользователь не найден")
+        return
+    await callback.answer()
+    await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
+
+
+@router.callback_query(F.data.startswith(("ucard_add_", "ucard_remove_")))
+async def admin_user_card_time(callback: CallbackQuery, state: FSMContext, is_admin: bool):
+    """Изменение срока из карточки: ID уже известен, сразу спрашиваем количество времени"""
+    if not is_admin:
+        await callback.answer("⛔ Доступ запрещён")
+        return
+    await callback.answer()
+    _, action, user_id = callback.data.split("_")
+    await state.update_data(user_id=int(user_id))
+    await callback.message.answer("Введите количество времени в формате:\nМесяцы Дни Часы Минуты\nПример: 1 0 0 0")
+    await state.set_state(AdminStates.ADD_TIME_AMOUNT if action == "add" else AdminStates.REMOVE_TIME_AMOUNT)
 
-    # Отправляем оставшуюся часть текста
-    await callback.message.answer(text, parse_mode="HTML")
 
 @router.callback_query(AdminPromoStates.choosing_type, F.data.in_({"promo_type_single", "promo_type_multi"}))
 async def admin_promo_choose_type(callback: CallbackQuery, state: FSMContext):
@@ -940,9 +1089,8 @@ async def admin_promo_choose_type(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AdminPromoStates.entering_months)
 
 @router.message(Command("listpromo"))
-async def list_promo_cmd(message: Message):
-    user = await get_user(message.from_user.id)
-    if not user or not user.is_admin:
+async def list_promo_cmd(message: Message, is_admin: bool):
+    if not is_admin:
         await message.answer("⛔ Доступ запрещён")
         return
 
@@ -970,6 +1118,7 @@ async def admin_send_message_start(callback: CallbackQuery, state: FSMContext):
     builder.button(text="✅ С подпиской", callback_data="target_active")
     builder.button(text="🛑 Без подписки", callback_data="target_inactive")
     builder.button(text="👥 Всем пользователям", callback_data="target_all")
+    builder.button(text="🗂 Текущие рассылки", callback_data="admin_broadcasts")
     builder.button(text="↩️ Назад", callback_data="admin_menu")
     builder.adjust(1)
 
@@ -979,6 +1128,59 @@ async def admin_send_message_start(callback: CallbackQuery, state: FSMContext):
     )
 
 
+async def show_broadcast_jobs(callback: CallbackQuery):
+    jobs = await get_broadcast_jobs(['running', 'paused'])
+
+    builder = InlineKeyboardBuilder()
+    if not jobs:
+        text = "Нет активных рассылок"
+    else:
+        lines = ["**Текущие рассылки**\n"]
+        for job in jobs:
+            running = job.id in active_broadcasts or job.status == 'running'
+            status = "▶️ идёт" if running else "⏸ пауза"
+            preview = job.text[:30].replace("\n", " ")
+            lines.append(f"#{job.id} {status}: {job.sent + job.failed}/{job.total} — {preview}")
+            if running:
+                builder.button(text=f"⏸ #{job.id}", callback_data=f"bc_pause_{job.id}")
+            else:
+                builder.button(text=f"▶️ #{job.id}", callback_data=f"bc_resume_{job.id}")
+            builder.button(text=f"✖️ #{job.id}", callback_data=f"bc_cancel_{job.id}")
+        text = "\n".join(lines)
+    builder.button(text="↩️ Назад", callback_data="admin_send_message")
+    builder.adjust(*([2] * len(jobs)), 1)
+
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+
+
+@router.callback_query(F.data == "admin_broadcasts")
+async def admin_broadcasts(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+    await callback.answer()
+    await show_broadcast_jobs(callback)
+
+
+@router.callback_query(F.data.startswith("bc_"))
+async def admin_broadcast_control(callback: CallbackQuery, bot: Bot, is_admin: bool):
+    if not is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+
+    _, action, job_id = callback.data.split("_")
+    job_id = int(job_id)
+    if action == "pause":
+        ok = await stop_broadcast(job_id, 'paused')
+    elif action == "cancel":
+        ok = await stop_broadcast(job_id, 'cancelled')
+    else:
+        ok = await resume_broadcast(bot, job_id)
+
+    await callback.answer("✅ Готово" if ok else "⚠️ Рассылка уже завершена")
+    await show_broadcast_jobs(callback)
+
+
 @router.callback_query(F.data.startswith("target_"))
 async def admin_send_message_target(
         callback: CallbackQuery,
@@ -990,9 +1192,8 @@ async def admin_send_message_target(
     await state.set_state(AdminStates.SEND_MESSAGE)
 
 @router.callback_query(F.data == "admin_create_promo")
-async def admin_create_promo_start(callback: CallbackQuery, state: FSMContext):
-    user = await get_user(callback.from_user.id)
-    if not user or not user.is_admin:
+async def admin_create_promo_start(callback: CallbackQuery, state: FSMContext, is_admin: bool):
+    if not is_admin:
         await callback.answer("⛔ Доступ запрещён")
         return
     await callback.answer()
@@ -1017,40 +1218,16 @@ async def admin_send_message(message: Message, state: FSMContext, bot: Bot):
     target = data['target']
     text = message.text
 
-    users = []
-    if target == "active":
-        users = await get_all_users(with_subscription=True)
-    elif target == "inactive":
-        users = await get_all_users(with_subscription=False)
-    else:  # all
-        users = await get_all_users()
-
-    success = 0
-    failed = 0
-
-    for user in users:
-        try:
-            await bot.send_message(user.telegram_id, text)
-            success += 1
-        except Exception as e:
-            logger.error(
-                f"🛑 Ошибка отправки сообщения {user.telegram_id}: {e}")
-            failed += 1
-
-    await message.answer(
-        f"📨 Результаты рассылки:\n\n"
-        f"• Успешно: {success}\n"
-        f"• Не удалось: {failed}\n"
-        f"• Всего: {len(users)}"
-    )
     await state.clear()
 
+    # Рассылка идёт в фоне: прогресс редактируется в отдельном сообщении
+    await start_broadcast(bot, text, target, message.chat.id)
+
 # Остальные обработчики остаются без изменений
 @router.message(Command("addpromo"))
-async def add_promo_cmd(message: Message):
+async def add_promo_cmd(message: Message, is_admin: bool):
     """Добавить промокод. Формат: /addpromo <месяцы> <макс_использований> [код]"""
-    user = await get_user(message.from_user.id)
-    if not user or not user.is_admin:
+    if not is_admin:
         await message.answer("⛔ Доступ запрещён")
         return
 
@@ -1191,20 +1368,17 @@ async def handle_delete_static_profile(callback: CallbackQuery):
     try:
         profile_id = int(callback.data.split("_")[-1])
 
-        with Session() as session:
-            profile = session.query(StaticProfile).filter_by(
-                id=profile_id).first()
-            if not profile:
-                await callback.answer("⚠️ Профиль не найден")
-                return
+        profile = await get_static_profile(profile_id)
+        if not profile:
+            await callback.answer("⚠️ Профиль не найден")
+            return
 
-            success = await delete_client_by_email(profile.name)
-            if not success:
-                logger.error(
-                    f"🛑 Ошибка удаления клиента из инбаунда: {profile.name}")
+        success = await delete_client_by_email(profile.name)
+        if not success:
+            logger.error(
+                f"🛑 Ошибка удаления клиента из инбаунда: {profile.name}")
 
-            session.delete(profile)
-            session.commit()
+        await delete_static_profile(profile_id)
 
         await callback.answer("✅ Профиль удален!")
         await callback.message.delete()
@@ -1237,8 +1411,7 @@ async def admin_promo_enter_max_uses(message: Message, state: FSMContext):
     await state.set_state(AdminPromoStates.entering_custom_code)
 
 @router.callback_query(F.data == "connect")
-async def connect_profile(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
+async def connect_profile(callback: CallbackQuery, user: User = None):
     if not user:
         await callback.answer("🛑 Ошибка профиля")
         return
@@ -1247,7 +1420,7 @@ async def connect_profile(callback: CallbackQuery):
         await callback.answer("⚠️ Подписка истекла! Продлите подписку.")
         return
 
-    if not user.vless_profile_data:
+    if not user.client_email:
         await callback.message.edit_text("⚙️ Создаем ваш VPN профиль...")
         remaining_days = 0
         if user.subscription_end and user.subscription_end > datetime.utcnow():
@@ -1256,33 +1429,21 @@ async def connect_profile(callback: CallbackQuery):
         profile_data = await create_vless_profile(user.telegram_id, subscription_days=remaining_days)
 
         if profile_data:
-            with Session() as session:
-                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                if db_user:
-                    db_user.vless_profile_data = json.dumps(profile_data)
-                    session.commit()
-            user = await get_user(user.telegram_id)
+            assign_profile(user, profile_data)
+            await flush_user(user)
+            expiry_scheduler.rearm()
         else:
             await callback.message.answer("🛑 Ошибка при создании профиля. Попробуйте позже.")
             return
 
-    profile_data = safe_json_loads(user.vless_profile_data, default={})
-    if not profile_data:
-        await callback.message.answer("⚠️ У вас пока нет созданного профиля.")
-        return
-
-    stats = await get_user_stats(profile_data['email'])
+    email = user.client_email
+    stats = await get_user_stats(email)
     sub_id = stats.get('subId')
     # Если sub_id нет, но в БД есть subscription_token – используем его
     if not sub_id and user.subscription_token:
         sub_id = user.subscription_token
         # Обновляем в панели, чтобы в следующий раз было
-        api = XUIAPI()
-        try:
-            await api.login()
-            await api.update_client_subid(profile_data['email'], sub_id)
-        finally:
-            await api.close()
+        await get_xui_api().update_client_subid(email, sub_id)
 
     if sub_id:
         subscription_link = f"https://panel.marlin.fit:2096/u7dGkL9pQw2rXyZ/{sub_id}"
@@ -1304,7 +1465,7 @@ async def connect_profile(callback: CallbackQuery):
             "✅ Теперь при любых изменениях на сервере вам не нужно будет обновлять ссылку вручную."
         )
     else:
-        vless_url = generate_vless_url(profile_data)
+        vless_url = await get_vless_url(user.client_id, email)
         text = (
             "🎉 **Ваш VPN профиль готов!**\n\n"
             "ℹ️ **Инструкция по подключению:**\n"
@@ -1371,14 +1532,12 @@ async def admin_promo_enter_custom_code(message: Message, state: FSMContext):
     await show_promo_confirmation(message, state)
 
 @router.callback_query(F.data == "stats")
-async def user_stats(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    if not user or not user.vless_profile_data:
+async def user_stats(callback: CallbackQuery, user: User = None):
+    if not user or not user.client_email:
         await callback.answer("⚠️ Профиль не создан")
         return
     await callback.message.edit_text("⚙️ Загружаем вашу статистику...")
-    profile_data = safe_json_loads(user.vless_profile_data, default={})
-    stats = await get_user_stats(profile_data["email"])
+    stats = await get_user_stats(user.client_email)
 
     logger.debug(stats)
     upload = f"{stats.get('upload', 0) / 1024 / 1024:.2f}"
@@ -1391,12 +1550,16 @@ async def user_stats(callback: CallbackQuery):
     if download_size == "GB":
         download = f"{int(float(download) / 1024):.2f}"
 
+    usage = await get_daily_usage(user.client_email, days=7)
+
     await callback.message.delete()
     text = (
         "📊 **Ваша статистика:**\n\n"
         f"🔼 Загружено: `{upload} {upload_size}`\n"
         f"🔽 Скачано: `{download} {download_size}`\n"
     )
+    if any(value for _, value in usage):
+        text += f"\n📈 **Трафик за 7 дней:**\n```\n{usage_chart(usage)}\n```"
     await callback.message.answer(text, parse_mode='Markdown')
 
 async def show_promo_confirmation(target, state: FSMContext):
@@ -1443,10 +1606,48 @@ async def network_stats(callback: CallbackQuery):
     await callback.answer()
     text = (
         "📊 **Статистика использования сети:**\n\n"
-        f"🔼 Upload - `{upload} {upload_size}` | 🔽 Download - `{download} {download_size}`"
+        f"🔼 Upload - `{upload} {upload_size}` | 🔽 Download - `{download} {download_size}`\n\n"
+        "📨 **Очереди отправки** (в очереди / отправлено / среднее и p95 ожидание):\n"
+    )
+    for name, metrics in send_scheduler.stats().items():
+        text += (
+            f"`{name}`: {metrics['queued']} / {metrics['sent']} / "
+            f"{metrics['avg_wait']:.2f}с, {metrics['p95_wait']:.2f}с\n"
+        )
+    if db_writer.enabled:
+        writer = db_writer.stats()
+        text += (
+            f"\n🗄 **Запись в БД**: в очереди `{writer['queued']}`, записей `{writer['writes']}`, "
+            f"ожидание `{writer['avg_wait_ms']:.1f}` мс, среднее `{writer['avg_ms']:.1f}` мс, "
+            f"p95 `{writer['p95_ms']:.1f}` мс"
+        )
+    cache = user_cache.stats()
+    text += (
+        f"\n👤 **Кэш пользователей**: `{cache['size']}` записей, попаданий `{cache['hits']}`, "
+        f"промахов `{cache['misses']}` ({cache['hit_rate']:.0%})"
     )
     await callback.message.edit_text(text, parse_mode='Markdown')
 
+@router.callback_query(F.data == "admin_top_traffic")
+async def admin_top_traffic(callback: CallbackQuery, is_admin: bool):
+    if not is_admin:
+        await callback.answer("⛔ Доступ запрещён")
+        return
+    await callback.answer()
+
+    text = "🔥 **Топ по трафику**\n"
+    for title, hours in (("За 24 часа", 24), ("За 7 дней", 24 * 7)):
+        top = await get_top_traffic(hours, limit=10)
+        text += f"\n**{title}:**\n"
+        if not top:
+            text += "• нет данных\n"
+        for place, (email, total) in enumerate(top, start=1):
+            text += f"{place}. `{email}` — {format_bytes(total)}\n"
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⬅️ Назад", callback_data="admin_menu")
+    await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='Markdown')
+
 @router.callback_query(AdminPromoStates.confirming, F.data == "admin_promo_confirm")
 async def admin_promo_confirm(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
@@ -1473,9 +1674,9 @@ async def admin_promo_confirm(callback: CallbackQuery, state: FSMContext):
         await state.finish()
 
 @router.callback_query(F.data == "back_to_menu")
-async def back_to_menu(callback: CallbackQuery, bot: Bot):
+async def back_to_menu(callback: CallbackQuery, bot: Bot, user: User = None):
     await callback.answer()
-    await show_menu(bot, callback.from_user.id, callback.message.message_id)
+    await show_menu(bot, callback.from_user.id, callback.message.message_id, user=user)
 
 @router.callback_query(F.data == "admin_promo_cancel")
 async def admin_promo_cancel(callback: CallbackQuery, state: FSMContext):
@@ -1486,6 +1687,9 @@ async def admin_promo_cancel(callback: CallbackQuery, state: FSMContext):
     await show_menu(callback.bot, callback.from_user.id, callback.message.message_id)
 
 def setup_handlers(dp: Dispatcher):
+    # Пользователь загружается один раз на апдейт, который дошёл до обработчика
+    router.message.middleware(user_context)
+    router.callback_query.middleware(user_context)
     dp.include_router(router)
     logger.info("✅ Handlers setup completed")
 
@@ -0,0 +1,49 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from config import config
+from database import get_user, flush_user
+
+logger = logging.getLogger(__name__)
+
+# Администраторы задаются только в конфиге, поэтому проверка не требует запроса к БД
+ADMIN_IDS = frozenset(config.ADMINS)
+
+
+def is_admin_id(telegram_id: int) -> bool:
+    return telegram_id in ADMIN_IDS
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Загружает пользователя один раз на апдейт и передаёт обработчику аргументами
+    user (User или None, если пользователь ещё не зарегистрирован) и is_admin.
+    Поля, изменённые обработчиком на объекте user, записываются одним UPDATE
+    после обработки апдейта.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        if from_user is None:
+            return await handler(event, data)
+
+        user = await get_user(from_user.id)
+        data["user"] = user
+        data["is_admin"] = is_admin_id(from_user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            if user is not None:
+                try:
+                    await flush_user(user)
+                except Exception as e:
+                    logger.error(f"❌ Failed to save user {from_user.id}: {e}")
+
+
+user_context = UserContextMiddleware()
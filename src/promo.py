@@ -2,38 +2,59 @@ import random
 from database import User
 import string
 from datetime import datetime, timedelta
-from sqlalchemy import func
+from collections import Counter
+from sqlalchemy import func, select, insert, update, or_
+from sqlalchemy.exc import IntegrityError
 from database import Session, PromoCode, PromoCodeUse, User
 from config import config
 import logging
 from functions import create_vless_profile, enable_client_by_email, apply_tc_limit, safe_json_loads
-from database import get_user, Session, User
-import json
+from database import get_user, update_user, save_user_profile, user_cache, writes, Session, User
+from database import bump_counters, counter_key, expiry_move, signup_deltas, upsert_insert
+from expiry import expiry_scheduler
 
 logger = logging.getLogger(__name__)
 
-async def get_all_promocodes_with_stats():
-    """Возвращает все промокоды с информацией об использовании и пользователях"""
-    with Session() as session:
-        promos = session.query(PromoCode).order_by(PromoCode.created_at.desc()).all()
-        result = []
-        for promo in promos:
-            # Получаем все использования для этого промокода
-            uses = session.query(PromoCodeUse).filter_by(promocode_id=promo.id).all()
-            users_info = []
-            for use in uses:
-                user = session.query(User).filter_by(telegram_id=use.user_id).first()
-                users_info.append({
-                    "telegram_id": use.user_id,
-                    "full_name": user.full_name if user else "Unknown",
-                    "username": user.username if user else None,
-                    "used_at": use.used_at
-                })
-            result.append({
-                "promo": promo,
-                "uses": users_info
-            })
-        return result
+async def get_promocodes_page(page: int = 0, page_size: int = 10):
+    """
+    Страница промокодов (новые первыми) с числом активаций каждого — одним запросом
+    с группировкой по промокоду. Возвращает ([(промокод, активаций)], всего промокодов).
+    """
+    async with Session() as session:
+        total = await session.scalar(select(func.count(PromoCode.id)))
+        rows = (await session.execute(
+            select(PromoCode, func.count(PromoCodeUse.id))
+            .outerjoin(PromoCodeUse, PromoCodeUse.promocode_id == PromoCode.id)
+            .group_by(PromoCode.id)
+            .order_by(PromoCode.id.desc())
+            .limit(page_size).offset(page * page_size)
+        )).all()
+        return [(promo, uses) for promo, uses in rows], total
+
+async def get_promo_activations(promo_id: int, page: int = 0, page_size: int = 20):
+    """
+    Промокод и страница его активаций (новые первыми) с именами пользователей — одним
+    запросом с JOIN. Возвращает (промокод или None, [активации], всего активаций).
+    """
+    async with Session() as session:
+        promo = await session.get(PromoCode, promo_id)
+        if not promo:
+            return None, [], 0
+        total = await session.scalar(select(func.count(PromoCodeUse.id)).filter_by(promocode_id=promo_id))
+        rows = (await session.execute(
+            select(PromoCodeUse.user_id, PromoCodeUse.used_at, User.full_name, User.username)
+            .outerjoin(User, User.telegram_id == PromoCodeUse.user_id)
+            .filter(PromoCodeUse.promocode_id == promo_id)
+            .order_by(PromoCodeUse.id.desc())
+            .limit(page_size).offset(page * page_size)
+        )).all()
+        uses = [{
+            "telegram_id": row.user_id,
+            "full_name": row.full_name or "Unknown",
+            "username": row.username,
+            "used_at": row.used_at
+        } for row in rows]
+        return promo, uses, total
 
 def generate_promo_code(length: int = 8) -> str:
     """Генерирует случайный код из букв и цифр."""
@@ -58,135 +79,158 @@ async def create_promo_code(months: int, max_uses: int, code: str = None, expire
         # генерируем уникальный код
         while True:
             candidate = generate_promo_code()
-            with Session() as session:
-                exists = session.query(PromoCode).filter_by(code=candidate).first()
+            async with Session() as session:
+                exists = await session.scalar(select(PromoCode).filter_by(code=candidate))
                 if not exists:
                     code = candidate
                     break
     else:
         # проверяем, что такого кода ещё нет
-        with Session() as session:
-            exists = session.query(PromoCode).filter_by(code=code).first()
+        async with Session() as session:
+            exists = await session.scalar(select(PromoCode).filter_by(code=code))
             if exists:
                 raise ValueError(f"Promo code '{code}' already exists")
 
-    promo = PromoCode(
+    return await save_promo_code(PromoCode(
         code=code,
         months=months,
         max_uses=max_uses,
         expires_at=expires_at
-    )
-    with Session() as session:
+    ))
+
+@writes
+async def save_promo_code(promo: PromoCode) -> PromoCode:
+    async with Session() as session:
         session.add(promo)
-        session.commit()
-        session.refresh(promo)
+        await session.commit()
+        await session.refresh(promo)
     return promo
 
 async def get_promo_by_code(code: str) -> PromoCode:
     """Возвращает промокод по коду или None."""
-    with Session() as session:
-        return session.query(PromoCode).filter_by(code=code).first()
-
-async def activate_promo_code(user_id: int, code: str) -> tuple[bool, str]:
+    async with Session() as session:
+        return await session.scalar(select(PromoCode).filter_by(code=code))
+
+def promo_error(promo: PromoCode, now: datetime) -> str:
+    """Причина, по которой промокод нельзя активировать, или None"""
+    if not promo:
+        return "Промокод не найден"
+    if not promo.is_active:
+        return "Промокод неактивен"
+    if promo.expires_at and promo.expires_at < now:
+        return "Срок действия промокода истёк"
+    if promo.current_uses >= promo.max_uses:
+        return "Промокод уже исчерпан"
+    return None
+
+@writes
+async def redeem_promo_code(user_id: int, code: str) -> tuple[PromoCode, str]:
     """
-    Активирует промокод для пользователя.
-    Возвращает (успех, сообщение).
+    Транзакция активации: начисление месяцев, запись использования и списание
+    использования промокода. Повторную активацию отсекает уникальность
+    (user_id, promocode_id), перерасход — условный UPDATE счётчика в конце транзакции.
+    Возвращает (промокод, None) при успехе или (None, текст ошибки).
     """
-    with Session() as session:
-        promo = session.query(PromoCode).filter_by(code=code).first()
-        if not promo:
-            return False, "Промокод не найден"
-        if not promo.is_active:
-            return False, "Промокод неактивен"
-        if promo.expires_at and promo.expires_at < datetime.utcnow():
-            return False, "Срок действия промокода истёк"
-        if promo.current_uses >= promo.max_uses:
-            return False, "Промокод уже исчерпан"
-
-        # Проверяем, не использовал ли этот пользователь данный промокод
-        existing_use = session.query(PromoCodeUse).filter_by(
-            user_id=user_id, promocode_id=promo.id
-        ).first()
-        if existing_use:
-            return False, "Вы уже использовали этот промокод"
-
-        # Получаем пользователя (создаём, если нет)
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if not user:
-            # Создаём пользователя (как в /start)
-            user = User(
+    now = datetime.utcnow()
+    async with Session() as session:
+        # Чтение без блокировок — только чтобы быстро отказать с понятной причиной
+        promo = await session.scalar(select(PromoCode).filter_by(code=code))
+        error = promo_error(promo, now)
+        if error:
+            return None, error
+
+        # Создаём пользователя, если его нет (как в /start, имя обновится позже)
+        created = await session.execute(
+            upsert_insert(User).values(
                 telegram_id=user_id,
-                full_name="Unknown",   # позже обновится при /start
+                full_name="Unknown",
                 username=None,
                 is_admin=(user_id in config.ADMINS)
+            ).on_conflict_do_nothing(index_elements=[User.telegram_id])
+        )
+        deltas = signup_deltas() if created.rowcount else Counter()
+
+        try:
+            await session.execute(insert(PromoCodeUse).values(user_id=user_id, promocode_id=promo.id, used_at=now))
+        except IntegrityError:
+            await session.rollback()
+            return None, "Вы уже использовали этот промокод"
+
+        # Начисляем месяцы: продлеваем от текущей даты окончания или начинаем с сейчас
+        old_end = await session.scalar(
+            select(User.subscription_end).filter_by(telegram_id=user_id).with_for_update()
+        )
+        new_end = max(old_end or now, now) + timedelta(days=30 * promo.months)
+        await session.execute(update(User).filter_by(telegram_id=user_id).values(subscription_end=new_end))
+
+        deltas.update(expiry_move(old_end, new_end))
+        deltas["promo_uses"] += 1
+        deltas[counter_key("promo_uses", now)] += 1
+        await bump_counters(session, deltas)
+
+        # Последним — атомарное списание использования: строка промокода блокируется
+        # только до коммита, а проверка лимита и увеличение — один оператор
+        taken = await session.execute(
+            update(PromoCode)
+            .where(
+                PromoCode.id == promo.id,
+                PromoCode.is_active.is_(True),
+                PromoCode.current_uses < PromoCode.max_uses,
+                or_(PromoCode.expires_at.is_(None), PromoCode.expires_at >= now)
             )
-            session.add(user)
-            session.flush()  # чтобы получить id
-
-        # Начисляем месяцы подписки
-        now = datetime.utcnow()
-        if user.subscription_end and user.subscription_end > now:
-            # продлеваем от текущей даты окончания
-            new_end = user.subscription_end + timedelta(days=30 * promo.months)
-        else:
-            # начинаем с сейчас
-            new_end = now + timedelta(days=30 * promo.months)
-        user.subscription_end = new_end
-
-        # Записываем использование
-        use = PromoCodeUse(user_id=user.telegram_id, promocode_id=promo.id)
-        session.add(use)
-
-        # Увеличиваем счётчик использований промокода
-        promo.current_uses += 1
-
-        session.commit()
-            # ... после успешной активации промокода ...
-
-        # Получаем свежего пользователя с обновлённой подпиской
-        user = await get_user(user_id)
-
-        # Если у пользователя нет профиля, создаём его
-        if not user.vless_profile_data:
-            days = promo.months * 30
-            profile_data = await create_vless_profile(user_id, subscription_days=days)
-            if profile_data:
-                with Session() as session:
-                    db_user = session.query(User).filter_by(telegram_id=user_id).first()
-                    if db_user:
-                        db_user.vless_profile_data = json.dumps(profile_data)
-                        session.commit()
-                # Сохраняем IP и применяем tc
-                client_ip = profile_data.get("client_ip")
-                if client_ip:
-                    with Session() as session:
-                        db_user = session.query(User).filter_by(telegram_id=user_id).first()
-                        if db_user and not db_user.client_ip:
-                            db_user.client_ip = client_ip
-                            session.commit()
-                    await apply_tc_limit(client_ip)
-        else:
-            # Профиль уже есть. Если он отключён, включаем его.
-            profile_data = safe_json_loads(user.vless_profile_data)
-            if profile_data and not user.is_enabled_in_panel:
-                email = profile_data["email"]
-                enable_success = await enable_client_by_email(email)
-                if enable_success:
-                    with Session() as session:
-                        db_user = session.query(User).filter_by(telegram_id=user_id).first()
-                        if db_user:
-                            db_user.is_enabled_in_panel = True
-                            session.commit()
-                    # Применяем tc, если IP есть
-                    if user.client_ip:
-                        await apply_tc_limit(user.client_ip)
-                else:
-                    logger.warning(f"⚠️ Failed to enable client {email} after promo activation")
-
-        # Далее функция возвращает результат
-        return True, f"Промокод активирован! Подписка продлена на {promo.months} мес."
+            .values(current_uses=PromoCode.current_uses + 1)
+        )
+        if not taken.rowcount:
+            await session.rollback()
+            return None, "Промокод уже исчерпан"
+
+        await session.commit()
+        user_cache.invalidate(user_id)
+        return promo, None
+
+async def activate_promo_code(user_id: int, code: str) -> tuple[bool, str]:
+    """
+    Активирует промокод для пользователя.
+    Возвращает (успех, сообщение).
+    """
+    promo, error = await redeem_promo_code(user_id, code)
+    if error:
+        return False, error
+
+    # Панель и tc — уже после коммита, чтобы не держать очередь записи на сетевых запросах
+    # Получаем свежего пользователя с обновлённой подпиской
+    user = await get_user(user_id)
+
+    # Если у пользователя нет профиля, создаём его
+    if not user.client_email:
+        days = promo.months * 30
+        profile_data = await create_vless_profile(user_id, subscription_days=days)
+        if profile_data:
+            await save_user_profile(user_id, profile_data)
+            # IP хранится в данных профиля, применяем tc
+            client_ip = profile_data.get("client_ip")
+            if client_ip:
+                await apply_tc_limit(client_ip)
+    else:
+        # Профиль уже есть. Если он отключён, включаем его.
+        if not user.is_enabled_in_panel:
+            email = user.client_email
+            enable_success = await enable_client_by_email(email)
+            if enable_success:
+                await update_user(user_id, is_enabled_in_panel=True)
+                # Применяем tc, если IP есть (хранится только в данных профиля)
+                profile_data = safe_json_loads(user.vless_profile_data) or {}
+                if profile_data.get("client_ip"):
+                    await apply_tc_limit(profile_data["client_ip"])
+            else:
+                logger.warning(f"⚠️ Failed to enable client {email} after promo activation")
+
+    expiry_scheduler.rearm()
+
+    # Далее функция возвращает результат
+    return True, f"Промокод активирован! Подписка продлена на {promo.months} мес."
 
 async def list_promocodes():
     """Возвращает список всех промокодов для админа."""
-    with Session() as session:
-        return session.query(PromoCode).order_by(PromoCode.created_at.desc()).all()
\ No newline at end of file
+    async with Session() as session:
+        return (await session.scalars(select(PromoCode).order_by(PromoCode.created_at.desc()))).all()
\ No newline at end of file
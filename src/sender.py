@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Классы исходящих сообщений: чем меньше значение, тем раньше уходит сообщение"""
+    INTERACTIVE = 0    # ответы на действия пользователя
+    TRANSACTIONAL = 1  # подтверждения оплаты, уведомления админов о платежах
+    NOTIFICATION = 2   # напоминания о подписке, реферальные уведомления
+    BULK = 3           # рассылки
+
+
+# Приоритет задаётся контекстом вызова: фоновые задачи выставляют его один раз,
+# обработчики апдейтов по умолчанию считаются интерактивными
+_priority = ContextVar("send_priority", default=Priority.INTERACTIVE)
+
+
+@contextmanager
+def send_priority(priority: Priority):
+    """Отправляет все сообщения внутри блока с указанным приоритетом"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def set_send_priority(priority: Priority):
+    """Выставляет приоритет для текущей задачи (и задач, созданных из неё)"""
+    _priority.set(priority)
+
+
+class TokenBucket:
+    """Глобальный лимит отправки: rate сообщений в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу на seconds (например, после RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Лимит на один чат: rate сообщений в секунду с запасом burst"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.chats = {}  # chat_id -> (tokens, time.monotonic() последнего пересчёта)
+
+    def _tokens(self, chat_id: int, now: float) -> float:
+        tokens, updated = self.chats.get(chat_id, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def delay(self, chat_id: int, now: float) -> float:
+        """Через сколько секунд в чат можно будет отправить следующее сообщение"""
+        tokens = self._tokens(chat_id, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, chat_id: int, now: float):
+        self.chats[chat_id] = (self._tokens(chat_id, now) - 1, now)
+        # Чаты с полным запасом хранить незачем
+        if len(self.chats) > 10000:
+            self.chats = {cid: v for cid, v in self.chats.items() if self._tokens(cid, now) < self.burst}
+
+
+class _Waiter:
+    __slots__ = ("priority", "chat_id", "enqueued", "future")
+
+    def __init__(self, priority: Priority, chat_id, future: asyncio.Future):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.enqueued = time.monotonic()
+        self.future = future
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Общий планировщик исходящих сообщений бота (middleware сессии aiogram).
+    Каждый запрос, адресованный чату, ждёт разрешения в очереди своего приоритета;
+    разрешения выдаются по одному под глобальным лимитом SENDER_RATE и лимитом на чат,
+    всегда начиная с самого приоритетного готового запроса. RetryAfter от Telegram
+    останавливает выдачу для всех, запрос повторяется.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(config.SENDER_RATE)
+        self.chats = ChatLimiter(config.SENDER_CHAT_RATE, config.SENDER_CHAT_BURST)
+        self.queues = {priority: deque() for priority in Priority}
+        self.granted = {priority: 0 for priority in Priority}
+        self.retries = {priority: 0 for priority in Priority}
+        self.waits = {priority: deque(maxlen=1000) for priority in Priority}  # время в очереди, сек
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery и т.п. в лимиты сообщений не входят
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        for attempt in range(config.SENDER_MAX_RETRIES + 1):
+            await self.acquire(priority, chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                self.retries[priority] += 1
+                logger.warning(f"⚠️ Flood control: sending paused for {e.retry_after}s ({priority.name})")
+                if attempt == config.SENDER_MAX_RETRIES:
+                    raise
+
+    async def acquire(self, priority: Priority, chat_id):
+        """Ждёт своей очереди на отправку в chat_id"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].append(_Waiter(priority, chat_id, future))
+        self._wakeup.set()
+        await future
+
+    def _pick(self, now: float):
+        """Самый приоритетный запрос, чат которого готов; иначе None и время до ближайшей готовности"""
+        nearest = None
+        for priority in Priority:
+            queue = self.queues[priority]
+            for waiter in list(queue):
+                if waiter.future.done():
+                    # Вызывающий отменил ожидание
+                    queue.remove(waiter)
+                    continue
+                delay = self.chats.delay(waiter.chat_id, now)
+                if delay == 0:
+                    queue.remove(waiter)
+                    return waiter, None
+                nearest = delay if nearest is None else min(nearest, delay)
+        return None, nearest
+
+    async def _dispatch(self):
+        while True:
+            waiter, delay = self._pick(time.monotonic())
+            if waiter is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Пока ждали токен, мог прийти более срочный запрос — он и получит разрешение
+            await self.bucket.acquire()
+            now = time.monotonic()
+            better, _ = self._pick(now)
+            if better is not None:
+                if better.priority < waiter.priority:
+                    self.queues[waiter.priority].appendleft(waiter)
+                    waiter = better
+                else:
+                    self.queues[better.priority].appendleft(better)
+            if waiter.future.done():
+                continue
+
+            self.chats.take(waiter.chat_id, now)
+            self.granted[waiter.priority] += 1
+            self.waits[waiter.priority].append(now - waiter.enqueued)
+            waiter.future.set_result(None)
+
+    def stats(self) -> dict:
+        """Глубина очередей и время ожидания по приоритетам"""
+        result = {}
+        for priority in Priority:
+            waits = sorted(self.waits[priority])
+            result[priority.name.lower()] = {
+                "queued": len(self.queues[priority]),
+                "sent": self.granted[priority],
+                "retries": self.retries[priority],
+                "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+                "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            }
+        return result
+
+
+send_scheduler = SendScheduler()
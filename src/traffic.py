@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from config import config
+from database import (
+    add_traffic_samples, rollup_traffic, get_last_traffic_bucket, purge_traffic,
+    get_traffic_series, get_top_consumers
+)
+from functions import get_xui_api, get_user_stats as fetch_user_stats
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficStore:
+    """Локальная таблица трафика клиентов: email -> (upload, download)"""
+
+    def __init__(self):
+        self.clients = {}
+        self.updated_at = None  # time.monotonic() последнего сбора
+
+    def update(self, client_stats: list):
+        self.clients = {
+            item["email"]: (int(item.get("up") or 0), int(item.get("down") or 0))
+            for item in client_stats
+            if item.get("email")
+        }
+        self.updated_at = time.monotonic()
+
+    def get(self, email: str):
+        """(upload, download) или None, если сбор ещё не выполнялся / клиента нет"""
+        if self.updated_at is None:
+            return None
+        return self.clients.get(email)
+
+
+class TrafficHistory:
+    """
+    История трафика по клиентам. Приросты счётчиков копятся в текущей корзине
+    (TRAFFIC_BUCKET_SECONDS) и пишутся в БД одной вставкой, когда корзина закрывается.
+    Закрытые часы и дни сворачиваются в агрегаты hour/day, старые корзины удаляются.
+    """
+
+    def __init__(self):
+        self.bucket_start = None
+        self.pending = {}  # email -> [upload, download] текущей корзины
+        self.last_rollup_hour = None
+        self.next_hour = None  # начало следующего часа для свёртки raw -> hour
+        self.next_day = None   # начало следующего дня для свёртки hour -> day
+
+    @staticmethod
+    def bucket_of(moment: datetime) -> datetime:
+        size = config.TRAFFIC_BUCKET_SECONDS
+        seconds = int((moment - datetime.min).total_seconds()) // size * size
+        return datetime.min + timedelta(seconds=seconds)
+
+    async def record(self, previous: dict, current: dict, now: datetime):
+        """Добавляет приросты между двумя сборами; при смене корзины сбрасывает прошлую в БД"""
+        bucket = self.bucket_of(now)
+        if self.bucket_start is not None and bucket != self.bucket_start:
+            await self.flush()
+        self.bucket_start = bucket
+
+        for email, (up, down) in current.items():
+            prev = previous.get(email)
+            if prev is None:
+                continue
+            # Счётчики в панели могли сбросить — тогда прирост равен новому значению
+            d_up = up - prev[0] if up >= prev[0] else up
+            d_down = down - prev[1] if down >= prev[1] else down
+            if d_up or d_down:
+                acc = self.pending.setdefault(email, [0, 0])
+                acc[0] += d_up
+                acc[1] += d_down
+
+    async def flush(self):
+        if self.pending and self.bucket_start is not None:
+            await add_traffic_samples("raw", self.bucket_start, self.pending)
+        self.pending = {}
+
+    async def rollup(self, now: datetime):
+        """Сворачивает закрытые часы в hour, закрытые дни в day и чистит устаревшие корзины"""
+        current_hour = now.replace(minute=0, second=0, microsecond=0)
+        if self.last_rollup_hour == current_hour:
+            return
+        oldest_raw = now - timedelta(days=config.TRAFFIC_RAW_RETENTION_DAYS)
+
+        if self.next_hour is None:
+            # После старта продолжаем с последнего агрегата в БД, но не раньше хранимых raw
+            last_hour = await get_last_traffic_bucket("hour")
+            last_day = await get_last_traffic_bucket("day")
+            self.next_hour = max(
+                last_hour + timedelta(hours=1) if last_hour else datetime.min,
+                oldest_raw.replace(minute=0, second=0, microsecond=0)
+            )
+            self.next_day = max(
+                last_day + timedelta(days=1) if last_day else datetime.min,
+                (now - timedelta(days=config.TRAFFIC_HOURLY_RETENTION_DAYS)).replace(
+                    hour=0, minute=0, second=0, microsecond=0)
+            )
+
+        while self.next_hour < current_hour:
+            await rollup_traffic("raw", "hour", self.next_hour, self.next_hour + timedelta(hours=1))
+            self.next_hour += timedelta(hours=1)
+
+        today = current_hour.replace(hour=0)
+        while self.next_day < today:
+            await rollup_traffic("hour", "day", self.next_day, self.next_day + timedelta(days=1))
+            self.next_day += timedelta(days=1)
+
+        await purge_traffic("raw", oldest_raw)
+        await purge_traffic("hour", now - timedelta(days=config.TRAFFIC_HOURLY_RETENTION_DAYS))
+        await purge_traffic("day", now - timedelta(days=config.TRAFFIC_DAILY_RETENTION_DAYS))
+        self.last_rollup_hour = current_hour
+
+    async def unrolled_since(self) -> datetime:
+        """Начало первого часа, который ещё не свёрнут в hour и лежит только в raw"""
+        if self.next_hour is not None:
+            return self.next_hour
+        last_hour = await get_last_traffic_bucket("hour")
+        return last_hour + timedelta(hours=1) if last_hour else datetime.min
+
+
+traffic_store = TrafficStore()
+traffic_history = TrafficHistory()
+
+
+async def collect_traffic():
+    """Забирает трафик всех клиентов инбаунда одним запросом (clientStats) в локальную таблицу"""
+    api = get_xui_api()
+    # Под блокировкой инбаунда: свежий снимок не подменит тот, к которому пакет записи уже применяет изменения
+    async with api.inbound_lock(config.INBOUND_ID):
+        snapshot = await api.get_inbound_snapshot(config.INBOUND_ID, force=True)
+    if not snapshot:
+        logger.warning("⚠️ Traffic collection skipped: inbound not available")
+        return False
+    previous = traffic_store.clients if traffic_store.updated_at is not None else {}
+    traffic_store.update(snapshot.inbound.get("clientStats") or [])
+    logger.debug(f"⚙️ Traffic collected for {len(traffic_store.clients)} clients")
+
+    now = datetime.utcnow()
+    await traffic_history.record(previous, traffic_store.clients, now)
+    await traffic_history.rollup(now)
+    return True
+
+
+async def run_traffic_collector():
+    """Фоновый сбор трафика клиентов каждые TRAFFIC_COLLECT_INTERVAL секунд"""
+    while True:
+        try:
+            await collect_traffic()
+        except Exception as e:
+            logger.warning(f"⚠️ Traffic collection error: {e}")
+        await asyncio.sleep(config.TRAFFIC_COLLECT_INTERVAL)
+
+
+async def get_user_stats(email: str):
+    """
+    Статистика клиента из локальной таблицы без запросов к панели.
+    subId берётся из закэшированного снимка инбаунда. Пока сбор не выполнялся
+    или клиента ещё нет в таблице — запрашивает панель напрямую.
+    """
+    traffic = traffic_store.get(email)
+    if traffic is None:
+        return await fetch_user_stats(email)
+
+    snapshot = get_xui_api().cached_inbound_snapshot(config.INBOUND_ID)
+    client = snapshot.find_client(email) if snapshot else None
+    return {
+        "upload": traffic[0],
+        "download": traffic[1],
+        "subId": client.get("subId") if client else None
+    }
+
+
+async def get_daily_usage(email: str, days: int = 7):
+    """Трафик клиента по дням за последние days дней: [(date, bytes)]
+
+    Закрытые часы берутся из часовых агрегатов, текущий (ещё не свёрнутый) — из raw-корзин
+    и незаписанной корзины в памяти.
+    """
+    today = datetime.utcnow().date()
+    first = today - timedelta(days=days - 1)
+    totals = {first + timedelta(days=i): 0 for i in range(days)}
+    since = datetime.combine(first, datetime.min.time())
+    raw_since = max(since, await traffic_history.unrolled_since())
+    samples = await get_traffic_series(email, "hour", since)
+    samples += await get_traffic_series(email, "raw", raw_since)
+    if email in traffic_history.pending:
+        samples.append((traffic_history.bucket_start, *traffic_history.pending[email]))
+    for bucket_start, up, down in samples:
+        day = bucket_start.date()
+        if day in totals:
+            totals[day] += int(up or 0) + int(down or 0)
+    return list(totals.items())
+
+
+async def get_top_traffic(hours: int, limit: int = 10):
+    """Топ клиентов по трафику за последние hours часов: [(email, bytes)]"""
+    since = datetime.utcnow() - timedelta(hours=hours)
+    raw_since = max(since, await traffic_history.unrolled_since())
+    rows = await get_top_consumers("hour", since, limit, raw_since=raw_since)
+    return [(email, int(up or 0) + int(down or 0)) for email, up, down in rows]